@@ -0,0 +1,97 @@
+"""
+    Generates synthetic diaries for benchmarking, e.g.
+
+        python -m benchmarks.generate --entries 100000 --key --output /tmp/diaries
+"""
+import random
+import argparse
+from pathlib import Path
+from datetime import datetime, timedelta
+from cryptography.fernet import Fernet
+from mdiary.crypto import EntryCipher
+from mdiary.database import DBHandler
+from mdiary.search import parse_tags, query_words
+from mdiary.stats import text_stats
+
+WORDS = ('the a and to of in it was we i my day work home walk coffee rain sun friend family book '
+         'read wrote long short tired happy meeting code python garden dinner lunch train city '
+         'mountain river evening morning night music film idea plan project week weekend quiet').split()
+
+TAGS = 'work family travel health books ideas'.split()
+TAG_RATE = 0.3 # of the entries end with a #tag
+
+START = datetime(2000, 1, 1)
+
+def gen_text(rng, min_words, max_words):
+    """
+        Returns a random entry of min_words to max_words words, where short
+        entries are more common than long ones, some ending with a #tag.
+    """
+    n_words = min(max_words, min_words + int(rng.expovariate(1 / max(1, (max_words - min_words) / 8))))
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    lines = [' '.join(words[i:i + 12]) for i in range(0, n_words, 12)]
+
+    txt = '\n'.join(lines).capitalize()
+
+    if rng.random() < TAG_RATE:
+        txt += '\n#' + rng.choice(TAGS)
+
+    return txt
+
+def gen_rows(entries, min_words=5, max_words=400, seed=0):
+    """
+        Yields (timestamp, text) rows of a diary, written a few hours apart.
+    """
+    rng = random.Random(seed)
+    timestamp = START
+
+    for _ in range(entries):
+        timestamp += timedelta(minutes=rng.randint(30, 60 * 24))
+        yield timestamp, gen_text(rng, min_words, max_words)
+
+def generate_diary(path, name, entries, key=None, min_words=5, max_words=400, seed=0, profile='fast'):
+    """
+        Create a diary called name with the given number of entries in the
+        directory path, encrypted and indexed when a key is given. Returns
+        the DBHandler of the diary.
+    """
+    db_handler = DBHandler(name=name, profile=profile, path=path)
+    db_handler.create(fulltext=key is None)
+    db_handler.new_session()
+
+    rows = gen_rows(entries, min_words, max_words, seed)
+
+    if key is None:
+        db_handler.bulk_insert((timestamp, txt, None, None, None) for timestamp, txt in rows)
+    else:
+        cipher = EntryCipher(key)
+        db_handler.bulk_insert((timestamp, cipher.encrypt(txt), cipher.blind_tokens(set(query_words(txt))),
+                                text_stats(txt), cipher.blind_tags(parse_tags(txt))) for timestamp, txt in rows)
+
+    return db_handler
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic mdiary database.')
+    parser.add_argument('--entries', '-n', type=int, default=1000, help='the number of entries.')
+    parser.add_argument('--output', '-o', default='.', help='the directory to create the diary in.')
+    parser.add_argument('--name', default=None, help='the file name of the diary.')
+    parser.add_argument('--key', action='store_true', help='encrypt the diary, storing the key next to it.')
+    parser.add_argument('--min-words', type=int, default=5)
+    parser.add_argument('--max-words', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    name = args.name or 'bench-{}{}.db'.format(args.entries, '-key' if args.key else '')
+    key = None
+
+    if args.key:
+        key = Fernet.generate_key()
+        (Path(args.output) / (name + '.key')).write_bytes(key)
+
+    db_handler = generate_diary(args.output, name, args.entries, key, args.min_words, args.max_words, args.seed)
+    db_handler.close()
+
+    print(db_handler.full_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+    Runs the mdiary benchmarks on synthetic diaries and writes the results
+    as JSON, such that runs of different versions can be compared, e.g.
+
+        python -m benchmarks.run --sizes 1000,10000 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from cryptography.fernet import Fernet
+from benchmarks.generate import generate_diary, gen_rows
+from mdiary.config import ConfigHandler
+
+ROOT = Path(__file__).resolve().parent.parent
+SCREEN = (100, 50)
+
+def timed(func, repeat=1):
+    """
+        Returns the durations in seconds of calling func repeat times.
+    """
+    durations = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+def summary(durations):
+    durations = sorted(durations)
+
+    return {
+        'median': statistics.median(durations),
+        'p95': durations[min(len(durations) - 1, int(0.95 * len(durations)))],
+        'min': durations[0],
+        'max': durations[-1],
+        'n': len(durations)
+    }
+
+class Benchmark():
+    """
+        Runs the benchmarks on one synthetic diary in a temporary home directory.
+    """
+    def __init__(self, entries, encrypted, results):
+        self.entries = entries
+        self.encrypted = encrypted
+        self.results = results
+        self.home = Path(tempfile.mkdtemp(prefix='mdiary-bench-'))
+        self.key = Fernet.generate_key() if encrypted else None
+
+    def record(self, name, value, unit, **stats):
+        result = {
+            'benchmark': name,
+            'entries': self.entries,
+            'encrypted': self.encrypted,
+            'value': value,
+            'unit': unit
+        }
+        result.update(stats)
+        self.results.append(result)
+
+        print('{:<26} {:>8} {:<6} {:>12.4f} {}'.format(name, self.entries, 'key' if self.encrypted else 'plain',
+                                                       value, unit), file=sys.stderr)
+
+    def setup(self):
+        os.environ['HOME'] = str(self.home)
+        db_path = self.home / '.mdiary'
+        db_path.mkdir()
+
+        start = time.perf_counter()
+        generate_diary(db_path, 'bench.db', self.entries, self.key).close()
+        self.record('generate', time.perf_counter() - start, 's')
+        self.record('db_size', (db_path / 'bench.db').stat().st_size / 2**20, 'MiB')
+
+        config_path = self.home / '.config' / 'mdiary'
+        config_path.mkdir(parents=True)
+        ConfigHandler(config_path).write('bench', 'true' if self.encrypted else 'false')
+
+        if self.key:
+            (db_path / 'bench.key').write_bytes(self.key)
+
+    def open_diary(self):
+        from mdiary.gui import Diary
+
+        diary = Diary()
+
+        if self.key:
+            diary.key_file = self.home / '.mdiary' / 'bench.key'
+            diary.set_key()
+
+        diary.gen_db()
+
+        return diary
+
+    def run(self):
+        self.setup()
+        diary = self.open_diary()
+
+        self.bench_reader(diary)
+        self.bench_decrypt(diary)
+        self.bench_inserts(diary)
+        self.bench_updates(diary)
+
+        diary.close_diary()
+        shutil.rmtree(str(self.home))
+
+    def bench_reader(self, diary):
+        reader = diary.get_view('reader')
+
+        def open_reader():
+            if diary.cipher:
+                diary.cipher.wipe()
+            reader.show_range()
+            reader.update_reader()
+            reader.render(SCREEN, focus=True)
+
+        durations = timed(open_reader, repeat=5)
+        self.record('reader_open', statistics.median(durations), 's', stats=summary(durations))
+
+        def open_tag():
+            if diary.cipher:
+                diary.cipher.wipe()
+            reader.show_tag('#work')
+            reader.update_reader()
+            reader.render(SCREEN, focus=True)
+
+        durations = timed(open_tag, repeat=5)
+        self.record('reader_open_tag', statistics.median(durations), 's', stats=summary(durations))
+        reader.show_range()
+
+        def scroll():
+            for _ in range(100):
+                reader.listbox.keypress(SCREEN, 'page down')
+                reader.render(SCREEN, focus=True)
+
+        durations = timed(scroll)
+        self.record('reader_scroll_100', durations[0], 's')
+
+        def edit_focused():
+            focus = reader.walker.focus
+            diary.update_entry(focus[1] if isinstance(focus, tuple) else 1, 'edited entry')
+            diary.db_handler.flush()
+            reader.update_reader()
+            reader.render(SCREEN, focus=True)
+
+        durations = timed(edit_focused, repeat=5)
+        self.record('reader_after_edit', statistics.median(durations) * 1000, 'ms', stats=summary(durations))
+
+    def bench_decrypt(self, diary):
+        if not self.key:
+            return
+
+        rows = [(row.entry_id, row.entry_text) for row in diary.db_handler.iter_entries()]
+        diary.cipher.wipe()
+
+        start = time.perf_counter()
+        count = sum(1 for _ in diary.cipher.decrypt_many(rows))
+        self.record('decrypt_throughput', count / (time.perf_counter() - start), 'entries/s')
+
+    def bench_inserts(self, diary):
+        db_handler = diary.db_handler
+        rows = list(gen_rows(200, seed=1))
+
+        def insert():
+            for _, txt in rows:
+                diary.db_handler.new_entry(diary.encrypt_entry(txt) if self.key else txt)
+
+        duration = timed(insert)[0]
+        self.record('insert_throughput', len(rows) / duration, 'entries/s')
+
+        def queued_insert():
+            for _, txt in rows:
+                diary.add_entry(txt)
+            db_handler.flush()
+
+        duration = timed(queued_insert)[0]
+        self.record('queued_insert_throughput', len(rows) / duration, 'entries/s')
+
+    def bench_updates(self, diary):
+        db_handler = diary.db_handler
+        rng = random.Random(2)
+        ids = rng.sample(range(1, self.entries + 1), min(100, self.entries))
+
+        def update(entry_id):
+            txt = 'updated entry {}'.format(entry_id)
+            db_handler.update_entry(entry_id, diary.encrypt_entry(txt) if self.key else txt)
+
+        durations = [timed(lambda: update(entry_id))[0] for entry_id in ids]
+        self.record('update_latency', statistics.median(durations) * 1000, 'ms', stats=summary(durations))
+
+        durations = [timed(lambda: db_handler.remove_entry(entry_id))[0] for entry_id in ids]
+        self.record('delete_latency', statistics.median(durations) * 1000, 'ms', stats=summary(durations))
+
+STARTUP_COMMANDS = {
+    'startup_cli': [str(ROOT / 'mdiary.py'), '--version'],
+    'startup_headless_import': ['-c', 'import mdiary.cli, mdiary.core, mdiary.lite'],
+    'startup_tui_import': ['-c', 'import mdiary.gui']
+}
+
+def bench_startup(results):
+    """
+        Measure the time it takes to start the mdiary command, and to 
+        import everything the headless commands and the terminal 
+        interface need.
+    """
+    for name, command in STARTUP_COMMANDS.items():
+        command = [sys.executable] + command
+        durations = timed(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, cwd=ROOT, check=True), 
+                          repeat=5)
+
+        results.append({'benchmark': name, 'value': statistics.median(durations),
+                        'unit': 's', 'stats': summary(durations)})
+        print('{:<26} {:>27.4f} s'.format(name, statistics.median(durations)), file=sys.stderr)
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mdiary on synthetic diaries.')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated numbers of entries, e.g. 1000,100000,1000000.')
+    parser.add_argument('--plain-only', action='store_true', help='skip the encrypted diaries.')
+    parser.add_argument('--output', '-o', help='the file to write the JSON results to, stdout by default.')
+    args = parser.parse_args()
+
+    results = []
+    bench_startup(results)
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        for encrypted in (False,) if args.plain_only else (False, True):
+            Benchmark(size, encrypted, results).run()
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'results': results
+    }
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
-from mdiary.gui import Diary
+from mdiary.cli import main
 
 if __name__ == '__main__':
-    diary = Diary()
-    diary.main()
+    main()
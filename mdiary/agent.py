@@ -0,0 +1,167 @@
+"""
+    A small key agent holding the unlocked key of a diary, such that
+    only the first invocation has to read the key file and verify it
+    against the stored (deliberately slow) key hash. The agent listens
+    on a Unix domain socket only the user can connect to, and exits
+    after being idle for a while.
+"""
+import os
+import sys
+import time
+import socket
+from pathlib import Path
+
+AGENT_TIMEOUT = 15 * 60 # seconds
+START_TIMEOUT = 5 # seconds
+REQUEST_SIZE = 64
+
+def socket_path(db_name, path=None):
+    """
+        Returns the path of the agent socket of the diary db_name.
+    """
+    path = Path(path) if path else Path.home() / '.mdiary'
+
+    return path / (db_name + '.agent')
+
+def request(sock_path, command):
+    """
+        Send a command to the agent listening on sock_path, returns its
+        reply or None if no agent is running.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(str(sock_path))
+        client.sendall(command + b'\n')
+        client.shutdown(socket.SHUT_WR)
+
+        reply = b''
+
+        while True:
+            data = client.recv(4096)
+
+            if not data:
+                break
+
+            reply += data
+    except OSError:
+        return None
+    finally:
+        client.close()
+
+    return reply
+
+def get_key(sock_path):
+    """
+        Returns the key held by the agent, None if no agent is running.
+    """
+    return request(sock_path, b'key') or None
+
+def stop(sock_path):
+    """
+        Stop the agent, returns whether one was running.
+    """
+    return request(sock_path, b'stop') is not None
+
+def start(sock_path, key, timeout=AGENT_TIMEOUT):
+    """
+        Start an agent holding key in the background, passing the key
+        through a pipe such that it never shows up in the process list.
+        Returns once the agent accepts connections.
+    """
+    import subprocess
+
+    # Run from the directory containing the mdiary package, such that it can be imported
+    root = Path(__file__).resolve().parent.parent
+
+    process = subprocess.Popen([sys.executable, '-m', 'mdiary.agent', str(sock_path), str(timeout)],
+                               cwd=str(root), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+    process.stdin.write(key)
+    process.stdin.close()
+
+    deadline = time.monotonic() + START_TIMEOUT
+
+    while time.monotonic() < deadline:
+        if get_key(sock_path) == key:
+            return
+
+        if process.poll() is not None:
+            break
+
+        time.sleep(0.01)
+
+    raise RuntimeError('The key agent did not start.')
+
+def peer_is_owner(conn):
+    """
+        Check that the process on the other end of the connection runs
+        as the same user, where the platform tells (Linux).
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+    uid = int.from_bytes(creds[4:8], sys.byteorder)
+
+    return uid == os.getuid()
+
+def serve(sock_path, key, timeout=AGENT_TIMEOUT):
+    """
+        Answer requests for the key on sock_path until the agent is
+        stopped or has been idle for timeout seconds.
+    """
+    sock_path = Path(sock_path)
+
+    if sock_path.exists():
+        if get_key(sock_path) is not None:
+            raise RuntimeError('A key agent is already running on {}.'.format(sock_path))
+
+        sock_path.unlink()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+
+    try:
+        server.bind(str(sock_path))
+    finally:
+        os.umask(umask)
+
+    os.chmod(str(sock_path), 0o600)
+    server.listen()
+    server.settimeout(timeout)
+
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+
+            with conn:
+                conn.settimeout(1)
+
+                if not peer_is_owner(conn):
+                    continue
+
+                try:
+                    command = conn.recv(REQUEST_SIZE).strip()
+                except OSError:
+                    continue
+
+                if command == b'key':
+                    conn.sendall(key)
+                elif command == b'stop':
+                    break
+    finally:
+        server.close()
+        sock_path.unlink()
+
+def main():
+    sock_path, timeout = sys.argv[1], float(sys.argv[2])
+    key = sys.stdin.buffer.read()
+
+    serve(sock_path, key, timeout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""
+    Incremental backups of a diary. A backup is a consistent snapshot of
+    each database of the diary (the shards of a sharded diary are backed
+    up one by one), taken with SQLite's online backup API while the diary
+    may be in use, split into chunks of CHUNK_SIZE bytes which are stored
+    under their SHA-256 hash. Chunks are aligned to the pages of the
+    database, such that a backup only stores the chunks holding pages
+    which changed since an earlier backup. Every backup has a manifest
+    listing the chunks of its databases, in the backup directory
+
+        chunks/ab/abcdef...     the compressed chunks, see mdiary.payload
+        snapshots/ID.json       the manifests, ID being the time of the backup
+        lock                    locked while a backup is taken or pruned
+"""
+import os
+import json
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from mdiary.lite import BUSY_TIMEOUT
+from mdiary.payload import compress, decompress, resolve_codec
+from mdiary.trace import traced
+
+CHUNK_SIZE = 64 * 1024 # bytes, a multiple of the largest page size
+ID_FORMAT = '%Y-%m-%dT%H-%M-%S-%f'
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class BackupError(ValueError):
+    pass
+
+def write_file(path, data):
+    """
+        Write the bytes data to the file at path atomically.
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+
+    with tmp_path.open('wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(str(tmp_path), str(path))
+
+def check_database(path):
+    """
+        Raises BackupError if the database file at path is corrupt.
+    """
+    conn = sqlite3.connect(str(path))
+
+    try:
+        result = conn.execute('PRAGMA quick_check').fetchone()[0]
+    except sqlite3.DatabaseError as error:
+        result = str(error)
+    finally:
+        conn.close()
+
+    if result != 'ok':
+        raise BackupError('The database {} is corrupt: {}'.format(path, result))
+
+def copy_database(source, target):
+    """
+        Copy the database at source to target (which may be in use)
+        with the online backup API, in a single step such that the copy
+        is consistent.
+    """
+    source_conn = sqlite3.connect(str(source))
+    target_conn = sqlite3.connect(str(target))
+
+    try:
+        for conn in (source_conn, target_conn):
+            conn.execute('PRAGMA busy_timeout = {}'.format(BUSY_TIMEOUT))
+
+        source_conn.backup(target_conn)
+    finally:
+        target_conn.close()
+        source_conn.close()
+
+def parse_point(point):
+    """
+        Returns the datetime of a point in time given as
+        YYYY-MM-DD[ HH:MM[:SS]], None if it is not one.
+    """
+    try:
+        return datetime.fromisoformat(point)
+    except ValueError:
+        return None
+
+def manifest_databases(manifest):
+    """
+        Returns the dicts with the name, size, sha256 and chunks of the
+        databases of a backup, the main database first.
+    """
+    # Backups of a single database
+    if 'databases' not in manifest:
+        return [{'name': manifest['database'], 'size': manifest['size'], 'sha256': manifest['sha256'],
+                 'chunks': manifest['chunks']}]
+
+    return manifest['databases']
+
+def manifest_chunks(manifest):
+    return [digest for database in manifest_databases(manifest) for digest in database['chunks']]
+
+def manifest_time(manifest):
+    # Older backups were created with a precision of seconds
+    return datetime.fromisoformat(manifest['created'])
+
+class BackupStore():
+    """
+        The backups of a diary in the directory path, see the module
+        docstring. Chunks are compressed with the codec of the
+        compression setting.
+    """
+    def __init__(self, path, compression='auto'):
+        self.path = Path(path)
+        self.chunks_path = self.path / 'chunks'
+        self.snapshots_path = self.path / 'snapshots'
+        self.codec = resolve_codec(compression)
+
+    @contextmanager
+    def lock(self):
+        """
+            Hold the lock of the backups, waiting until other processes
+            release it, where the platform supports it (POSIX).
+        """
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        with (self.path / 'lock').open('a') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def chunk_path(self, digest):
+        return self.chunks_path / digest[:2] / digest
+
+    def has_chunk(self, digest):
+        return self.chunk_path(digest).is_file()
+
+    def write_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        path.parent.mkdir(mode=0o700, exist_ok=True)
+        header, body = compress(data, self.codec)
+        write_file(path, bytes([header]) + body)
+
+    def read_chunk(self, digest):
+        """
+            Returns the data of a chunk, raises BackupError if it is
+            missing or does not match its hash.
+        """
+        try:
+            value = self.chunk_path(digest).read_bytes()
+            data = decompress(value[0], value[1:])
+        # Any error of the codecs means the chunk is corrupt
+        except Exception as error:
+            raise BackupError('The chunk {} cannot be read: {}'.format(digest, error))
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise BackupError('The chunk {} is corrupt.'.format(digest))
+
+        return data
+
+    def store_database(self, db_file, snapshot):
+        """
+            Store the chunks of the database at db_file which are not
+            stored yet, copying it to the file snapshot first. Returns
+            its entry of the manifest and the number and size of the
+            stored chunks.
+        """
+        copy_database(db_file, snapshot)
+        check_database(snapshot)
+
+        chunks = []
+        new_chunks = 0
+        new_bytes = 0
+        file_hash = hashlib.sha256()
+
+        with snapshot.open('rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest = hashlib.sha256(data).hexdigest()
+                file_hash.update(data)
+                chunks.append(digest)
+
+                if not self.has_chunk(digest):
+                    self.write_chunk(digest, data)
+                    new_chunks += 1
+                    new_bytes += len(data)
+
+        database = {
+            'name': Path(db_file).name,
+            'size': snapshot.stat().st_size,
+            'sha256': file_hash.hexdigest(),
+            'chunks': chunks
+        }
+
+        return database, new_chunks, new_bytes
+
+    @traced('backup.create')
+    def create(self, db_files, files=None):
+        """
+            Back up the databases at the paths db_files, the main database
+            first, storing the chunks which are not stored yet. files maps
+            the names of small text files kept next to the database (such
+            as its key hash) to their text, which are stored in the manifest.
+            Holds the lock of the backups, such that a concurrent prune does
+            not delete the chunks it reuses. Returns the manifest.
+        """
+        with self.lock():
+            return self.create_locked(db_files, files)
+
+    def create_locked(self, db_files, files=None):
+        self.chunks_path.mkdir(mode=0o700, exist_ok=True)
+        self.snapshots_path.mkdir(mode=0o700, exist_ok=True)
+
+        # The ids of backups taken within the resolution of the clock differ as well
+        snapshots = self.snapshots()
+        created = datetime.now()
+
+        if snapshots and manifest_time(snapshots[-1]) >= created:
+            created = manifest_time(snapshots[-1]) + timedelta(microseconds=1)
+
+        backup_id = created.strftime(ID_FORMAT)
+        manifest_path = self.snapshots_path / (backup_id + '.json')
+        snapshot = self.path / 'snapshot.tmp'
+
+        if snapshot.exists():
+            snapshot.unlink()
+
+        databases = []
+        new_chunks = 0
+        new_bytes = 0
+
+        try:
+            for db_file in db_files:
+                database, chunks, size = self.store_database(db_file, snapshot)
+                databases.append(database)
+                new_chunks += chunks
+                new_bytes += size
+
+            manifest = {
+                'id': backup_id,
+                'created': created.isoformat(' ', 'microseconds'),
+                'databases': databases,
+                'size': sum(database['size'] for database in databases),
+                'chunk_size': CHUNK_SIZE,
+                'new_chunks': new_chunks,
+                'new_bytes': new_bytes,
+                'files': files or {}
+            }
+
+            write_file(manifest_path, json.dumps(manifest).encode())
+        finally:
+            if snapshot.exists():
+                snapshot.unlink()
+
+        return manifest
+
+    def snapshots(self):
+        """
+            Returns the manifests of all backups, oldest first.
+        """
+        if not self.snapshots_path.is_dir():
+            return []
+
+        manifests = [json.loads(path.read_text()) for path in self.snapshots_path.glob('*.json')]
+
+        return sorted(manifests, key=manifest_time)
+
+    def find(self, point=None):
+        """
+            Returns the manifest of the backup with the id point, or the
+            last one taken at or before the time point, or the latest if
+            point is None or 'latest'. Raises BackupError if there is none.
+        """
+        snapshots = self.snapshots()
+
+        if point in (None, 'latest'):
+            found = snapshots[-1:]
+        else:
+            time = parse_point(point)
+            found = [manifest for manifest in snapshots if manifest['id'] == point or
+                     (time and manifest_time(manifest) <= time)]
+
+        if not found:
+            raise BackupError('There is no backup {}.'.format('yet' if point in (None, 'latest') else 'at ' + point))
+
+        return found[-1]
+
+    @traced('backup.verify')
+    def verify(self, manifests):
+        """
+            Check that all chunks of the backups of manifests are stored
+            and match their hash, checking every chunk once. Returns the
+            number of checked chunks, raises BackupError otherwise.
+        """
+        checked = set()
+
+        for manifest in manifests:
+            for digest in manifest_chunks(manifest):
+                if digest not in checked:
+                    self.read_chunk(digest)
+                    checked.add(digest)
+
+        return len(checked)
+
+    def reassemble(self, manifest, database, path):
+        """
+            Write the database of a backup to the file path, raises 
+            BackupError if it does not match its checksum.
+        """
+        file_hash = hashlib.sha256()
+
+        with path.open('wb') as f:
+            for digest in database['chunks']:
+                data = self.read_chunk(digest)
+                file_hash.update(data)
+                f.write(data)
+
+        if file_hash.hexdigest() != database['sha256'] or path.stat().st_size != database['size']:
+            raise BackupError('The backup {} of {} does not match its checksum.'.format(manifest['id'], database['name']))
+
+        check_database(path)
+
+    @traced('backup.restore')
+    def restore(self, manifest, target):
+        """
+            Restore the backup of manifest to the database file target, and
+            the shards of the backup next to it, named after target. The 
+            databases are reassembled and checked next to target first,
+            and then copied into it with the online backup API when target
+            exists, such that target is never left half written.
+        """
+        target = Path(target)
+        databases = manifest_databases(manifest)
+        stem = Path(databases[0]['name']).stem
+        targets = [target] + [target.with_name(target.stem + database['name'][len(stem):]) 
+                              for database in databases[1:]]
+        restored = [path.with_name(path.name + '.restore') for path in targets]
+
+        try:
+            for database, path in zip(databases, restored):
+                self.reassemble(manifest, database, path)
+
+            for path, target in zip(restored, targets):
+                if target.exists():
+                    copy_database(path, target)
+                else:
+                    os.replace(str(path), str(target))
+        finally:
+            for path in restored:
+                if path.exists():
+                    path.unlink()
+
+    def prune(self, keep):
+        """
+            Delete all but the newest keep backups, and the chunks no
+            longer used by the remaining ones, holding the lock of the
+            backups. Returns the number of deleted backups and chunks.
+        """
+        with self.lock():
+            return self.prune_locked(keep)
+
+    def prune_locked(self, keep):
+        snapshots = self.snapshots()
+        removed = snapshots[:max(0, len(snapshots) - keep)]
+
+        if not removed:
+            return 0, 0
+
+        for manifest in removed:
+            (self.snapshots_path / (manifest['id'] + '.json')).unlink()
+
+        used = {digest for manifest in snapshots[len(removed):] for digest in manifest_chunks(manifest)}
+        count = 0
+
+        for path in self.chunks_path.glob('*/*'):
+            if path.name not in used:
+                path.unlink()
+                count += 1
+
+        return len(removed), count
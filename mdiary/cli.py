@@ -0,0 +1,380 @@
+import sys
+import time
+import argparse
+from pathlib import Path
+from mdiary import trace
+from mdiary.agent import AGENT_TIMEOUT
+from mdiary.transfer import READERS, WRITERS, guess_format
+
+class PatchedHelpFormatter(argparse.HelpFormatter):
+    def _split_lines(self, text, width):
+        """
+            Adds a blankline between arguments displayed by
+            the --help flag.
+        """
+        return [''] + super()._split_lines(text, width) + ['']
+
+def build_parser():
+    """
+        Returns the argument parser of the mdiary command.
+    """
+    key_help = 'sets the location of the diary safety key! Make sure you always use the same key and for the sake of security, please do not keep the key in the original directory.'
+
+    parser = argparse.ArgumentParser(description='A simple terminal diary, written in Python, with encryption possibilities.',
+                                     formatter_class=PatchedHelpFormatter)
+    parser.add_argument('--key', '-k', help=key_help, action='store', dest='key')
+    parser.add_argument('--reset', '-r', help='reset the configuration file. Such that a new diary instance can be created.',
+                        action='store_true', dest='reset')
+    parser.add_argument('--version', '-v', action='version', version='mdiary 0.0.2')
+    parser.add_argument('--profile', '-p', nargs='?', const='', default=None, dest='profile', metavar='FILE',
+                        help='time the slow parts of mdiary and write a trace to FILE, ~/.mdiary/trace-PID.jsonl by default. Setting MDIARY_TRACE does the same.')
+
+    # Allows the key to be passed after the subcommand as well
+    key_parser = argparse.ArgumentParser(add_help=False)
+    key_parser.add_argument('--key', '-k', help=key_help, action='store', dest='key', default=argparse.SUPPRESS)
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser('import', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                          help='import entries from a JSONL or Markdown file.')
+    import_parser.add_argument('file', help='the file to import, - reads from stdin.')
+    import_parser.add_argument('--format', '-f', choices=sorted(READERS), dest='format',
+                               help='the format of the file, guessed from its extension by default.')
+
+    export_parser = subparsers.add_parser('export', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                          help='export all entries to a JSONL or Markdown file.')
+    export_parser.add_argument('file', help='the file to export to, - writes to stdout.')
+    export_parser.add_argument('--format', '-f', choices=sorted(WRITERS), dest='format',
+                               help='the format of the file, guessed from its extension by default.')
+
+    add_parser = subparsers.add_parser('add', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                       help='add a new entry without opening the diary interface.')
+    add_parser.add_argument('text', help='the text of the entry, - reads it from stdin.')
+
+    subparsers.add_parser('count', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                          help='print the number of entries in the diary.')
+
+    show_parser = subparsers.add_parser('show', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                        help='print the entry with the given id.')
+    show_parser.add_argument('id', type=int, help='the id of the entry.')
+
+    compact_parser = subparsers.add_parser('compact', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                           help='compress the entries written by older versions and shrink the database files.')
+    compact_parser.add_argument('--year', '-y', type=int, default=None, dest='year',
+                                help='only shrink the database file of this year of a sharded diary.')
+
+    subparsers.add_parser('shard', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                          help='move the entries into a database file per year, close mdiary first.')
+
+    rekey_parser = subparsers.add_parser('rekey', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                         help='encrypt the diary with a new key, run it again with the same new key to resume it when interrupted.')
+    rekey_parser.add_argument('new_key', help='the file of the new key, which is generated when it does not exist.')
+
+    backup_parser = subparsers.add_parser('backup', formatter_class=PatchedHelpFormatter,
+                                          help='back up the diary incrementally while it may be in use, or list, verify, restore or prune its backups.')
+    backup_parser.add_argument('action', nargs='?', default='create', choices=['create', 'list', 'verify', 'restore', 'prune'],
+                               help='what to do, create a backup by default.')
+    backup_parser.add_argument('point', nargs='?', default=None,
+                               help='the backup to verify or restore: its id, a time YYYY-MM-DD[ HH:MM[:SS]] for the last backup taken before it or latest (the default). verify checks all backups by default.')
+    backup_parser.add_argument('--dir', '-d', default=None, dest='dir',
+                               help='the directory of the backups, ~/.mdiary/backups/DB by default.')
+    backup_parser.add_argument('--keep', type=int, default=None, dest='keep',
+                               help='delete all but the newest KEEP backups after creating one, or when pruning.')
+    backup_parser.add_argument('--output', '-o', default=None, dest='output',
+                               help='restore the backup to this database file instead of the diary.')
+
+    agent_parser = subparsers.add_parser('agent', parents=[key_parser], formatter_class=PatchedHelpFormatter,
+                                         help='start or stop a key agent, which holds the unlocked key such that --key can be left out.')
+    agent_parser.add_argument('action', choices=['start', 'stop', 'status'], help='what to do with the agent.')
+    agent_parser.add_argument('--timeout', '-t', type=float, default=AGENT_TIMEOUT / 60, dest='timeout',
+                              help='the number of idle minutes after which the agent stops.')
+
+    return parser
+
+def open_file(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+
+    return open(path, mode, encoding='utf-8')
+
+def report(action, count, start):
+    """
+        Print the throughput of an import or export to stderr.
+    """
+    duration = time.perf_counter() - start
+    rate = count / duration if duration else float('inf')
+    print('{} {} entries in {:.2f}s ({:.0f} entries/s)'.format(action, count, duration, rate), file=sys.stderr)
+
+def open_diary(args, lite=False):
+    """
+        Returns an opened DiaryCore for the headless commands, which 
+        do not need urwid or the views of the diary. See DiaryCore.gen_db
+        for lite.
+    """
+    from mdiary.core import DiaryCore
+
+    diary = DiaryCore()
+
+    if not diary.config_file.is_file():
+        print('No diary has been set up yet, run mdiary without a command first.', file=sys.stderr)
+        sys.exit(1)
+
+    diary.open_diary(args.key, lite=lite)
+
+    return diary
+
+def import_command(args):
+    diary = open_diary(args)
+    reader = READERS[args.format or guess_format(args.file)]
+    start = time.perf_counter()
+
+    with open_file(args.file, 'r') as f:
+        count = diary.import_entries(reader(f))
+
+    diary.close_diary()
+
+    report('Imported', count, start)
+
+def export_command(args):
+    diary = open_diary(args)
+    writer = WRITERS[args.format or guess_format(args.file)]
+    start = time.perf_counter()
+
+    f = open_file(args.file, 'w')
+
+    try:
+        count = writer(f, diary.export_entries())
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    diary.close_diary()
+
+    report('Exported', count, start)
+
+def add_command(args):
+    txt = sys.stdin.read() if args.text == '-' else args.text
+
+    if not txt.strip():
+        print('Not adding an empty entry.', file=sys.stderr)
+        sys.exit(1)
+
+    diary = open_diary(args, lite=True)
+    diary.add_entry(txt.rstrip('\n'))
+    diary.close_diary()
+
+def count_command(args):
+    diary = open_diary(args, lite=True)
+    print(diary.db_handler.get_entry_count())
+    diary.close_diary()
+
+def show_command(args):
+    diary = open_diary(args, lite=True)
+    entry, txt = diary.get_entry_text(args.id)
+    diary.close_diary()
+
+    if entry is None:
+        print('There is no entry with id {}.'.format(args.id), file=sys.stderr)
+        sys.exit(1)
+
+    print('{} (entry {})\n\n{}'.format(entry.timestamp.isoformat(' ', 'seconds'), entry.entry_id, txt))
+
+def compact_command(args):
+    diary = open_diary(args)
+
+    if args.year is not None and not diary.db_handler.get_meta('sharded'):
+        print('The diary is not sharded, run mdiary shard first.', file=sys.stderr)
+        sys.exit(1)
+
+    size = sum(path.stat().st_size for path in diary.database_files())
+    start = time.perf_counter()
+
+    count = diary.migrate_entries()
+
+    if args.year is None:
+        diary.db_handler.vacuum()
+    elif not diary.db_handler.vacuum(args.year):
+        print('There are no entries of {}.'.format(args.year), file=sys.stderr)
+
+    diary.close_diary()
+
+    report('Compacted', count, start)
+    print('Database size {:.1f} MiB -> {:.1f} MiB'.format(size / 2**20, 
+          sum(path.stat().st_size for path in diary.database_files()) / 2**20), file=sys.stderr)
+
+def shard_command(args):
+    diary = open_diary(args)
+
+    if diary.db_handler.get_meta('sharded'):
+        print('The diary is sharded already.', file=sys.stderr)
+        sys.exit(1)
+
+    start = time.perf_counter()
+
+    def progress(year):
+        print('\rMoved the entries of {}'.format(year), end='', file=sys.stderr, flush=True)
+
+    try:
+        count = diary.shard(progress)
+    finally:
+        diary.close_diary()
+
+    print('', file=sys.stderr)
+    print('Split the diary into {} database files in {:.2f}s.'.format(count, time.perf_counter() - start),
+          file=sys.stderr)
+
+    if count:
+        from mdiary.shards import SHARD_IDS
+
+        year = diary.db_handler.years[0]
+        print('The entries are numbered per year now, e.g. the first entry of {} is no. {}.'.format(
+              year, year * SHARD_IDS + 1), file=sys.stderr)
+
+def rekey_command(args):
+    from mdiary import agent
+    from mdiary.core import DiaryCore
+
+    diary = DiaryCore()
+
+    if not diary.config_file.is_file() or not diary.is_using_key():
+        print('The diary does not use a key.', file=sys.stderr)
+        sys.exit(1)
+
+    diary.open_diary(args.key, rekey=True)
+    new_key_file = Path(args.new_key).expanduser()
+
+    if not new_key_file.is_file():
+        from cryptography.fernet import Fernet
+
+        new_key_file.touch(mode=0o600)
+        new_key_file.write_bytes(Fernet.generate_key())
+    start = time.perf_counter()
+
+    def progress(count):
+        print('\rEncrypted {} entries'.format(count), end='', file=sys.stderr, flush=True)
+
+    try:
+        count = diary.rekey(new_key_file.read_bytes(), progress=progress)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        diary.close_diary()
+
+    print('', file=sys.stderr)
+    report('Encrypted', count, start)
+
+    # The agent holds the old key
+    agent.stop(agent.socket_path(diary.settings.db, diary.hash_path))
+
+    print('The diary is now encrypted with {}, keep it safe. The old key can be deleted.'.format(new_key_file),
+          file=sys.stderr)
+
+def backup_command(args):
+    from mdiary import agent
+    from mdiary.backup import BackupError
+    from mdiary.core import DiaryCore
+
+    diary = DiaryCore()
+
+    if not diary.config_file.is_file():
+        print('No diary has been set up yet, run mdiary without a command first.', file=sys.stderr)
+        sys.exit(1)
+
+    store = diary.backup_store(args.dir)
+    start = time.perf_counter()
+
+    try:
+        if args.action == 'create':
+            manifest = diary.backup(store, args.keep)
+            print('Backed up {:.1f} MiB in {:.2f}s as {}, storing {} new chunks ({:.1f} MiB).'.format(
+                  manifest['size'] / 2**20, time.perf_counter() - start, manifest['id'], 
+                  manifest['new_chunks'], manifest['new_bytes'] / 2**20), file=sys.stderr)
+        elif args.action == 'list':
+            for manifest in store.snapshots():
+                print('{}  {}  {:.1f} MiB'.format(manifest['id'], manifest['created'][:19], manifest['size'] / 2**20))
+        elif args.action == 'verify':
+            manifests = [store.find(args.point)] if args.point else store.snapshots()
+            count = store.verify(manifests)
+            print('Verified {} backups ({} chunks).'.format(len(manifests), count), file=sys.stderr)
+        elif args.action == 'restore':
+            manifest = store.find(args.point)
+            diary.restore_backup(store, manifest, args.output)
+            print('Restored the backup {} to {}.'.format(manifest['id'], args.output or diary.settings.db), 
+                  file=sys.stderr)
+
+            if not args.output:
+                # The agent may hold a key of another version of the diary
+                agent.stop(agent.socket_path(diary.settings.db, diary.hash_path))
+        elif args.keep is None:
+            print('Pass the number of backups to keep with --keep.', file=sys.stderr)
+            sys.exit(1)
+        else:
+            backups, chunks = store.prune(args.keep)
+            print('Deleted {} backups and {} chunks.'.format(backups, chunks), file=sys.stderr)
+    except BackupError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+
+def agent_command(args):
+    from mdiary import agent
+    from mdiary.core import DiaryCore
+
+    diary = DiaryCore()
+
+    if not diary.config_file.is_file() or not diary.is_using_key():
+        print('The diary does not use a key.', file=sys.stderr)
+        sys.exit(1)
+
+    sock_path = agent.socket_path(diary.settings.db, diary.hash_path)
+
+    if args.action == 'stop':
+        if not agent.stop(sock_path):
+            print('No key agent is running.', file=sys.stderr)
+    elif args.action == 'status':
+        print('running' if agent.get_key(sock_path) else 'stopped')
+    elif agent.get_key(sock_path):
+        print('A key agent is running already.', file=sys.stderr)
+    elif not getattr(args, 'key', None):
+        print('Pass the key of the diary with the [--key, -k KEY] argument!', file=sys.stderr)
+        sys.exit(1)
+    else:
+        # Verifies the key once, the agent is trusted afterwards
+        diary.key_file = Path(args.key).expanduser()
+        diary.set_key()
+
+        if not diary.verify_key_hash():
+            print('Use the appropiate key!', file=sys.stderr)
+            sys.exit(1)
+
+        agent.start(sock_path, diary.key, args.timeout * 60)
+
+COMMANDS = {
+    'import': import_command,
+    'export': export_command,
+    'add': add_command,
+    'count': count_command,
+    'show': show_command,
+    'compact': compact_command,
+    'shard': shard_command,
+    'rekey': rekey_command,
+    'backup': backup_command,
+    'agent': agent_command
+}
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Before the traced modules are imported
+    if args.profile is not None:
+        trace.enable(args.profile or None)
+
+    if args.command:
+        with trace.span('command.{}'.format(args.command)):
+            COMMANDS[args.command](args)
+    else:
+        with trace.span('import.gui'):
+            from mdiary.gui import Diary
+
+        diary = Diary()
+        diary.main(args)
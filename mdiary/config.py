@@ -0,0 +1,95 @@
+from collections import namedtuple
+from configparser import ConfigParser
+from pathlib import Path
+from mdiary.trace import traced
+
+Settings = namedtuple('Settings', ['db', 'using_key', 'cache_size', 'profile', 'compression'])
+
+CACHE_SIZE = 16 # MiB of decrypted entries kept in memory
+PROFILE = 'durable'
+COMPRESSION = 'auto'
+
+class ConfigHandler():
+    """
+        Class owning the mdiary.conf configuration file. The file
+        is parsed once into a Settings tuple, which is only reloaded
+        after the handler writes the file or its mtime changes.
+    """
+    def __init__(self, path=None):
+        self.config_path = path or Path.home() / '.config' / 'mdiary'
+        self.config_file = self.config_path / 'mdiary.conf'
+        self._settings = None
+        self._mtime = None
+
+    def exists(self):
+        return self.config_file.is_file()
+
+    def invalidate(self):
+        """
+            Drop the cached settings, such that they are read again.
+        """
+        self._settings = None
+        self._mtime = None
+
+    @property
+    def settings(self):
+        """
+            Returns the cached Settings, reloading them when the
+            configuration file changed on disk.
+        """
+        mtime = self.config_file.stat().st_mtime_ns
+
+        if self._settings is None or mtime != self._mtime:
+            self._settings = self.load()
+            self._mtime = mtime
+
+        return self._settings
+
+    @traced('config.load')
+    def load(self):
+        """
+            Parse the configuration file into a Settings tuple.
+        """
+        config = ConfigParser()
+        config.read(self.config_file)
+
+        return Settings(
+            db=config.get('settings', 'db'),
+            using_key=config.getboolean('settings', 'using_key'),
+            cache_size=config.getint('settings', 'cache_size', fallback=CACHE_SIZE),
+            profile=config.get('settings', 'profile', fallback=PROFILE),
+            compression=config.get('settings', 'compression', fallback=COMPRESSION)
+        )
+
+    def write(self, db_name, using_key):
+        """
+            Write a new configuration file, see Diary.gen_config.
+        """
+        config = ConfigParser()
+        config['settings'] = {
+            'db': db_name + '.db',
+            'using_key': using_key
+        }
+
+        with self.config_file.open(mode='w') as f:
+            config.write(f)
+
+        self.invalidate()
+
+    def reset(self):
+        """
+            Moves the configuration file out of the way, keeping
+            the old ones as mdiary.conf.old, mdiary.conf.old.old, etc.
+        """
+        suffix = '.old'
+        file_old = self.config_path / ('mdiary.conf' + suffix)
+
+        while True:
+            if not file_old.is_file():
+                break
+
+            suffix += '.old'
+            file_old = self.config_path / ('mdiary.conf' + suffix)
+
+        self.config_file.rename(file_old)
+        self.invalidate()
@@ -0,0 +1,795 @@
+import os
+import sys
+import json
+import threading
+from functools import partial
+from itertools import tee
+from pathlib import Path
+from mdiary.config import ConfigHandler
+from mdiary.search import make_snippet, parse_query, parse_tags, plain_tag_keys, query_words
+from mdiary.stats import streaks, text_stats
+from mdiary.trace import span, traced
+
+REKEY_BATCH = 500
+STATS_BATCH = 500
+GREP_BATCH = 200
+
+# The files next to the database which are backed up with it
+BACKUP_FILES = ('.keyhash', '.rekey')
+
+def replace_file(path, txt):
+    """
+        Write txt to the file at path atomically, such that it holds
+        either the old or the new text after a crash.
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+
+    with tmp_path.open('w') as f:
+        f.write(txt)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(str(tmp_path), str(path))
+
+class DiaryCore:
+    """
+        Class handling the configuration, keys and entries of the
+        diary, without any user interface. Modules are only imported
+        once they are needed, such that the headless commands start fast.
+    """
+
+    def __init__(self):
+        self.hash_path = Path.home() / '.mdiary'
+        self.config_path = Path.home() / '.config' / 'mdiary'
+        self.config_file = self.config_path / 'mdiary.conf'
+        self.config = ConfigHandler(self.config_path)
+        self.db_handler = None
+        self.key_file = None
+        self.key = None
+        self.cipher = None
+        self.migration = None
+        self.stop_migration = threading.Event()
+
+    @traced('core.open_diary')
+    def open_diary(self, key=None, lite=False, rekey=False):
+        """
+            Open the configured diary, unlocking it with the key file at
+            the path key when the diary uses a key, or with the key held
+            by a running key agent. Exits if the key is missing or does 
+            not belong to the diary, or if rekey was interrupted (unless
+            rekey is set). See gen_db for lite.
+        """
+        if self.is_using_key():
+            agent_key = self.agent_key()
+
+            if key:
+                self.key_file = Path(key).expanduser()
+                self.set_key()
+
+                # The agent only holds keys which were verified already
+                if self.key != agent_key and not self.verify_key_hash():
+                    print('Use the appropiate key!')
+                    sys.exit()
+            elif agent_key:
+                self.set_key(agent_key)
+            else:
+                print('Use your key to get access to the diary by using the [--key, -k KEY] argument!')
+                sys.exit()
+
+            if not rekey and self.rekey_state() is not None:
+                print('Changing the key of the diary was interrupted, finish it by running mdiary rekey again.')
+                sys.exit()
+
+        self.gen_db(lite=lite)
+
+    def agent_key(self):
+        """
+            Returns the key held by the key agent of the diary, None if
+            no agent is running, see mdiary.agent.
+        """
+        from mdiary import agent
+
+        return agent.get_key(agent.socket_path(self.settings.db, self.hash_path))
+
+    def gen_config(self, db_name, using_key):
+        """
+            Generate an ini like configuration file with
+            parameters 'db' for the database name and location, 
+            and 'using_key' which stores True/False depending
+            on whether one want to use a secret key to encrypt 
+            the diary entries (functionality nog yet implemented!).
+        """
+        self.config.write(db_name, using_key)
+        self.gen_db()
+
+    @property
+    def settings(self):
+        """
+            The cached Settings of the diary, see ConfigHandler.
+        """
+        return self.config.settings
+
+    def get_config(self):
+        """
+            Returns the retrieved configuration file's contents.
+        """
+        return self.settings._asdict()
+
+    def reset_config(self):
+        """
+            Resets the configuration file such that one can initiate
+            a new database, key, etc.
+        """
+        self.config.reset()
+        
+    @traced('core.gen_db')
+    def gen_db(self, lite=False):
+        """
+            Open (and create) the database of the diary. With lite set,
+            an existing database is opened by a LiteDBHandler, which only
+            supports the headless commands but avoids importing SQLAlchemy,
+            unless it is sharded. A sharded database is opened by a
+            ShardedDBHandler, see mdiary.shards.
+        """
+        db_name = self.settings.db
+
+        if not db_name:
+            return
+
+        if lite:
+            from mdiary.lite import LiteDBHandler
+
+            db_handler = LiteDBHandler(name=db_name, profile=self.settings.profile,
+                                       compression=self.settings.compression)
+
+            if db_handler.exists() and not db_handler.is_sharded():
+                self.db_handler = db_handler
+                return
+
+            db_handler.close()
+
+        with span('import.database'):
+            from mdiary.database import DBHandler
+
+        self.db_handler = DBHandler(name=db_name, profile=self.settings.profile,
+                                    compression=self.settings.compression)
+        self.db_handler.create(fulltext=not self.settings.using_key)
+        self.db_handler.new_session()
+
+        if self.db_handler.get_meta('sharded'):
+            from mdiary.shards import ShardedDBHandler
+
+            self.db_handler = ShardedDBHandler(self.db_handler, fulltext=not self.settings.using_key)
+
+    def prepare_entry(self, txt):
+        """
+            Returns the text to store, the search tokens, the stats and 
+            the tag keys of an entry, which are encrypted and indexed if 
+            the diary uses a key.
+        """
+        if self.is_using_key():
+            return self.encrypt_entry(txt), self.entry_tokens(txt), text_stats(txt), self.entry_tags(txt)
+
+        return txt, None, text_stats(txt), self.entry_tags(txt)
+
+    def add_entry(self, txt):
+        """
+            Queue a new entry to be stored by the background writer, 
+            see prepare_entry.
+        """
+        self.db_handler.queue_entry(*self.prepare_entry(txt))
+
+    def update_entry(self, id, txt):
+        """
+            Queue an update of the text of an entry, see add_entry. The
+            text it replaces is kept as a revision, see prepare_revision.
+        """
+        # The revision is a delta against the stored text, which the
+        # writer passes to prepare_revision when it stores the update
+        self.db_handler.queue_update(id, *self.prepare_entry(txt), revision=partial(self.prepare_revision, txt))
+
+    @traced('core.prepare_revision')
+    def prepare_revision(self, txt, old_text, depth):
+        """
+            Returns the (snapshot, text) revision of the stored old_text
+            replaced by txt, a delta turning txt into old_text or the whole
+            old_text when a snapshot is due (or smaller), encrypted if the
+            diary uses a key. Returns None if the text did not change. 
+            depth is the number of revisions after the newest snapshot,
+            see mdiary.revisions.
+        """
+        from mdiary.revisions import SNAPSHOT_INTERVAL, make_delta
+
+        # Called from the writer thread, see DBHandler.write
+        if self.is_using_key():
+            old_text = self.cipher.decrypt(old_text)
+
+        if old_text == txt:
+            return None
+
+        delta = make_delta(txt, old_text)
+        snapshot = depth + 1 >= SNAPSHOT_INTERVAL or len(delta) >= len(old_text)
+        revision = old_text if snapshot else delta
+
+        if self.is_using_key():
+            revision = self.encrypt_entry(revision)
+
+        return snapshot, revision
+
+    @traced('core.revision_text')
+    def revision_text(self, id, revision):
+        """
+            Returns the text of a revision of an entry.
+        """
+        from mdiary.revisions import reconstruct
+
+        # The chain starts at the stored text, not at a queued update
+        entry = self.db_handler.get_entry(id, queued=False)
+        chain = self.db_handler.get_revision_chain(id, revision)
+
+        if entry is None or not chain:
+            raise ValueError('Entry {} has no revision {}.'.format(id, revision))
+
+        txt = entry.entry_text
+
+        if self.is_using_key():
+            txt = self.decrypt_entry(txt, id)
+            chain = [(snapshot, self.decrypt_entry(text)) for snapshot, text in chain]
+
+        return reconstruct(txt, chain)
+
+    def restore_revision(self, id, revision):
+        """
+            Queue an update of an entry to the text of a revision, which
+            keeps the text it replaces as a revision as well.
+        """
+        self.update_entry(id, self.revision_text(id, revision))
+
+    def get_entry_text(self, id):
+        """
+            Returns the entry with the given id and its (decrypted) text,
+            or (None, None) if there is no such entry.
+        """
+        entry = self.db_handler.get_entry(id)
+
+        if entry is None:
+            return None, None
+
+        if self.is_using_key():
+            return entry, self.decrypt_entry(entry.entry_text, id)
+
+        return entry, entry.entry_text
+
+    def save_draft(self, name, txt):
+        """
+            Queue saving a draft, encrypted if the diary uses a key.
+        """
+        if self.is_using_key():
+            txt = self.encrypt_entry(txt)
+
+        self.db_handler.queue_draft(name, txt)
+
+    def load_draft(self, name):
+        """
+            Returns the text of a draft, None if there is no such draft.
+        """
+        txt = self.db_handler.get_draft(name)
+
+        if txt is not None and self.is_using_key():
+            txt = self.decrypt_entry(txt)
+
+        return txt
+
+    def discard_draft(self, name):
+        self.db_handler.queue_remove_draft(name)
+
+    @traced('core.import_entries')
+    def import_entries(self, rows):
+        """
+            Import an iterable of (timestamp, text) rows in batches,
+            encrypting (in parallel) and indexing them if the diary uses 
+            a key. Returns the number of imported entries.
+        """
+        if not self.is_using_key():
+            return self.db_handler.bulk_insert((timestamp, txt, None, text_stats(txt), self.entry_tags(txt)) 
+                                               for timestamp, txt in rows)
+
+        rows, texts = tee(rows)
+        tokens = self.cipher.encrypt_many(txt for _, txt in texts)
+        rows = ((timestamp, token, self.entry_tokens(txt), text_stats(txt), self.entry_tags(txt)) 
+                for (timestamp, txt), token in zip(rows, tokens))
+
+        return self.db_handler.bulk_insert(rows)
+
+    def export_entries(self):
+        """
+            Yields (id, timestamp, text) tuples of all entries ordered by time,
+            decrypting them in bulk if the diary uses a key.
+        """
+        rows = self.db_handler.iter_entries()
+
+        if not self.is_using_key():
+            yield from rows
+            return
+
+        rows, tokens = tee(rows)
+        texts = self.cipher.decrypt_many((row.entry_id, row.entry_text) for row in tokens)
+
+        for row, (_, txt) in zip(rows, texts):
+            yield row.entry_id, row.timestamp, txt
+
+    def entry_tokens(self, txt):
+        """
+            Returns the blind search tokens of the words in an entry.
+        """
+        return self.cipher.blind_tokens(set(query_words(txt)))
+
+    def entry_tags(self, txt):
+        """
+            Returns the keys of the #tags in an entry, which are blind
+            tokens if the diary uses a key.
+        """
+        if self.is_using_key():
+            return self.cipher.blind_tags(parse_tags(txt))
+
+        return plain_tag_keys(txt)
+
+    def tag_key(self, tag):
+        """
+            Returns the key of a tag (with or without the #) to filter 
+            the entries by, see DBHandler.get_page. 
+        """
+        return next(iter(self.entry_tags('#' + tag.lstrip('#'))), None)
+
+    @traced('core.index_entries')
+    def index_entries(self, db_handler=None):
+        """
+            Add the entries of an encrypted diary which are not yet in
+            the search index (e.g. written by an older version), like 
+            backfill_stats. Until it is done, search_entries decrypts
+            the entries instead.
+        """
+        from mdiary.crypto import chunked
+
+        db_handler = db_handler or self.db_handler
+        rows = self.decrypt_entries(db_handler.get_unindexed_texts(STATS_BATCH))
+
+        for chunk in chunked(rows, STATS_BATCH):
+            if self.stop_migration.is_set():
+                return
+
+            db_handler.add_tokens((entry_id, self.entry_tokens(txt)) for entry_id, txt in chunk)
+
+        db_handler.set_indexed()
+
+    @traced('core.search_entries')
+    def search_entries(self, query):
+        """
+            Search the diary, returns (id, timestamp, snippet) tuples. 
+            Diaries without a key use the full-text index, encrypted diaries
+            look up the blind tokens of the words and only decrypt the matches,
+            or grep the entries while the index is incomplete (see 
+            index_entries). See parse_query for the supported date filters.
+        """
+        query, start, end = parse_query(query)
+
+        if not self.is_using_key():
+            return self.db_handler.search(query, start, end)
+
+        words = query_words(query)
+
+        if self.db_handler.is_indexed():
+            rows = self.db_handler.search_tokens(self.entry_tokens(query), start, end)
+            texts = self.decrypt_entries((row.entry_id, row.entry_text) for row in rows)
+            matches = ((row, entry_text) for row, (_, entry_text) in zip(rows, texts))
+        else:
+            matches = self.grep_entries(words, start, end)
+
+        return [(row.entry_id, row.timestamp, make_snippet(entry_text, words)) 
+                for row, entry_text in matches]
+
+    @traced('core.grep_entries')
+    def grep_entries(self, words, start=None, end=None):
+        """
+            Returns the (EntryRow, text) tuples of the encrypted entries 
+            written between start and end which contain all words, newest
+            first, decrypting the entries page by page.
+        """
+        from mdiary.database import SEARCH_LIMIT
+
+        words = set(words)
+        matches = []
+        before = None
+
+        while words and len(matches) < SEARCH_LIMIT:
+            rows = self.db_handler.get_page(before=before, limit=GREP_BATCH, start=start, end=end, last=True)
+
+            if not rows:
+                break
+
+            rows.reverse()
+            texts = self.decrypt_entries((row.entry_id, row.entry_text) for row in rows)
+            matches += [(row, entry_text) for row, (_, entry_text) in zip(rows, texts) 
+                        if words <= set(query_words(entry_text))]
+            before = self.db_handler.entry_key(rows[-1])
+
+        return matches[:SEARCH_LIMIT]
+
+    def migrate_entries(self, db_handler=None):
+        """
+            Rewrite the entries stored by older versions in the current
+            (compressed) payload format, returns the number of rewritten 
+            entries. See DBHandler.migrate_payloads.
+        """
+        db_handler = db_handler or self.db_handler
+
+        if self.is_using_key():
+            convert = lambda token: self.cipher.encrypt(self.cipher.decrypt(token))
+        else:
+            convert = db_handler.pack
+
+        return db_handler.migrate_payloads(convert, self.stop_migration)
+
+    @traced('core.backfill_stats')
+    def backfill_stats(self, db_handler=None):
+        """
+            Store the stats of the entries written by older versions,
+            decrypting them in batches if the diary uses a key. Stops
+            early when the migration is stopped. 
+        """
+        from mdiary.crypto import chunked
+
+        db_handler = db_handler or self.db_handler
+        rows = db_handler.get_texts_without_stats(STATS_BATCH)
+
+        if self.is_using_key():
+            rows = self.decrypt_entries(rows)
+
+        for chunk in chunked(rows, STATS_BATCH):
+            if self.stop_migration.is_set():
+                break
+
+            db_handler.add_stats((entry_id, text_stats(txt)) for entry_id, txt in chunk)
+
+    @traced('core.backfill_tags')
+    def backfill_tags(self, db_handler=None):
+        """
+            Store the tags of the entries written by older versions, 
+            like backfill_stats.
+        """
+        from mdiary.crypto import chunked
+
+        db_handler = db_handler or self.db_handler
+        rows = db_handler.get_untagged_texts(STATS_BATCH)
+
+        if self.is_using_key():
+            rows = self.decrypt_entries(rows)
+
+        for chunk in chunked(rows, STATS_BATCH):
+            if self.stop_migration.is_set():
+                break
+
+            db_handler.add_tags([(entry_id, self.entry_tags(txt)) for entry_id, txt in chunk])
+
+    def migrate(self):
+        """
+            Migrate the databases of the diary which are not marked as
+            migrated yet one by one, marking each once it is complete,
+            see DBHandler.unmigrated.
+        """
+        for db_handler in self.db_handler.unmigrated():
+            if self.is_using_key():
+                self.index_entries(db_handler)
+
+            self.migrate_entries(db_handler)
+            self.backfill_stats(db_handler)
+            self.backfill_tags(db_handler)
+
+            if self.stop_migration.is_set():
+                break
+
+            self.db_handler.set_migrated(db_handler)
+
+        self.db_handler.end_session()
+
+    def start_migration(self):
+        """
+            Run index_entries (if the diary uses a key), migrate_entries,
+            backfill_stats and backfill_tags in a background thread, which
+            is stopped when the diary is closed. See migrate.
+        """
+        if self.migration is None and self.db_handler:
+            self.migration = threading.Thread(target=self.migrate, name='mdiary-migration', daemon=True)
+            self.migration.start()
+
+    @traced('core.summary')
+    def summary(self):
+        """
+            Returns a dict with the totals of the diary, the current and
+            longest streak of successive days with entries and the 
+            (month, entries, words, chars) tuples per month, see 
+            DBHandler.get_summary.
+        """
+        entries, words, chars, days, first, last = self.db_handler.get_summary()
+        current, longest = streaks(day for day, _, _, _ in self.db_handler.stats_by_period('day'))
+
+        return {
+            'entries': entries,
+            'words': words,
+            'chars': chars,
+            'days': days,
+            'first': first,
+            'last': last,
+            'current_streak': current,
+            'longest_streak': longest,
+            'months': self.db_handler.stats_by_period('month')
+        }
+
+    def shard(self, progress=None):
+        """
+            Move the entries of the diary into a database per year, see
+            mdiary.shards, which renumbers them by year. Returns the number
+            of shards, 0 if the diary is sharded already.
+        """
+        from mdiary.shards import ShardedDBHandler
+
+        if isinstance(self.db_handler, ShardedDBHandler):
+            return 0
+
+        self.db_handler = ShardedDBHandler(self.db_handler, fulltext=not self.settings.using_key)
+
+        return self.db_handler.split(progress)
+
+    def database_files(self):
+        """
+            Returns the paths of the database files of the diary, the
+            main database and its shards ordered by year.
+        """
+        from mdiary.shards import shard_paths
+
+        path = self.hash_path / self.settings.db
+
+        return [path] + list(shard_paths(path).values())
+
+    def backup_store(self, path=None):
+        """
+            Returns the BackupStore of the diary in the directory path,
+            ~/.mdiary/backups/DB by default.
+        """
+        from mdiary.backup import BackupStore
+
+        path = Path(path).expanduser() if path else self.hash_path / 'backups' / self.settings.db
+
+        return BackupStore(path, self.settings.compression)
+
+    def backup(self, store, keep=None):
+        """
+            Back up the diary to the BackupStore store while it may be in
+            use, together with its key hash and rekey checkpoint. Only the 
+            newest keep backups are kept if given. Returns the manifest.
+        """
+        files = {}
+
+        for suffix in BACKUP_FILES:
+            path = self.hash_path / (self.settings.db + suffix)
+
+            if path.is_file():
+                files[suffix] = path.read_text()
+
+        manifest = store.create(self.database_files(), files)
+
+        if keep:
+            store.prune(keep)
+
+        return manifest
+
+    def restore_backup(self, store, manifest, target=None):
+        """
+            Restore the backup of manifest to the diary, or to the database
+            file target. The key hash and rekey checkpoint of the diary are
+            restored as well, since the key may have changed since.
+        """
+        if target:
+            store.restore(manifest, Path(target).expanduser())
+            return
+
+        from mdiary.backup import manifest_databases
+        from mdiary.shards import remove_database
+
+        store.restore(manifest, self.hash_path / self.settings.db)
+
+        # Shards created after the backup
+        restored = {database['name'] for database in manifest_databases(manifest)}
+
+        for path in self.database_files()[1:]:
+            if path.name not in restored:
+                remove_database(path)
+
+        for suffix in BACKUP_FILES:
+            path = self.hash_path / (self.settings.db + suffix)
+
+            if suffix in manifest['files']:
+                replace_file(path, manifest['files'][suffix])
+            elif path.is_file():
+                path.unlink()
+
+    def gen_key(self, key_fn):
+        """
+            Generates a key at the <Path> key_fn.
+        """
+        self.key_file = key_fn
+
+        if self.key_file:
+            from cryptography.fernet import Fernet
+
+            self.key_file.touch()
+            key = Fernet.generate_key()
+            self.key_file.write_bytes(key)
+
+            self.set_key()
+        else:
+            raise AttributeError('self.key_file does not exist, SET IT IDIOT!')
+        
+    @traced('core.set_key')
+    def set_key(self, key=None):
+        """
+            Unlock the diary with key, read from the key file by default.
+        """
+        with span('import.crypto'):
+            from mdiary.crypto import EntryCipher
+            from mdiary.payload import resolve_codec
+
+        if key is None:
+            if not self.key_file.is_file():
+                raise AttributeError('The key_file attribute is not valid or does not exist!')
+
+            key = self.key_file.read_bytes()
+
+        self.key = key
+        self.cipher = EntryCipher(key, cache_budget=self.settings.cache_size * 1024 * 1024,
+                                  codec=resolve_codec(self.settings.compression))
+
+    def gen_key_hash(self):
+        from passlib.hash import pbkdf2_sha256
+
+        hashed_key = pbkdf2_sha256.hash(self.key)
+
+        hf = self.hash_path / (self.settings.db + '.keyhash')
+        hf.write_text(hashed_key)
+
+    @traced('core.verify_key_hash')
+    def verify_key_hash(self, key=None):
+        from passlib.hash import pbkdf2_sha256
+
+        if not key:
+            key = self.key
+        hf = self.hash_path / (self.settings.db + '.keyhash')
+        return pbkdf2_sha256.verify(key, hf.read_text())
+
+    def rekey_state(self):
+        """
+            Returns the checkpoint of an unfinished rekey, a dict holding
+            the 'key_hash' of the new key and the id of the last entry
+            encrypted with it ('after'), None if the key is not changing.
+        """
+        path = self.hash_path / (self.settings.db + '.rekey')
+
+        if not path.is_file():
+            return None
+
+        state = json.loads(path.read_text())
+
+        # Interrupted right after the new key hash was stored
+        if state['key_hash'] == (self.hash_path / (self.settings.db + '.keyhash')).read_text():
+            path.unlink()
+            return None
+
+        return state
+
+    @traced('core.rekey')
+    def rekey(self, new_key, batch=REKEY_BATCH, progress=None):
+        """
+            Encrypt all entries, revisions and drafts of the diary, opened with the
+            current key, with new_key and store the hash of new_key once
+            done. Entries are read in order of their id and rewritten in 
+            batches of a transaction each (encrypted in parallel), after
+            which a checkpoint is stored, such that an interrupted rekey
+            resumes where it stopped when it is run again with the same
+            new_key. Until then, entries of both keys are decrypted.
+            Calls progress(count) after every batch, returns the number of
+            re-encrypted entries.
+        """
+        from passlib.hash import pbkdf2_sha256
+        from mdiary.crypto import EntryCipher, chunked
+
+        if new_key == self.key:
+            raise ValueError('The new key is the current key of the diary.')
+
+        path = self.hash_path / (self.settings.db + '.rekey')
+        state = self.rekey_state()
+
+        if state is None:
+            state = {'key_hash': pbkdf2_sha256.hash(new_key), 'after': 0}
+            replace_file(path, json.dumps(state))
+        elif not pbkdf2_sha256.verify(new_key, state['key_hash']):
+            raise ValueError('An interrupted rekey to another key has to be finished first.')
+
+        cipher = EntryCipher(new_key, cache_budget=self.cipher.cache.budget, codec=self.cipher.codec,
+                             old_keys=[self.key])
+
+        drafts = self.db_handler.get_drafts()
+        self.db_handler.rewrite(drafts=[(name, cipher.encrypt(cipher.decrypt(txt))) for name, txt in drafts])
+
+        count = 0
+        rows = cipher.rekey_many(self.db_handler.get_texts(batch, state['after']))
+
+        for chunk in chunked(rows, batch):
+            revisions = self.db_handler.get_revision_texts(entry_id for entry_id, _, _, _ in chunk)
+            self.db_handler.rewrite(entries=chunk, revisions=[(revision_id, cipher.encrypt(cipher.decrypt(txt))) 
+                                                              for revision_id, txt in revisions])
+            state['after'] = chunk[-1][0]
+            replace_file(path, json.dumps(state))
+            count += len(chunk)
+
+            if progress:
+                progress(count)
+
+        replace_file(self.hash_path / (self.settings.db + '.keyhash'), state['key_hash'])
+        path.unlink()
+
+        # The tags of the old key
+        self.db_handler.remove_unused_tags()
+
+        self.cipher.wipe()
+        self.set_key(new_key)
+
+        return count
+
+    @traced('core.encrypt_entry')
+    def encrypt_entry(self, text):
+        return self.cipher.encrypt(text)
+    
+    @traced('core.decrypt_entry')
+    def decrypt_entry(self, enc_text, id=None):
+        """
+            Decrypts an entry, passing the id of the entry allows
+            the plaintext to be served from the cipher's cache.
+        """
+        from cryptography.fernet import InvalidToken
+
+        try:
+            dec = self.cipher.decrypt(enc_text, id)
+        except InvalidToken:
+            self.quit_program()
+
+        return dec
+
+    def decrypt_entries(self, rows):
+        """
+            Decrypts an iterable of (id, encrypted text) rows in bulk,
+            yielding (id, text) tuples in order, see EntryCipher.decrypt_many.
+        """
+        from cryptography.fernet import InvalidToken
+
+        try:
+            yield from self.cipher.decrypt_many(rows)
+        except InvalidToken:
+            self.quit_program()
+    
+    def is_using_key(self):
+        return self.settings.using_key
+    
+    def close_diary(self):
+        if self.migration is not None:
+            self.stop_migration.set()
+            self.migration.join()
+            self.migration = None
+
+        if self.db_handler:
+            self.db_handler.close()
+
+    def quit_program(self):
+        if self.cipher:
+            self.cipher.wipe()
+
+        sys.exit('Could not decrypt the diary with this key!')
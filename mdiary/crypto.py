@@ -0,0 +1,301 @@
+import os
+import sys
+import hmac
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from cryptography.fernet import Fernet, MultiFernet
+from mdiary.payload import seal, unseal
+from mdiary.search import parse_tags, query_words
+from mdiary.trace import count
+
+CACHE_BUDGET = 16 * 1024 * 1024
+PARALLEL_THRESHOLD = 512
+CHUNK_SIZE = 256
+TOKEN_SIZE = 16
+
+_worker_fernet = None
+_worker_codec = None
+_worker_index_key = None
+
+def worker_context():
+    """
+        Returns the multiprocessing context of the worker processes. They
+        are not forked from the diary, whose background threads may hold
+        locks (of the connection pool, the write queue or logging) which
+        would never be released in the children.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+
+    return multiprocessing.get_context('spawn')
+
+def _init_worker(keys, codec):
+    global _worker_fernet, _worker_codec, _worker_index_key
+    _worker_fernet = make_fernet(keys)
+    _worker_codec = codec
+    _worker_index_key = derive_index_key(keys[0])
+
+def _decrypt_chunk(tokens):
+    return [unseal(_worker_fernet, token) for token in tokens]
+
+def _encrypt_chunk(texts):
+    return [seal(_worker_fernet, text, _worker_codec) for text in texts]
+
+def _rekey_chunk(tokens):
+    return [rekey_payload(_worker_fernet, _worker_index_key, token, _worker_codec) for token in tokens]
+
+def make_fernet(keys):
+    """
+        Returns a Fernet for the first of keys, which also decrypts
+        the payloads of the other (older) keys.
+    """
+    if len(keys) == 1:
+        return Fernet(keys[0])
+
+    return MultiFernet([Fernet(key) for key in keys])
+
+def derive_index_key(key):
+    """
+        Returns the key of the blind search tokens, derived from key.
+    """
+    return hmac.new(key, b'mdiary search index', hashlib.sha256).digest()
+
+def blind_tokens(index_key, words):
+    return {hmac.new(index_key, word.encode(), hashlib.sha256).digest()[:TOKEN_SIZE]
+            for word in words}
+
+def blind_tags(index_key, tags):
+    """
+        Returns the keys of tags, which cannot be confused with the
+        blind tokens of words.
+    """
+    return blind_tokens(index_key, {'#' + tag for tag in tags})
+
+def rekey_payload(fernet, index_key, token, codec):
+    """
+        Returns the payload of token encrypted again with the first key
+        of fernet, and the blind search tokens and tags of its text.
+    """
+    text = unseal(fernet, token)
+
+    return (seal(fernet, text, codec), blind_tokens(index_key, set(query_words(text))),
+            blind_tags(index_key, parse_tags(text)))
+
+def available_cpus():
+    """
+        Returns the number of cores this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def chunked(iterable, size):
+    """
+        Yields lists of at most size items from an iterable.
+    """
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+class PlaintextCache():
+    """
+        Least recently used cache of decrypted entries, keyed by the
+        entry id and a digest of its ciphertext, such that an updated
+        entry never hits a stale plaintext. The cache is bounded by an
+        (approximate) memory budget in bytes. It may be shared by threads.
+    """
+    def __init__(self, budget=CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(entry_id, token):
+        return (entry_id, hashlib.blake2b(token, digest_size=16).digest())
+
+    def get(self, entry_id, token):
+        key = self.cache_key(entry_id, token)
+
+        with self.lock:
+            text = self.items.get(key)
+
+            if text is not None:
+                self.items.move_to_end(key)
+
+        return text
+
+    def put(self, entry_id, token, text):
+        size = sys.getsizeof(text)
+
+        if size > self.budget:
+            return
+
+        key = self.cache_key(entry_id, token)
+
+        with self.lock:
+            if key in self.items:
+                self.size -= sys.getsizeof(self.items.pop(key))
+
+            self.items[key] = text
+            self.size += size
+
+            while self.size > self.budget:
+                _, old_text = self.items.popitem(last=False)
+                self.size -= sys.getsizeof(old_text)
+
+    def wipe(self):
+        """
+            Drop all cached plaintexts.
+        """
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+class EntryCipher():
+    """
+        Wraps a single Fernet instance for a key, together with
+        a PlaintextCache for the entries it decrypted. Texts are 
+        compressed with codec before they are encrypted, see 
+        mdiary.payload. Payloads of the old_keys are decrypted as
+        well, while a diary moves to a new key, see rekey_many.
+    """
+    def __init__(self, key, cache_budget=CACHE_BUDGET, codec='zlib', old_keys=()):
+        self.key = key
+        self.keys = [key] + list(old_keys)
+        self.codec = codec
+        self.fernet = make_fernet(self.keys)
+        self.cache = PlaintextCache(cache_budget)
+        self.index_key = derive_index_key(key)
+
+    def encrypt(self, text):
+        return seal(self.fernet, text, self.codec)
+
+    def decrypt(self, token, entry_id=None):
+        """
+            Decrypt a payload, raises InvalidToken if it was not
+            encrypted with the key. Only payloads of which the entry_id
+            is known are cached.
+        """
+        if isinstance(token, str):
+            token = token.encode()
+
+        if entry_id is None:
+            return unseal(self.fernet, token)
+
+        text = self.cache.get(entry_id, token)
+        count('cipher.cache_hit' if text is not None else 'cipher.cache_miss')
+
+        if text is None:
+            text = unseal(self.fernet, token)
+            self.cache.put(entry_id, token, text)
+
+        return text
+
+    def blind_tokens(self, words):
+        """
+            Returns the set of keyed hashes of the given words, which 
+            are stored in the search index instead of the words themselves.
+        """
+        return blind_tokens(self.index_key, words)
+
+    def blind_tags(self, tags):
+        return blind_tags(self.index_key, tags)
+
+    def decrypt_many(self, rows, workers=None):
+        """
+            Decrypt an iterable of (entry_id, token) rows, yielding 
+            (entry_id, text) tuples in the same order. Small inputs are
+            decrypted serially (through the cache), larger ones are fanned 
+            out in chunks over a pool of worker processes, see map_parallel.
+        """
+        rows = iter(rows)
+        head = list(islice(rows, PARALLEL_THRESHOLD))
+        rows = chain(head, rows)
+        workers = workers or available_cpus()
+
+        if len(head) < PARALLEL_THRESHOLD or workers < 2:
+            for entry_id, token in rows:
+                yield entry_id, self.decrypt(token, entry_id)
+            return
+
+        for chunk, texts in self.map_parallel(_decrypt_chunk, rows, workers):
+            yield from zip((entry_id for entry_id, _ in chunk), texts)
+
+    def encrypt_many(self, texts, workers=None):
+        """
+            Encrypt an iterable of texts, yielding the tokens in the same
+            order. Like decrypt_many, large inputs are encrypted in parallel.
+        """
+        texts = iter(texts)
+        head = list(islice(texts, PARALLEL_THRESHOLD))
+        texts = chain(head, texts)
+        workers = workers or available_cpus()
+
+        if len(head) < PARALLEL_THRESHOLD or workers < 2:
+            for text in texts:
+                yield self.encrypt(text)
+            return
+
+        for _, tokens in self.map_parallel(_encrypt_chunk, ((None, text) for text in texts), workers):
+            yield from tokens
+
+    def rekey_many(self, rows, workers=None):
+        """
+            Encrypt an iterable of (entry_id, token) rows of one of the 
+            old keys again with the key, yielding (entry_id, token, 
+            search tokens, tags) tuples in the same order. Like decrypt_many,
+            large inputs are processed in parallel.
+        """
+        rows = iter(rows)
+        head = list(islice(rows, PARALLEL_THRESHOLD))
+        rows = chain(head, rows)
+        workers = workers or available_cpus()
+
+        if len(head) < PARALLEL_THRESHOLD or workers < 2:
+            for entry_id, token in rows:
+                yield (entry_id,) + rekey_payload(self.fernet, self.index_key, token, self.codec)
+            return
+
+        for chunk, results in self.map_parallel(_rekey_chunk, rows, workers):
+            for (entry_id, _), (token, tokens, tags) in zip(chunk, results):
+                yield entry_id, token, tokens, tags
+
+    def map_parallel(self, func, rows, workers):
+        """
+            Apply func to the values of (entry_id, value) rows in chunks, 
+            over a pool of worker processes holding the key. Yields the 
+            (chunk, results) in order, keeping only a bounded number of 
+            chunks in flight such that memory use stays constant. The
+            workers are started by worker_context and only receive the
+            keys as bytes.
+        """
+        pending = deque()
+        keys = [bytes(key) for key in self.keys]
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context(), initializer=_init_worker, 
+                                 initargs=(keys, self.codec)) as pool:
+            for chunk in chunked(rows, CHUNK_SIZE):
+                pending.append((chunk, pool.submit(func, [value for _, value in chunk])))
+
+                if len(pending) >= 2 * workers:
+                    chunk, future = pending.popleft()
+                    yield chunk, future.result()
+
+            while pending:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+
+    def wipe(self):
+        self.cache.wipe()
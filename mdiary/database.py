@@ -1,90 +1,811 @@
+import queue
+import threading
 from datetime import datetime
+from itertools import islice
 from sqlalchemy import (Table, Column, Integer, Numeric, String, 
-                        Text, DateTime, create_engine, func)
+                        Text, DateTime, LargeBinary, Index, ForeignKey, 
+                        create_engine, func, tuple_, inspect, text, bindparam,
+                        exists, select, event)
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool
+from collections import OrderedDict
 from pathlib import Path
+from mdiary.lite import STORAGE_PROFILES, BUSY_TIMEOUT, EntryRow
+from mdiary.payload import PAYLOAD_VERSION, is_legacy, pack, resolve_codec, sql_text, unpack
+from mdiary.search import HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE, fts_query, period_range, plain_tag_keys
+from mdiary.stats import DAY_FORMAT, text_stats
+from mdiary.trace import traced
 
 Base = declarative_base()
 
+PAGE_SIZE = 50
+BATCH_SIZE = 5000
+MIGRATE_BATCH = 500
+SEARCH_LIMIT = 100
+
+POOL_SIZE = 4
+
+PERIOD_FORMATS = {
+    'day': '%Y-%m-%d',
+    'month': '%Y-%m',
+    'year': '%Y'
+}
+
+# The length of the periods formatted as above
+PERIOD_LENGTHS = {
+    'day': 10,
+    'month': 7,
+    'year': 4
+}
+
+# The entries are (compressed) payloads, the index reads their text through 
+# the mdiary_text function registered on every connection, see on_connect
+FULLTEXT_SCHEMA = [
+    """CREATE VIEW entries_content AS SELECT id, mdiary_text(text) AS text FROM entries""",
+    """CREATE VIRTUAL TABLE entries_fts USING fts5(text, content='entries_content', content_rowid='id',
+                                                  tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER entries_fts_insert AFTER INSERT ON entries BEGIN
+           INSERT INTO entries_fts(rowid, text) VALUES (new.id, mdiary_text(new.text));
+       END""",
+    """CREATE TRIGGER entries_fts_delete AFTER DELETE ON entries BEGIN
+           INSERT INTO entries_fts(entries_fts, rowid, text) VALUES ('delete', old.id, mdiary_text(old.text));
+       END""",
+    """CREATE TRIGGER entries_fts_update AFTER UPDATE OF text ON entries
+       WHEN mdiary_text(old.text) IS NOT mdiary_text(new.text) BEGIN
+           INSERT INTO entries_fts(entries_fts, rowid, text) VALUES ('delete', old.id, mdiary_text(old.text));
+           INSERT INTO entries_fts(rowid, text) VALUES (new.id, mdiary_text(new.text));
+       END""",
+    """INSERT INTO entries_fts(entries_fts) VALUES ('rebuild')"""
+]
+
+# The full-text index of older versions, which read the text column directly
+OLD_FULLTEXT_SCHEMA = [
+    """DROP TRIGGER IF EXISTS entries_fts_insert""",
+    """DROP TRIGGER IF EXISTS entries_fts_delete""",
+    """DROP TRIGGER IF EXISTS entries_fts_update""",
+    """DROP TABLE IF EXISTS entries_fts"""
+]
+
+# The day_stats summary follows the entry_stats rows, which are removed
+# together with their entry. Updates never move an entry to another day.
+STATS_SCHEMA = [
+    """CREATE TRIGGER IF NOT EXISTS entry_stats_insert AFTER INSERT ON entry_stats BEGIN
+           INSERT OR IGNORE INTO day_stats (day, entries, words, chars, first, last) 
+           VALUES (new.day, 0, 0, 0, new.timestamp, new.timestamp);
+           UPDATE day_stats SET entries = entries + 1, words = words + new.words, chars = chars + new.chars,
+                                first = min(first, new.timestamp), last = max(last, new.timestamp)
+           WHERE day = new.day;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_stats_update AFTER UPDATE OF words, chars ON entry_stats BEGIN
+           UPDATE day_stats SET words = words - old.words + new.words, chars = chars - old.chars + new.chars
+           WHERE day = old.day;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_stats_delete AFTER DELETE ON entry_stats BEGIN
+           DELETE FROM day_stats WHERE day = old.day AND entries = 1;
+           UPDATE day_stats SET entries = entries - 1, words = words - old.words, chars = chars - old.chars,
+                                first = (SELECT min(timestamp) FROM entry_stats WHERE day = old.day),
+                                last = (SELECT max(timestamp) FROM entry_stats WHERE day = old.day)
+           WHERE day = old.day;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS entries_stats_delete AFTER DELETE ON entries BEGIN
+           DELETE FROM entry_stats WHERE entry_id = old.id;
+       END"""
+]
+
+TAGS_SCHEMA = [
+    """CREATE TRIGGER IF NOT EXISTS entries_tags_delete AFTER DELETE ON entries BEGIN
+           DELETE FROM entry_tags WHERE entry_id = old.id;
+       END"""
+]
+
+REVISIONS_SCHEMA = [
+    """CREATE TRIGGER IF NOT EXISTS entries_revisions_delete AFTER DELETE ON entries BEGIN
+           DELETE FROM entry_revisions WHERE entry_id = old.id;
+       END"""
+]
+
+# Numbers the revisions of an entry from 1, see EntryRevision
+REVISION_INSERT = text("""
+    INSERT INTO entry_revisions (entry_id, revision, timestamp, snapshot, text)
+    SELECT :entry_id, coalesce(max(revision), 0) + 1, :timestamp, :snapshot, :text 
+    FROM entry_revisions WHERE entry_id = :entry_id
+""").bindparams(bindparam('timestamp', type_=DateTime()))
+
+TAG_INSERT = text("""INSERT OR IGNORE INTO tags (tag) VALUES (:tag)""")
+
+# Entry timestamps never change, they are copied such that the entries 
+# of a tag are paged through in order by ix_entry_tags_tag_timestamp
+ENTRY_TAG_INSERT = text("""
+    INSERT INTO entry_tags (tag_id, entry_id, timestamp)
+    SELECT tags.id, entries.id, entries.timestamp FROM tags, entries
+    WHERE tags.tag = :tag AND entries.id = :entry_id
+""")
+
+# Adds the statistics of an entry stored without them, see add_stats
+STATS_INSERT = text("""
+    INSERT INTO entry_stats (entry_id, day, timestamp, words, chars)
+    SELECT id, substr(timestamp, 1, 10), timestamp, :words, :chars FROM entries WHERE id = :entry_id
+""")
+
+LEGACY_QUERY = text("""
+    SELECT id, text FROM entries
+    WHERE id > :after AND (typeof(text) = 'text' OR substr(text, 1, 1) = X'67')
+    ORDER BY id
+    LIMIT :limit
+""")
+
+UNINDEXED_QUERY = text("""
+    SELECT max(id) FROM entries 
+    WHERE NOT EXISTS (SELECT 1 FROM entry_tokens WHERE entry_tokens.entry_id = entries.id)""")
+
+MIGRATE_UPDATE = text("""UPDATE entries SET text = :new WHERE id = :id AND text = :old""")
+
+SEARCH_QUERY = text("""
+    SELECT entries.id AS entry_id, entries.timestamp AS timestamp,
+           snippet(entries_fts, 0, :open, :close, '...', 24) AS snippet
+    FROM entries_fts JOIN entries ON entries.id = entries_fts.rowid
+    WHERE entries_fts MATCH :match
+      AND (:start IS NULL OR entries.timestamp >= :start)
+      AND (:end IS NULL OR entries.timestamp < :end)
+    ORDER BY rank
+    LIMIT :limit
+""").bindparams(
+    bindparam('start', type_=DateTime()), bindparam('end', type_=DateTime())
+).columns(entry_id=Integer(), timestamp=DateTime(), snippet=Text())
+
+class PayloadText(TypeDecorator):
+    """
+        A text column holding payloads, see mdiary.payload. Plain payloads
+        are read as text, encrypted ones as bytes. Values are written as 
+        they are, DBHandler.pack encodes them.
+    """
+    impl = Text
+
+    def process_result_value(self, value, dialect):
+        return unpack(value)
+
 class Entry(Base):
     __tablename__ = 'entries'
 
     entry_id   = Column('id', Integer(), primary_key=True)
-    entry_text = Column('text', Text(), nullable=False)
+    entry_text = Column('text', PayloadText(), nullable=False)
     timestamp  = Column('timestamp', DateTime(), nullable=False)
+
+    # The ids of deleted entries are never reused, and a shard starts
+    # at the id of its year, see DBHandler.create
+    __table_args__ = (
+        Index('ix_entries_timestamp_id', 'timestamp', 'id'),
+        {'sqlite_autoincrement': True}
+    )
     
     def __repr__(self):
         return "Entry(text='{self.entry_text}', timestamp={self.timestamp})".format(self=self)
 
+class EntryToken(Base):
+    """
+        Search index of encrypted diaries, storing a keyed hash
+        of every (normalized) word occurring in an entry.
+    """
+    __tablename__ = 'entry_tokens'
+
+    token    = Column('token', LargeBinary(), primary_key=True)
+    entry_id = Column('entry_id', Integer(), ForeignKey('entries.id'), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_entry_tokens_entry_id', 'entry_id'),
+    )
+
+ENTRIES = Entry.__table__
+
+# The columns of an EntryRow, reads select these with SQLAlchemy Core
+# instead of loading Entry objects, see DBHandler.rows
+ENTRY_COLUMNS = [ENTRIES.c.id, ENTRIES.c.timestamp, ENTRIES.c.text]
+
+class EntryStat(Base):
+    """
+        The number of words and characters of an entry, counted 
+        before it is encrypted.
+    """
+    __tablename__ = 'entry_stats'
+
+    entry_id  = Column('entry_id', Integer(), ForeignKey('entries.id'), primary_key=True)
+    day       = Column('day', String(), nullable=False)
+    timestamp = Column('timestamp', DateTime(), nullable=False)
+    words     = Column('words', Integer(), nullable=False)
+    chars     = Column('chars', Integer(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_entry_stats_day', 'day', 'timestamp'),
+    )
+
+class DayStat(Base):
+    """
+        Summary of the entries written on a day (YYYY-MM-DD), kept
+        up to date by the triggers on entry_stats, see STATS_SCHEMA.
+    """
+    __tablename__ = 'day_stats'
+
+    day     = Column('day', String(), primary_key=True)
+    entries = Column('entries', Integer(), nullable=False)
+    words   = Column('words', Integer(), nullable=False)
+    chars   = Column('chars', Integer(), nullable=False)
+    first   = Column('first', DateTime(), nullable=False)
+    last    = Column('last', DateTime(), nullable=False)
+
+def entry_stats(txt, stats=None):
+    """
+        Returns the (words, characters) stats of an entry, which are 
+        counted for plain texts when not given. Returns None for encrypted
+        entries without stats, these are added by add_stats later on.
+    """
+    if stats is None and isinstance(txt, str):
+        stats = text_stats(txt)
+
+    return stats
+
+def stats_row(entry_id, timestamp, stats):
+    return {'entry_id': entry_id, 'day': timestamp.strftime(DAY_FORMAT), 'timestamp': timestamp,
+            'words': stats[0], 'chars': stats[1]}
+
+class Tag(Base):
+    """
+        The tags of the entries, stored as the keyed hash of #tag (see
+        EntryCipher.blind_tokens) in encrypted diaries and as the encoded
+        tag otherwise.
+    """
+    __tablename__ = 'tags'
+
+    tag_id = Column('id', Integer(), primary_key=True)
+    tag    = Column('tag', LargeBinary(), nullable=False, unique=True)
+
+class EntryTag(Base):
+    __tablename__ = 'entry_tags'
+
+    tag_id    = Column('tag_id', Integer(), ForeignKey('tags.id'), primary_key=True)
+    entry_id  = Column('entry_id', Integer(), ForeignKey('entries.id'), primary_key=True)
+    timestamp = Column('timestamp', DateTime(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_entry_tags_tag_timestamp', 'tag_id', 'timestamp', 'entry_id'),
+        Index('ix_entry_tags_entry_id', 'entry_id'),
+    )
+
+class Meta(Base):
+    """
+        Integer settings of the database, such as the progress of
+        migrations, see get_meta.
+    """
+    __tablename__ = 'meta'
+
+    key   = Column('key', String(), primary_key=True)
+    value = Column('value', Integer(), nullable=False)
+
+def tag_keys(txt, tags=None):
+    """
+        Returns the tag keys of an entry, which are parsed from plain 
+        texts when not given. Returns None for encrypted entries without
+        tags, see entry_stats.
+    """
+    if tags is None and isinstance(txt, str):
+        tags = plain_tag_keys(txt)
+
+    return tags
+
+def store_tags(conn, entry_id, tags):
+    """
+        Replace the tags of an entry, using the connection conn.
+    """
+    tagged = EntryTag.__table__
+
+    conn.execute(tagged.delete().where(tagged.c.entry_id == entry_id))
+
+    if tags:
+        conn.execute(TAG_INSERT, [{'tag': tag} for tag in tags])
+        conn.execute(ENTRY_TAG_INSERT, [{'entry_id': entry_id, 'tag': tag} for tag in tags])
+
+class EntryRevision(Base):
+    """
+        An old text of an entry, replaced at timestamp. Its text is either
+        the whole text (a snapshot) or a delta against the next newer 
+        revision or the entry itself, see mdiary.revisions.
+    """
+    __tablename__ = 'entry_revisions'
+
+    revision_id = Column('id', Integer(), primary_key=True)
+    entry_id    = Column('entry_id', Integer(), ForeignKey('entries.id'), nullable=False)
+    revision    = Column('revision', Integer(), nullable=False)
+    timestamp   = Column('timestamp', DateTime(), nullable=False)
+    snapshot    = Column('snapshot', Integer(), nullable=False)
+    text        = Column('text', PayloadText(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_entry_revisions_entry_revision', 'entry_id', 'revision', unique=True),
+    )
+
+REVISIONS = EntryRevision.__table__
+
+# The entries and drafts changed by the queued writes, see DBHandler.get_queued
+QUEUED_KEYS = {'update': 'entry', 'draft': 'draft', 'remove_draft': 'draft'}
+
+def revision_depth(entry_id):
+    """
+        Returns the query counting the revisions of an entry after its
+        newest snapshot, see mdiary.revisions.
+    """
+    newest = select([func.max(REVISIONS.c.revision)]).where(
+        (REVISIONS.c.entry_id == entry_id) & (REVISIONS.c.snapshot == 1))
+
+    return select([func.count(REVISIONS.c.id)]).where(
+        (REVISIONS.c.entry_id == entry_id) & (REVISIONS.c.revision > func.coalesce(newest.as_scalar(), 0)))
+
+def store_revision(conn, entry_id, revise, pack):
+    """
+        Add a revision of the stored text of an entry before it is replaced,
+        packing its text with pack, using the connection conn. The function
+        revise(old_text, depth) returns the (snapshot, text) revision of the
+        stored text, given the number of revisions after the newest snapshot,
+        or None to keep no revision. See DiaryCore.prepare_revision.
+    """
+    old_text = conn.execute(select([ENTRIES.c.text]).where(ENTRIES.c.id == entry_id)).scalar()
+
+    if old_text is None:
+        return
+
+    revision = revise(old_text, conn.execute(revision_depth(entry_id)).scalar())
+
+    if revision is not None:
+        snapshot, txt = revision
+        conn.execute(REVISION_INSERT, entry_id=entry_id, timestamp=datetime.now(), snapshot=int(snapshot), 
+                     text=pack(txt))
+
+class Draft(Base):
+    """
+        Autosaved, not yet stored text of the writer and editor views.
+    """
+    __tablename__ = 'drafts'
+
+    name       = Column('name', String(), primary_key=True)
+    draft_text = Column('text', PayloadText(), nullable=False)
+    timestamp  = Column('timestamp', DateTime(), nullable=False)
+
 class DBHandler():
-    def __init__(self, name='mdiary.db'):
+    def __init__(self, name='mdiary.db', profile='durable', path=None, compression='auto', first_id=1):
+        if profile not in STORAGE_PROFILES:
+            raise ValueError('Unknown storage profile {}, use one of {}.'.format(
+                             profile, ', '.join(STORAGE_PROFILES)))
+
         self.db_name = name
-        self.db_path = Path.home() / '.mdiary'
+        self.profile = profile
+        self.codec = resolve_codec(compression)
+        self.db_path = Path(path) if path else Path.home() / '.mdiary'
         self.full_path = self.db_path / self.db_name  
+        self.first_id = first_id
         self.engine = None
         self.session = None
+        self.writes = queue.Queue()
+        self.writer = None
+        self.queued = {}
+        self.queued_lock = threading.Lock()
+        self.write_error = None
+        self.listeners = []
 
-    def create(self):
+    @traced('db.create')
+    def create(self, fulltext=False):
         """
-            Create a new database.
+            Create a new database. With fulltext set, a full-text 
+            search index is kept in sync with the (plain text) entries.
         """
         if not self.db_path.is_dir():
             self.db_path.mkdir(exist_ok=True)
 
         if not self.engine:
-            self.engine = create_engine('sqlite:///{}'.format(self.full_path))
+            self.engine = create_engine('sqlite:///{}'.format(self.full_path), poolclass=QueuePool,
+                                        pool_size=POOL_SIZE, connect_args={'check_same_thread': False})
+            event.listen(self.engine, 'connect', self.on_connect)
         
+        new = not self.engine.has_table('entries')
+        untagged = not new and not self.engine.has_table('tags')
+
         Base.metadata.create_all(self.engine)
+        self.create_indexes()
+
+        with self.engine.begin() as conn:
+            for statement in STATS_SCHEMA + TAGS_SCHEMA + REVISIONS_SCHEMA:
+                conn.execute(text(statement))
+
+            # The entries written so far are tagged by add_tags
+            if untagged:
+                self.set_meta(conn, 'tags_until', conn.execute(select([func.max(ENTRIES.c.id)])).scalar() or 0)
+
+            # The entries without search tokens so far are indexed by add_tokens, once
+            if conn.execute(select([Meta.__table__.c.value]).where(Meta.__table__.c.key == 'tokens_until')).scalar() is None:
+                self.set_meta(conn, 'tokens_until', conn.execute(UNINDEXED_QUERY).scalar() or 0)
+
+        if new:
+            self.set_payload_version(PAYLOAD_VERSION)
+
+            if self.first_id > 1:
+                with self.engine.begin() as conn:
+                    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('entries', :seq)"), 
+                                 seq=self.first_id - 1)
+
+        if fulltext:
+            self.create_fulltext()
+
+    def on_connect(self, dbapi_connection, connection_record):
+        """
+            Apply the pragmas of the storage profile to a new connection,
+            and register the function reading payloads.
+        """
+        dbapi_connection.create_function('mdiary_text', 1, sql_text, deterministic=True)
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA busy_timeout = {}'.format(BUSY_TIMEOUT))
+
+        for pragma, value in STORAGE_PROFILES[self.profile].items():
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+
+        cursor.close()
+
+    def create_indexes(self):
+        """
+            Create the indexes which are missing from a database that 
+            was created by an older version of mdiary.
+        """
+        inspector = inspect(self.engine)
+
+        for table in Base.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
     
+    def create_fulltext(self):
+        """
+            Create the FTS5 index over the entries and the triggers keeping 
+            it up to date, indexing the entries which are already stored.
+            The index of an older version is replaced.
+        """
+        with self.engine.begin() as conn:
+            if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'entries_content'")).scalar():
+                return
+
+            for statement in OLD_FULLTEXT_SCHEMA + FULLTEXT_SCHEMA:
+                conn.execute(text(statement))
+
     def new_session(self):
         """
-            Initialize a new session object.
+            Initialize a new session object. Every thread reading through 
+            the handler gets a session of its own, see end_session.
         """
         if not self.session:
-            Session = sessionmaker(bind=self.engine)
-            self.session = Session()
+            self.session = scoped_session(sessionmaker(bind=self.engine))
+
+    def end_session(self):
+        """
+            Close the session of the current thread, returning its connection.
+        """
+        self.session.remove()
     
-    def new_entry(self, txt):
+    @traced('db.new_entry')
+    def new_entry(self, txt, tokens=None, stats=None, tags=None, timestamp=None):
         """
             Appends a new diary entry to the database,
-            given the text of the entry.
+            given the text of the entry. The search tokens,
+            (words, characters) stats and tag keys of encrypted 
+            entries are stored alongside. It is written now,
+            unless the datetime timestamp is given.
         """
-        dt = datetime.now()
+        dt = timestamp or datetime.now()
 
-        new_entry = Entry(entry_text=txt, timestamp=dt)
+        new_entry = Entry(entry_text=self.pack(txt), timestamp=dt)
 
         self.session.add(new_entry)
+        self.session.flush()
+
+        if tokens:
+            self.session.add_all(EntryToken(token=token, entry_id=new_entry.entry_id) 
+                                 for token in tokens)
+
+        stats = entry_stats(txt, stats)
+
+        if stats:
+            self.session.add(EntryStat(**stats_row(new_entry.entry_id, dt, stats)))
+
+        tags = tag_keys(txt, tags)
+
+        if tags:
+            self.session.flush()
+            store_tags(self.session.connection(), new_entry.entry_id, tags)
+
         self.session.commit()
+        self.emit('insert', [new_entry.entry_id])
         
         return new_entry
     
-    def get_entry(self, id):
+    @traced('db.get_entry')
+    def get_entry(self, id, queued=True):
         """
-            Retrieve the diary entries that matches the id.
+            Retrieve the EntryRow of the entry with the id, 
+            None if there is no such entry. The row has the text of
+            a queued update which is not stored yet, unless queued
+            is False.
         """
-        entry = self.session.query(Entry).filter(Entry.entry_id == id).first()
-        
-        return entry
+        rows = self.rows(select(ENTRY_COLUMNS).where(ENTRIES.c.id == id))
+
+        if not rows:
+            return None
+
+        update = self.get_queued('update', id) if queued else None
+
+        return rows[0]._replace(entry_text=update[0]) if update else rows[0]
 
     def get_entries(self):
         """
             Retrieve all diary entries as a list of dictionaries. 
         """
-        entries = self.session.query(Entry).all()
-        res = map(lambda q: q.__dict__, entries)
-        
-        return list(res)
+        return [row._asdict() for row in self.iter_entries()]
+
+    def rows(self, query, make_row=EntryRow._make):
+        """
+            Execute a Core query selecting ENTRY_COLUMNS and return
+            its result as a list of EntryRow tuples, or of the rows
+            made by make_row for other queries.
+        """
+        return [make_row(row) for row in self.session.execute(query)]
+
+    def iter_rows(self, query, batch=BATCH_SIZE, make_row=EntryRow._make):
+        """
+            Execute a Core query selecting ENTRY_COLUMNS and yield its 
+            result as EntryRow tuples (or make_row of every row), fetching 
+            batch rows at a time such that only one batch is held in memory.
+        """
+        result = self.session.execute(query)
+
+        try:
+            while True:
+                rows = result.fetchmany(batch)
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield make_row(row)
+        finally:
+            result.close()
     
-    def get_entries_raw(self):
+    @traced('db.get_page')
+    def get_page(self, after=None, before=None, limit=PAGE_SIZE, start=None, end=None, last=False, tag=None):
         """
-            Returns all diary entries as a iterable of Entry objects.
+            Retrieve at most limit entries ordered by (timestamp, id),
+            starting right after the key after, or ending right before 
+            the key before (or at the last entry, with last set). 
+            Keys are (timestamp, id) tuples, see entry_key.
+            Only entries written between the datetimes start and end (exclusive)
+            are considered, when given, and only the entries having the tag
+            key tag (see tag_keys), which are paged through by the index of 
+            entry_tags. Rows are returned in ascending order as EntryRow tuples.
         """
-        entries = self.session.query(Entry)
+        query, timestamp, entry_id = self.select_tagged(select(ENTRY_COLUMNS), tag)
+        query = self.filter_range(query, start, end, timestamp)
+        key = tuple_(timestamp, entry_id)
+
+        if after:
+            query = query.where(key > tuple_(*after))
+        
+        if before:
+            query = query.where(key < tuple_(*before))
+        
+        if (before or last) and not after:
+            query = query.order_by(timestamp.desc(), entry_id.desc())
+            return list(reversed(self.rows(query.limit(limit))))
+
+        query = query.order_by(timestamp, entry_id)
         
-        return entries
+        return self.rows(query.limit(limit))
+
+    @staticmethod
+    def select_tagged(query, tag=None):
+        """
+            Restrict a Core query over the entries to those having the tag
+            key tag, if given. Returns the query and the timestamp and id 
+            columns to filter and order it by.
+        """
+        if tag is None:
+            return query, ENTRIES.c.timestamp, ENTRIES.c.id
+
+        tagged = EntryTag.__table__
+        tag_id = select([Tag.__table__.c.id]).where(Tag.__table__.c.tag == tag).as_scalar()
+        query = query.select_from(ENTRIES.join(tagged, tagged.c.entry_id == ENTRIES.c.id))
+
+        return query.where(tagged.c.tag_id == tag_id), tagged.c.timestamp, tagged.c.entry_id
+
+    @staticmethod
+    def entry_key(row):
+        """
+            Returns the pagination key of a row returned by get_page.
+        """
+        return (row.timestamp, row.entry_id)
+
+    @staticmethod
+    def filter_range(query, start=None, end=None, timestamp=ENTRIES.c.timestamp):
+        """
+            Restrict a Core query to the entries written between start and end.
+        """
+        if start:
+            query = query.where(timestamp >= start)
+        if end:
+            query = query.where(timestamp < end)
+
+        return query
+
+    def get_range(self, start=None, end=None, limit=None):
+        """
+            Retrieve the entries written between the datetimes start 
+            and end (exclusive), as EntryRow tuples ordered by timestamp.
+        """
+        query = self.filter_range(select(ENTRY_COLUMNS), start, end)
+
+        return self.rows(query.order_by(ENTRIES.c.timestamp, ENTRIES.c.id).limit(limit))
+
+    def get_day(self, year, month, day):
+        """
+            Retrieve the entries written on a day, see get_range.
+        """
+        return self.get_range(*period_range('{}-{}-{}'.format(year, month, day)))
+
+    def get_month(self, year, month):
+        """
+            Retrieve the entries written in a month, see get_range.
+        """
+        return self.get_range(*period_range('{}-{}'.format(year, month)))
+
+    def get_year(self, year):
+        """
+            Retrieve the entries written in a year, see get_range.
+        """
+        return self.get_range(*period_range(str(year)))
+
+    @traced('db.count_range')
+    def count_range(self, start=None, end=None, tag=None):
+        """
+            Returns the number of entries written between start and end,
+            having the tag key tag if given.
+        """
+        query, timestamp, entry_id = self.select_tagged(select([func.count(ENTRIES.c.id)]), tag)
+        
+        return self.session.execute(self.filter_range(query, start, end, timestamp)).scalar()
+
+    @traced('db.count_by_period')
+    def count_by_period(self, period='month', start=None, end=None):
+        """
+            Returns the number of entries per 'day', 'month' or 'year'
+            written between start and end, as a list of (period, count) 
+            tuples ordered by period, where period is formatted as 
+            YYYY-MM-DD, YYYY-MM or YYYY respectively.
+        """
+        label = func.strftime(PERIOD_FORMATS[period], ENTRIES.c.timestamp)
+        query = select([label, func.count(ENTRIES.c.id)])
+        query = self.filter_range(query, start, end).group_by(label).order_by(label)
+
+        return [tuple(row) for row in self.session.execute(query)]
+
+    @traced('db.get_summary')
+    def get_summary(self):
+        """
+            Returns the (entries, words, chars, days, first, last) totals
+            of the diary from the day_stats summary, without reading entries.
+        """
+        days = DayStat.__table__
+        query = select([func.sum(days.c.entries), func.sum(days.c.words), func.sum(days.c.chars), 
+                        func.count(days.c.day), func.min(days.c.first), func.max(days.c.last)])
+
+        entries, words, chars, n_days, first, last = self.session.execute(query).first()
+
+        return (entries or 0, words or 0, chars or 0, n_days, first, last)
+
+    @traced('db.stats_by_period')
+    def stats_by_period(self, period='month'):
+        """
+            Returns (period, entries, words, chars) tuples per 'day', 'month' 
+            or 'year', ordered by period, see count_by_period.
+        """
+        days = DayStat.__table__
+        label = func.substr(days.c.day, 1, PERIOD_LENGTHS[period])
+        query = select([label, func.sum(days.c.entries), func.sum(days.c.words), func.sum(days.c.chars)])
+
+        return [tuple(row) for row in self.session.execute(query.group_by(label).order_by(label))]
+
+    def get_texts_without_stats(self, batch=PAGE_SIZE):
+        """
+            Iterate over (entry_id, entry_text) tuples of the entries 
+            without stats, e.g. written by an older version.
+        """
+        stats_table = EntryStat.__table__
+        counted = exists().where(stats_table.c.entry_id == ENTRIES.c.id)
+        query = select([ENTRIES.c.id, ENTRIES.c.text]).where(~counted).order_by(ENTRIES.c.id)
+
+        return self.iter_rows(query, batch, tuple)
+
+    def get_untagged_texts(self, batch=PAGE_SIZE):
+        """
+            Iterate over (entry_id, entry_text) tuples of the entries 
+            written before the tags were kept, which are not tagged yet.
+        """
+        query = select([ENTRIES.c.id, ENTRIES.c.text]).where(ENTRIES.c.id > self.get_meta('tags_after'))
+        query = query.where(ENTRIES.c.id <= self.get_meta('tags_until')).order_by(ENTRIES.c.id)
+
+        return self.iter_rows(query, batch, tuple)
+
+    def add_tags(self, entry_tags):
+        """
+            Store the tags of the entries returned by get_untagged_texts, 
+            given a list of (entry_id, tags) tuples, in a single transaction.
+        """
+        if not entry_tags:
+            return
+
+        with self.engine.begin() as conn:
+            for entry_id, tags in entry_tags:
+                store_tags(conn, entry_id, tags)
+
+            self.set_meta(conn, 'tags_after', entry_tags[-1][0])
+
+    def remove_unused_tags(self):
+        tags = Tag.__table__
+        tagged = EntryTag.__table__
+
+        with self.engine.begin() as conn:
+            conn.execute(tags.delete().where(~exists().where(tagged.c.tag_id == tags.c.id)))
+
+    def get_meta(self, key, default=0):
+        value = self.session.query(Meta.value).filter(Meta.key == key).scalar()
+
+        return default if value is None else value
+
+    def unmigrated(self):
+        """
+            Returns the DBHandlers of the databases which may hold entries
+            written by older versions, see DiaryCore.migrate. Older versions
+            may still open a single database, which is checked every time.
+        """
+        return [self]
+
+    def set_migrated(self, db_handler):
+        pass
+
+    @staticmethod
+    def set_meta(conn, key, value):
+        """
+            Store a setting using the connection conn, see Meta.
+        """
+        meta = Meta.__table__
+
+        conn.execute(meta.delete().where(meta.c.key == key))
+        conn.execute(meta.insert().values(key=key, value=value))
+
+    def add_stats(self, stats):
+        """
+            Store the stats of entries, given an iterable of (entry_id, 
+            (words, characters)) tuples, in a single transaction.
+        """
+        rows = [{'entry_id': entry_id, 'words': words, 'chars': chars}
+                for entry_id, (words, chars) in stats]
+
+        if rows:
+            with self.engine.begin() as conn:
+                conn.execute(STATS_INSERT, rows)
+
+    def get_entries_raw(self):
+        """
+            Returns all diary entries as an iterable of EntryRow tuples.
+        """
+        return self.iter_entries()
 
+    @traced('db.remove_entry')
     def remove_entry(self, id):
         """
             Delete an entry given its id.
@@ -92,10 +813,13 @@ class DBHandler():
         try:
             query = self.session.query(Entry).filter(Entry.entry_id == id)
             d_entry = query.one()
+            self.session.query(EntryToken).filter(EntryToken.entry_id == id).delete()
             self.session.delete(d_entry)
             self.session.commit()
         except NoResultFound:
-            pass
+            return
+
+        self.emit('delete', [id])
 
     
     def entry_exists(self, id):
@@ -106,21 +830,594 @@ class DBHandler():
         query = query.filter_by(entry_id=id).scalar() 
         return query is not None
 
-    def update_entry(self, id, txt):
+    @traced('db.update_entry')
+    def update_entry(self, id, txt, tokens=None, stats=None, tags=None, revision=None):
         """
-            Updates an entry.
+            Updates an entry, replacing its search tokens, stats and tags if given.
+            A revision of the old text is stored if the function revision is
+            given, see store_revision.
         """
+        if revision is not None:
+            store_revision(self.session.connection(), id, revision, self.pack)
+
         query = self.session.query(Entry)
         entry = query.filter(Entry.entry_id == id).first()
-        entry.entry_text = txt
+        entry.entry_text = self.pack(txt)
+
+        if tokens is not None:
+            self.session.query(EntryToken).filter(EntryToken.entry_id == id).delete()
+            self.session.add_all(EntryToken(token=token, entry_id=id) for token in tokens)
+
+        stats = entry_stats(txt, stats)
+
+        if stats:
+            self.session.query(EntryStat).filter(EntryStat.entry_id == id).update(
+                {'words': stats[0], 'chars': stats[1]}, synchronize_session=False)
+
+        tags = tag_keys(txt, tags)
+
+        if tags is not None:
+            self.session.flush()
+            store_tags(self.session.connection(), id, tags)
+
         self.session.commit()
+        self.emit('update', [id])
+
+    def get_revisions(self, id):
+        """
+            Returns the (revision, timestamp) tuples of the revisions of an
+            entry, newest first, where timestamp is when it was replaced.
+        """
+        query = select([REVISIONS.c.revision, REVISIONS.c.timestamp]).where(REVISIONS.c.entry_id == id)
+        
+        return self.rows(query.order_by(REVISIONS.c.revision.desc()), tuple)
+
+    def revision_depth(self, id):
+        """
+            Returns the number of revisions of an entry after its newest
+            snapshot, see mdiary.revisions.
+        """
+        return self.session.execute(revision_depth(id)).scalar()
+
+    @traced('db.get_revision_chain')
+    def get_revision_chain(self, id, revision):
+        """
+            Returns the (snapshot, text) tuples needed to reconstruct the
+            revision of an entry, from the revision up to the next snapshot 
+            or the newest revision, see mdiary.revisions.reconstruct.
+        """
+        snapshot = select([func.min(REVISIONS.c.revision)]).where(
+            (REVISIONS.c.entry_id == id) & (REVISIONS.c.revision >= revision) & (REVISIONS.c.snapshot == 1))
+        query = select([REVISIONS.c.snapshot, REVISIONS.c.text]).where(
+            (REVISIONS.c.entry_id == id) & (REVISIONS.c.revision >= revision) &
+            (REVISIONS.c.revision <= func.coalesce(snapshot.as_scalar(), REVISIONS.c.revision)))
+
+        return self.rows(query.order_by(REVISIONS.c.revision), tuple)
+
+    def get_revision_texts(self, entry_ids):
+        """
+            Returns the (revision_id, text) tuples of the revisions
+            of the given entries.
+        """
+        query = select([REVISIONS.c.id, REVISIONS.c.text]).where(REVISIONS.c.entry_id.in_(list(entry_ids)))
+
+        return self.rows(query, tuple)
     
+    @traced('db.get_entry_count')
     def get_entry_count(self):
         """
             Returns the number of entries stored in the database.
         """
-        counter = self.session.query(func.count(Entry.entry_text).label('entry_count')).first()
+        counter = self.session.query(func.count(Entry.entry_id).label('entry_count')).first()
         return counter.entry_count
 
+    @traced('db.search')
+    def search(self, query, start=None, end=None, limit=SEARCH_LIMIT):
+        """
+            Full-text search in the entries, every word in the query
+            is matched as a prefix, optionally restricted to the entries 
+            written between the datetimes start and end. Returns (entry_id, 
+            timestamp, snippet) rows ordered by relevance, where the matches
+            in the snippet are enclosed by HIGHLIGHT_OPEN and HIGHLIGHT_CLOSE.
+        """
+        match = fts_query(query)
+
+        if not match:
+            return []
+
+        params = {'match': match, 'limit': limit, 'start': start, 'end': end,
+                  'open': HIGHLIGHT_OPEN, 'close': HIGHLIGHT_CLOSE}
+
+        return self.session.execute(SEARCH_QUERY, params).fetchall()
+
+    @traced('db.search_tokens')
+    def search_tokens(self, tokens, start=None, end=None, limit=SEARCH_LIMIT):
+        """
+            Search the encrypted entries containing all the given tokens,
+            optionally restricted to the entries written between start and 
+            end. Returns EntryRow tuples, newest first.
+        """
+        tokens = set(tokens)
+
+        if not tokens:
+            return []
+
+        entry_tokens = EntryToken.__table__
+        matches = select([entry_tokens.c.entry_id]).where(entry_tokens.c.token.in_(tokens))
+        matches = matches.group_by(entry_tokens.c.entry_id)
+        matches = matches.having(func.count(entry_tokens.c.token) == len(tokens)).alias()
+
+        query = select(ENTRY_COLUMNS).select_from(ENTRIES.join(matches, matches.c.entry_id == ENTRIES.c.id))
+        query = self.filter_range(query, start, end)
+        query = query.order_by(ENTRIES.c.timestamp.desc(), ENTRIES.c.id.desc())
+
+        return self.rows(query.limit(limit))
+
+    def get_unindexed_texts(self, batch=PAGE_SIZE):
+        """
+            Iterate over (entry_id, entry_text) tuples of the entries 
+            written before the search tokens were kept, which are not 
+            indexed yet. Entries without any tokens are only returned
+            until add_tokens passed them.
+        """
+        indexed = exists().where(EntryToken.__table__.c.entry_id == ENTRIES.c.id)
+        query = select([ENTRIES.c.id, ENTRIES.c.text]).where(ENTRIES.c.id > self.get_meta('tokens_after'))
+        query = query.where(ENTRIES.c.id <= self.get_meta('tokens_until')).where(~indexed).order_by(ENTRIES.c.id)
+
+        return self.iter_rows(query, batch, tuple)
+
+    def add_tokens(self, entry_tokens):
+        """
+            Store the search tokens of the entries returned by 
+            get_unindexed_texts, given an iterable of (entry_id, tokens) 
+            tuples, in a single transaction. Entries which were indexed 
+            in the meantime (updated by the writer) are skipped.
+        """
+        entry_tokens = list(entry_tokens)
+
+        if not entry_tokens:
+            return
+
+        tokens_table = EntryToken.__table__
+        query = select([tokens_table.c.entry_id]).where(
+            tokens_table.c.entry_id.in_([entry_id for entry_id, _ in entry_tokens])).distinct()
+        indexed = {entry_id for entry_id, in self.session.execute(query)}
+        rows = [{'entry_id': entry_id, 'token': token} 
+                for entry_id, tokens in entry_tokens if entry_id not in indexed for token in tokens]
+
+        if rows:
+            self.session.execute(EntryToken.__table__.insert(), rows)
+
+        self.set_meta(self.session, 'tokens_after', entry_tokens[-1][0])
+        self.session.commit()
+
+    def is_indexed(self):
+        """
+            Whether all entries are in the search index, see get_unindexed_texts.
+        """
+        return self.get_meta('tokens_after') >= self.get_meta('tokens_until')
+
+    def set_indexed(self):
+        """
+            Mark all entries as indexed once add_tokens stored the tokens 
+            of the entries returned by get_unindexed_texts, which may end 
+            before tokens_until when the last ones were deleted.
+        """
+        self.set_meta(self.session, 'tokens_after', self.get_meta('tokens_until'))
+        self.session.commit()
+
+    @traced('db.bulk_insert')
+    def bulk_insert(self, rows, batch_size=BATCH_SIZE):
+        """
+            Insert an iterable of (timestamp, entry_text, tokens, stats, tags) 
+            rows, where tokens, stats and tags may be None. Every batch is 
+            inserted in a single transaction with executemany, bypassing the
+            session. Returns the number of inserted entries.
+        """
+        entries = Entry.__table__
+        tokens_table = EntryToken.__table__
+        stats_table = EntryStat.__table__
+        count = 0
+        rows = iter(rows)
+
+        while True:
+            batch = list(islice(rows, batch_size))
+
+            if not batch:
+                break
+
+            entry_rows = [{'timestamp': timestamp, 'text': self.pack(entry_text)} 
+                          for timestamp, entry_text, _, _, _ in batch]
+
+            with self.engine.begin() as conn:
+                conn.execute(entries.insert(), entry_rows)
+
+                # The entries got successive ids, as the transaction holds the write lock
+                next_id = conn.execute(text('SELECT last_insert_rowid()')).scalar() - len(batch) + 1
+                token_rows = []
+                stat_rows = []
+                tag_rows = []
+
+                for entry_id, (timestamp, entry_text, tokens, stats, tags) in enumerate(batch, next_id):
+                    token_rows += [{'entry_id': entry_id, 'token': token} for token in tokens or ()]
+                    stats = entry_stats(entry_text, stats)
+
+                    if stats:
+                        stat_rows.append(stats_row(entry_id, timestamp, stats))
+
+                    tag_rows += [{'entry_id': entry_id, 'tag': tag} for tag in tag_keys(entry_text, tags) or ()]
+
+                if token_rows:
+                    conn.execute(tokens_table.insert(), token_rows)
+
+                if stat_rows:
+                    conn.execute(stats_table.insert(), stat_rows)
+
+                if tag_rows:
+                    conn.execute(TAG_INSERT, [{'tag': row['tag']} for row in tag_rows])
+                    conn.execute(ENTRY_TAG_INSERT, tag_rows)
+
+            self.emit('insert', list(range(next_id, next_id + len(batch))))
+            count += len(batch)
+
+        return count
+
+    def iter_entries(self, batch=BATCH_SIZE):
+        """
+            Iterate over the EntryRow tuples of all entries ordered 
+            by timestamp, fetching them in batches.
+        """
+        query = select(ENTRY_COLUMNS).order_by(ENTRIES.c.timestamp, ENTRIES.c.id)
+        
+        return self.iter_rows(query, batch)
+
+    def get_texts(self, batch=PAGE_SIZE, after=0):
+        """
+            Iterate over (entry_id, entry_text) tuples of all entries
+            with an id above after, fetching them in batches.
+        """
+        query = select([ENTRIES.c.id, ENTRIES.c.text]).where(ENTRIES.c.id > after).order_by(ENTRIES.c.id)
+        
+        return self.iter_rows(query, batch, tuple)
+
+    @traced('db.get_draft')
+    def get_draft(self, name):
+        """
+            Returns the text of a draft, or None if there is no such draft,
+            including the queued changes to drafts which are not stored yet.
+        """
+        if self.get_queued('remove_draft', name):
+            return None
+
+        draft = self.get_queued('draft', name)
+
+        if draft:
+            return draft[0]
+
+        return self.session.query(Draft.draft_text).filter(Draft.name == name).scalar()
+
+    def get_drafts(self):
+        """
+            Returns the (name, draft_text) tuples of all drafts.
+        """
+        return self.session.query(Draft.name, Draft.draft_text).all()
+
+    @traced('db.rewrite')
+    def rewrite(self, entries=(), drafts=(), revisions=()):
+        """
+            Replace the texts of entries, given (entry_id, entry_text, tokens, 
+            tags) tuples, of drafts, given (name, draft_text) tuples, and of 
+            revisions, given (revision_id, text) tuples, in a single transaction.
+            The search tokens and tags of the entries are replaced as well, 
+            and timestamps are left as they are.
+        """
+        entries_table = Entry.__table__
+        tokens_table = EntryToken.__table__
+        drafts_table = Draft.__table__
+
+        entries = list(entries)
+        ids = [entry_id for entry_id, _, _, _ in entries]
+
+        with self.engine.begin() as conn:
+            if entries:
+                conn.execute(entries_table.update().where(entries_table.c.id == bindparam('entry_id'))
+                                                   .values(text=bindparam('new_text')),
+                             [{'entry_id': entry_id, 'new_text': self.pack(txt)} for entry_id, txt, _, _ in entries])
+                conn.execute(tokens_table.delete().where(tokens_table.c.entry_id.in_(ids)))
+
+                token_rows = [{'entry_id': entry_id, 'token': token} 
+                              for entry_id, _, tokens, _ in entries for token in tokens]
+
+                if token_rows:
+                    conn.execute(tokens_table.insert(), token_rows)
+
+                for entry_id, _, _, tags in entries:
+                    store_tags(conn, entry_id, tags)
+
+            for name, txt in drafts:
+                conn.execute(drafts_table.update().where(drafts_table.c.name == name)
+                                                  .values(text=self.pack(txt)))
+
+            revisions = [{'revision_id': revision_id, 'new_text': self.pack(txt)} for revision_id, txt in revisions]
+
+            if revisions:
+                conn.execute(REVISIONS.update().where(REVISIONS.c.id == bindparam('revision_id'))
+                                               .values(text=bindparam('new_text')), revisions)
+
+        self.emit('update', ids)
+
+    def queue_entry(self, txt, tokens=None, stats=None, tags=None, timestamp=None):
+        """
+            Queue a new entry to be written by the background writer,
+            see new_entry.
+        """
+        self.queue_write('insert', None, (txt, tokens, stats, tags, timestamp or datetime.now()))
+
+    def queue_update(self, id, txt, tokens=None, stats=None, tags=None, revision=None):
+        """
+            Queue an update of an entry, see update_entry.
+        """
+        self.queue_write('update', id, (txt, tokens, stats, tags, revision))
+
+    def queue_draft(self, name, txt):
+        """
+            Queue saving the text of a draft.
+        """
+        self.queue_write('draft', name, (txt, datetime.now()))
+
+    def queue_remove_draft(self, name):
+        self.queue_write('remove_draft', name, None)
+
+    def queue_write(self, op, key, value):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop, name='mdiary-writer', daemon=True)
+            self.writer.start()
+
+        # The newest queued update of every entry and draft, see get_queued
+        if op != 'insert':
+            with self.queued_lock:
+                self.queued[QUEUED_KEYS[op], key] = (op, value)
+
+        self.writes.put((op, key, value))
+
+    def get_queued(self, op, key):
+        """
+            Returns the value of the newest queued op of an entry or 
+            draft if it is that op and not stored yet, otherwise None.
+            The value of a queued 'remove_draft' is True.
+        """
+        with self.queued_lock:
+            queued = self.queued.get((QUEUED_KEYS[op], key))
+
+        if queued is None or queued[0] != op:
+            return None
+
+        return queued[1] if queued[1] is not None else True
+
+    def unqueue(self, ops):
+        # Forget the stored ops, unless they were queued again meanwhile
+        with self.queued_lock:
+            for op, key, value in ops:
+                queued = self.queued.get((QUEUED_KEYS.get(op), key))
+
+                if queued is not None and queued[0] == op and queued[1] is value:
+                    del self.queued[QUEUED_KEYS[op], key]
+
+    def write_loop(self):
+        """
+            Runs in the background writer thread, writing all queued
+            operations that are pending in a single transaction.
+        """
+        while True:
+            ops = [self.writes.get()]
+
+            while True:
+                try:
+                    ops.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.write(op for op in ops if op is not None)
+            except Exception as error:
+                self.write_error = error
+            finally:
+                self.unqueue(op for op in ops if op is not None)
+
+                for _ in ops:
+                    self.writes.task_done()
+
+            if None in ops:
+                return
+
+    @traced('db.write')
+    def write(self, ops):
+        """
+            Write a group of queued operations in one transaction, where
+            successive updates of the same entry or draft are coalesced.
+        """
+        entries = Entry.__table__
+        tokens_table = EntryToken.__table__
+        stats_table = EntryStat.__table__
+        drafts = Draft.__table__
+
+        inserts = []
+        updates = OrderedDict()
+        draft_ops = OrderedDict()
+        inserted = []
+
+        for op, key, value in ops:
+            if op == 'insert':
+                inserts.append(value)
+            elif op == 'update':
+                updates[key] = value
+            else:
+                draft_ops.pop(key, None)
+                draft_ops[key] = (op, value)
+
+        with self.engine.begin() as conn:
+            for txt, tokens, stats, tags, timestamp in inserts:
+                result = conn.execute(entries.insert().values(text=self.pack(txt), timestamp=timestamp))
+                entry_id = result.inserted_primary_key[0]
+                inserted.append(entry_id)
+
+                if tokens:
+                    conn.execute(tokens_table.insert(), [{'entry_id': entry_id, 'token': token} 
+                                                         for token in tokens])
+
+                stats = entry_stats(txt, stats)
+
+                if stats:
+                    conn.execute(stats_table.insert(), stats_row(entry_id, timestamp, stats))
+
+                tags = tag_keys(txt, tags)
+
+                if tags:
+                    store_tags(conn, entry_id, tags)
+
+            for entry_id, (txt, tokens, stats, tags, revision) in updates.items():
+                if revision is not None:
+                    store_revision(conn, entry_id, revision, self.pack)
+
+                conn.execute(entries.update().where(entries.c.id == entry_id).values(text=self.pack(txt)))
+
+                stats = entry_stats(txt, stats)
+
+                if stats:
+                    conn.execute(stats_table.update().where(stats_table.c.entry_id == entry_id)
+                                                     .values(words=stats[0], chars=stats[1]))
+
+                tags = tag_keys(txt, tags)
+
+                if tags is not None:
+                    store_tags(conn, entry_id, tags)
+
+                if tokens is not None:
+                    conn.execute(tokens_table.delete().where(tokens_table.c.entry_id == entry_id))
+                    if tokens:
+                        conn.execute(tokens_table.insert(), [{'entry_id': entry_id, 'token': token} 
+                                                             for token in tokens])
+
+            for name, (op, value) in draft_ops.items():
+                conn.execute(drafts.delete().where(drafts.c.name == name))
+
+                if op == 'draft':
+                    txt, timestamp = value
+                    conn.execute(drafts.insert().values(name=name, text=self.pack(txt), timestamp=timestamp))
+
+        self.emit('insert', inserted)
+        self.emit('update', list(updates))
+
+    def add_listener(self, listener):
+        """
+            Call listener(change, entry_ids) after entries are stored, where
+            change is 'insert', 'update' or 'delete'. Listeners are called
+            from the thread writing the change, which is the background 
+            writer for queued writes.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def emit(self, change, entry_ids):
+        if entry_ids:
+            for listener in list(self.listeners):
+                listener(change, entry_ids)
+
+    def pack(self, txt):
+        """
+            Returns the payload of a text, compressed with the codec
+            of the diary. Encrypted payloads are returned as they are.
+        """
+        return pack(txt, self.codec)
+
+    def get_payload_version(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text('PRAGMA user_version')).scalar()
+
+    def set_payload_version(self, version):
+        with self.engine.connect() as conn:
+            conn.execute(text('PRAGMA user_version = {:d}'.format(version)))
+
+    @traced('db.migrate_payloads')
+    def migrate_payloads(self, convert, stop=None, batch=MIGRATE_BATCH):
+        """
+            Rewrite the entries written by older versions in the current
+            payload format, where convert returns the new payload of an
+            old value. Every batch is written in a short transaction of
+            its own, skipping entries that changed in the meantime, such
+            that this can run in the background while the diary is used.
+            Stops early when the threading.Event stop is set. Returns the
+            number of rewritten entries.
+        """
+        if self.get_payload_version() >= PAYLOAD_VERSION:
+            return 0
+
+        count = 0
+        after = 0
+
+        while not (stop and stop.is_set()):
+            with self.engine.connect() as conn:
+                rows = conn.execute(LEGACY_QUERY, after=after, limit=batch).fetchall()
+
+            if not rows:
+                self.set_payload_version(PAYLOAD_VERSION)
+                break
+
+            updates = [{'id': entry_id, 'old': value, 'new': convert(value)} 
+                       for entry_id, value in rows if is_legacy(value)]
+
+            if updates:
+                with self.engine.begin() as conn:
+                    conn.execute(MIGRATE_UPDATE, updates)
+
+            count += len(updates)
+            after = rows[-1][0]
+
+        return count
+
+    def vacuum(self):
+        """
+            Rebuild the database file, returning the space freed by
+            compressed entries to the file system.
+        """
+        self.session.close()
+
+        with self.engine.connect() as conn:
+            conn.execute(text('VACUUM'))
+            conn.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+
+    @traced('db.flush')
+    def flush(self):
+        """
+            Wait until all queued writes are stored, such that the 
+            session reads them. Raises the error of a failed write.
+        """
+        if self.writer is None:
+            return
+
+        self.writes.join()
+        self.session.expire_all()
+
+        if self.write_error:
+            error, self.write_error = self.write_error, None
+            raise error
+
     def close(self):
-        self.session.close()
\ No newline at end of file
+        """
+            Store the queued writes, stop the writer and close the session
+            and connections, checkpointing the write-ahead log. Raises the
+            error of a failed write, like flush.
+        """
+        if self.writer is not None:
+            self.writes.put(None)
+            self.writer.join()
+            self.writer = None
+
+        self.session.remove()
+        self.engine.dispose()
+
+        if self.write_error:
+            error, self.write_error = self.write_error, None
+            raise error
\ No newline at end of file
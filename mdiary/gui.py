@@ -1,11 +1,14 @@
-import sys
-from configparser import ConfigParser
-import argparse
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import datetime, timedelta
 from pathlib import Path
 import urwid
-from cryptography.fernet import Fernet, InvalidToken
-from passlib.hash import pbkdf2_sha256
-from mdiary.database import DBHandler
+from mdiary.core import DiaryCore
+from mdiary.database import PAGE_SIZE
+from mdiary.search import period_range, snippet_markup
+from mdiary.trace import TRACER, traced
 
 PALETTE = [
     ('edit_body', 'black', 'light green'),
@@ -13,13 +16,26 @@ PALETTE = [
     ('footer', 'white', 'black', 'bold'),
     ('header', 'white', 'black', 'bold'),
     ('container', 'white', 'black'),
-    ('button', 'white', 'black')
+    ('button', 'white', 'black'),
+    ('highlight', 'black', 'yellow')
 ]
 
+AUTOSAVE_INTERVAL = 5 # seconds
+WIDGET_CACHE = 2 * PAGE_SIZE
+PREFETCH_DISTANCE = PAGE_SIZE // 2
+LOADING = 'loading'
+ROW_CACHE = 4 * PAGE_SIZE
+PREVIEW_LINES = 20
+PREVIEW_CHARS = 2000
+CHUNK_LINES = 40
+CHUNK_CHARS = 4000
+CHUNK_CACHE = 16
+
 class BaseView(urwid.WidgetWrap):
     def __init__(self, controller):
         self.controller = controller
-        urwid.WidgetWrap.__init__(self, self.window())
+        self.body = self.window()
+        urwid.WidgetWrap.__init__(self, self.body)
 
     def window(self):
         pass
@@ -30,6 +46,54 @@ class BaseView(urwid.WidgetWrap):
     def on_quit(self, button):
         self.quit_program()
 
+    def on_hide(self):
+        """
+            Called when another view is shown, cancels background work.
+        """
+        pass
+
+    def on_changed(self, change, entry_ids):
+        """
+            Called while the view is shown when queued writes changed
+            entries, see Diary.on_stored.
+        """
+        pass
+
+    def show_error(self, message):
+        """
+            Show the error message of failed background work in a footer
+            below the view, or remove the footer if message is None.
+        """
+        if message is None:
+            self._w = self.body
+        else:
+            self._w = urwid.Frame(self.body, footer=urwid.AttrMap(urwid.Text(message, align='center'), 'footer'))
+
+class DraftMixin():
+    """
+        Autosaves the text of the edit_field of a view as a draft,
+        under the name returned by draft_name.
+    """
+    saved_text = u''
+
+    def draft_name(self):
+        pass
+
+    def autosave(self):
+        txt = self.edit_field.get_edit_text()
+
+        if txt != self.saved_text:
+            if txt:
+                self.controller.save_draft(self.draft_name(), txt)
+            else:
+                self.controller.discard_draft(self.draft_name())
+
+            self.saved_text = txt
+
+    def discard_draft(self):
+        self.controller.discard_draft(self.draft_name())
+        self.saved_text = u''
+
 class InitView(BaseView):
     """
         Class responsible for providing the initialization window.
@@ -122,6 +186,12 @@ class MenuView(BaseView):
                           align='center', width=('relative', 50)),
             urwid.Padding(urwid.Button(('button', u'View entries'), self.on_to_reader), 
                           align='center', width=('relative', 50)),
+            urwid.Padding(urwid.Button(('button', u'Search entries'), self.on_to_search), 
+                          align='center', width=('relative', 50)),
+            urwid.Padding(urwid.Button(('button', u'Writing statistics'), self.on_to_summary), 
+                          align='center', width=('relative', 50)),
+            urwid.Padding(urwid.Button(('button', u'Statistics'), self.on_to_stats), 
+                          align='center', width=('relative', 50)),
             urwid.Padding(urwid.Button(('button', u'Quit'), self.on_quit), 
                            align='center', width=('relative', 50)),
             div
@@ -137,9 +207,19 @@ class MenuView(BaseView):
         self.controller.set_view('writer')
 
     def on_to_reader(self, button):
+        self.controller.get_view('reader').show_range()
         self.controller.set_view('reader')
 
-class WriterView(BaseView):
+    def on_to_search(self, button):
+        self.controller.set_view('search')
+
+    def on_to_summary(self, button):
+        self.controller.set_view('summary')
+
+    def on_to_stats(self, button):
+        self.controller.set_view('stats')
+
+class WriterView(DraftMixin, BaseView):
     """
         Class responsible for providing the application 
         window handling the creation of new entries.
@@ -177,13 +257,24 @@ class WriterView(BaseView):
 
         return view
 
+    def draft_name(self):
+        return 'new'
+
+    def restore_draft(self):
+        """
+            Continue with the autosaved text of an unsaved entry.
+        """
+        draft = self.controller.load_draft(self.draft_name())
+
+        if draft and not self.edit_field.get_edit_text():
+            self.edit_field.set_edit_text(draft)
+            self.saved_text = draft
+
     def on_save(self, button):
         txt = self.edit_field.get_text()[0]
-
-        if self.controller.is_using_key():
-            txt = self.controller.encrypt_entry(txt)
-        
-        self.controller.db_handler.new_entry(txt)
+        self.edit_field.set_edit_text(u'')
+        self.controller.add_entry(txt)
+        self.discard_draft()
         self.quit_program()
     
     def on_to_menu(self, button):
@@ -192,19 +283,17 @@ class WriterView(BaseView):
     def on_append(self, button):
         txt = self.edit_field.get_text()[0]
         self.edit_field.set_edit_text(u'')
+        self.controller.add_entry(txt)
+        self.discard_draft()
 
-        if self.controller.is_using_key():
-            txt = self.controller.encrypt_entry(txt)
-
-        self.controller.db_handler.new_entry(txt)
-
-class EditView(BaseView):
+class EditView(DraftMixin, BaseView):
     """
         Class responsible for providing the application 
         window handling the creation of new entries.
     """
     def __init__(self, controller):
         self.id = None
+        self.back = 'reader'
         super().__init__(controller)
 
     def window(self):
@@ -224,6 +313,8 @@ class EditView(BaseView):
             urwid.Columns([
                 urwid.Padding(urwid.Button(('button', u'Save changes'), self.on_save),
                             align='center', width=('relative', 80)),
+                urwid.Padding(urwid.Button(('button', u'History'), self.on_history),
+                            align='center', width=('relative', 80)),
                 urwid.Padding(urwid.Button(('button', u'Cancel'), self.on_cancel), 
                             align='center', width=('relative', 80)),
                 urwid.Padding(urwid.Button(('button', u'Quit'), self.on_quit), 
@@ -237,35 +328,505 @@ class EditView(BaseView):
 
         return view
 
-    def set_state(self, id):
+    def draft_name(self):
+        return 'edit-{}'.format(self.id)
+
+    def set_state(self, id, back='reader'):
         self.id = id
+        self.back = back
 
         entry = self.controller.db_handler.get_entry(self.id)
         entry_text = entry.entry_text
 
         if self.controller.is_using_key():
-            entry_text = self.controller.decrypt_entry(entry_text)
+            entry_text = self.controller.decrypt_entry(entry_text, self.id)
 
-        self.edit_field.edit_text = entry_text
         info = u'Editting entry {}. Originally created on {}-{}-{}.'.format(self.id, entry.timestamp.year,
                                                                             entry.timestamp.month,
                                                                             entry.timestamp.day)
-        self.edit_info.set_text(info)
+        draft = self.controller.load_draft(self.draft_name())
+
+        if draft is not None:
+            entry_text = draft
+            info += u' Restored your unsaved changes.'
 
+        # The text which needs no draft, see DraftMixin.autosave
+        self.edit_field.edit_text = entry_text
+        self.saved_text = entry_text
+        self.edit_info.set_text(info)
 
     def on_save(self, button):
         if self.id:
             txt = self.edit_field.get_text()[0]
+            self.controller.update_entry(self.id, txt)
+            self.discard_draft()
 
-            if self.controller.is_using_key():
-                txt = self.controller.encrypt_entry(txt)
+        # Leaves nothing to autosave when the view is hidden
+        self.edit_field.set_edit_text(u'')
+        self.controller.set_view(self.back)
 
-            self.controller.db_handler.update_entry(self.id, txt)
+    def on_cancel(self, button):
+        self.discard_draft()
+        self.edit_field.set_edit_text(u'')
+        self.controller.set_view(self.back)
 
-        self.controller.set_view('reader')
+    def on_history(self, button):
+        self.controller.get_view('history').set_state(self.id)
+        self.controller.set_view('history')
 
-    def on_cancel(self, button):
-        self.controller.set_view('reader')
+    def restore(self, revision):
+        """
+            Show the entry after a revision was restored (see 
+            DiaryCore.restore_revision), discarding the draft.
+        """
+        self.discard_draft()
+        self.set_state(self.id, self.back)
+        self.edit_info.set_text(u'Restored revision {} of entry {}.'.format(revision, self.id))
+
+def key_order(key):
+    """
+        Sort key of the positions of an EntryWalker.
+    """
+    if key == 'head':
+        return (0,)
+    if key == 'tail':
+        return (2,)
+
+    return (1,) + tuple(key)
+
+def preview(txt, lines=PREVIEW_LINES, chars=PREVIEW_CHARS):
+    """
+        Returns the first lines (at most chars characters) of a text
+        and the number of lines left out, without splitting all of it.
+    """
+    end = -1
+
+    for _ in range(lines):
+        end = txt.find('\n', end + 1, chars)
+
+        if end == -1:
+            break
+
+    if end == -1:
+        if len(txt) <= chars:
+            return txt, 0
+
+        end = rest = chars
+    else:
+        rest = end + 1
+
+    return txt[:end], txt.count('\n', rest) + (len(txt) > rest and not txt.endswith('\n'))
+
+def split_chunks(txt, lines=CHUNK_LINES, chars=CHUNK_CHARS):
+    """
+        Split a text in chunks of at most lines lines and (about) chars
+        characters, where overly long lines are split at a space.
+    """
+    chunks = []
+    chunk = []
+    size = 0
+
+    for line in txt.split('\n'):
+        while len(line) > chars:
+            cut = line.rfind(' ', 0, chars) + 1 or chars
+            chunks.append('\n'.join(chunk + [line[:cut]]))
+            chunk, size, line = [], 0, line[cut:]
+
+        if chunk and (len(chunk) >= lines or size + len(line) > chars):
+            chunks.append('\n'.join(chunk))
+            chunk, size = [], 0
+
+        chunk.append(line)
+        size += len(line) + 1
+
+    chunks.append('\n'.join(chunk))
+
+    return chunks
+
+class EntryWalker(urwid.ListWalker):
+    """
+        List walker which pages the diary entries in from the database
+        on demand. Positions are either 'head', 'tail' or the (timestamp, id)
+        key of an entry. Only the rows and widgets near the focus are kept,
+        the least recently used ones are evicted. Changes to the entries are
+        collected from the DBHandler and patched in by apply_changes.
+
+        When the diary runs its event loop, pages are fetched (and decrypted)
+        in the background ahead of the focus. A page which is not there yet
+        is shown as the 'loading' position until it arrives.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.start = None
+        self.end = None
+        self.tag = None
+        self.db_handler = None
+        self.changes = deque()
+        self.pending = {}
+        self.focus = 'head'
+        self.loading_after = None
+        self.reset()
+
+    def listen(self, db_handler):
+        """
+            Collect the changes to the entries of db_handler.
+        """
+        if db_handler is not self.db_handler:
+            if self.db_handler:
+                self.db_handler.remove_listener(self.on_change)
+
+            db_handler.add_listener(self.on_change)
+            self.db_handler = db_handler
+            self.changes.clear()
+            self.reset()
+
+    def on_change(self, change, entry_ids):
+        # Called from the writer thread, the changes are applied by the UI
+        self.changes.append((change, entry_ids))
+        self.view.controller.call_in_loop(self.view.on_stored)
+
+    @traced('reader.apply_changes')
+    def apply_changes(self):
+        """
+            Patch the changed entries into the walker, keeping the loaded 
+            entries and the focus. Updated entries are reloaded when they 
+            are shown, inserted entries are linked in when their neighbours 
+            are loaded.
+        """
+        while self.changes:
+            change, entry_ids = self.changes.popleft()
+
+            if change == 'insert' and len(entry_ids) > PAGE_SIZE:
+                self.reset()
+                continue
+
+            for entry_id in entry_ids:
+                if change == 'delete':
+                    self.remove(entry_id)
+                elif change == 'update':
+                    self.invalidate(entry_id)
+                else:
+                    self.insert(entry_id)
+
+        self._modified()
+
+    def set_range(self, start=None, end=None, tag=None):
+        """
+            Only walk over the entries written between start and end,
+            having the tag key tag if given.
+        """
+        self.start = start
+        self.end = end
+        self.tag = tag
+        self.reset()
+
+    def reset(self):
+        """
+            Forget all loaded entries and move the focus back to the top.
+        """
+        self.cancel()
+        self.focus = 'head'
+        self.rows = OrderedDict()
+        self.widgets = OrderedDict()
+        self.next_keys = {}
+        self.prev_keys = {}
+        self._modified()
+
+    def get_focus(self):
+        return self.get_widget(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        if position in ('tail', LOADING):
+            return None, None
+
+        if position not in self.next_keys:
+            after = None if position == 'head' else position
+
+            if self.view.controller.background:
+                self.prefetch(after=after)
+                self.loading_after = position
+                return self.view.loading, LOADING
+
+            self.load(after=after)
+        
+        key = self.next_keys.get(position, 'tail')
+        self.prefetch_around(key)
+
+        return self.get_widget(key), key
+    
+    def get_prev(self, position):
+        if position == 'head':
+            return None, None
+
+        if position == LOADING:
+            return self.get_widget(self.loading_after), self.loading_after
+
+        if position not in self.prev_keys:
+            self.load(before=position)
+
+        key = self.prev_keys.get(position, 'head')
+        self.prefetch_around(key)
+
+        return self.get_widget(key), key
+
+    def positions(self, reverse=False):
+        """
+            Iterate over the positions from the top (or from the bottom),
+            loading the entries as they are reached. The list box only takes
+            the first one, to move the focus there on home and end.
+        """
+        position = 'tail' if reverse else 'head'
+
+        while position is not None:
+            yield position
+            _, position = self.get_prev(position) if reverse else self.get_next(position)
+
+    def prefetch_around(self, key):
+        """
+            Fetch the pages in the background which are missing within
+            PREFETCH_DISTANCE entries after or before key.
+        """
+        if not self.view.controller.background:
+            return
+
+        for links, end, direction in ((self.next_keys, 'tail', 'after'), (self.prev_keys, 'head', 'before')):
+            position = key
+
+            for _ in range(PREFETCH_DISTANCE):
+                if position == end:
+                    break
+
+                if position not in links:
+                    if direction == 'after':
+                        self.prefetch(after=None if position == 'head' else position)
+                    else:
+                        self.prefetch(before=position)
+                    break
+
+                position = links[position]
+
+    def prefetch(self, after=None, before=None):
+        """
+            Fetch a page in the background and link it in once it arrives, 
+            see load.
+        """
+        task = ('after', after) if before is None else ('before', before)
+
+        if task not in self.pending:
+            self.pending[task] = self.view.controller.run_background(
+                self.fetch, partial(self.on_fetched, task, after, before), after, before)
+
+    def on_fetched(self, task, after, before, rows):
+        self.pending.pop(task, None)
+        self.link(after, before, rows)
+
+        if self.focus == LOADING:
+            self.focus = self.next_keys.get(self.loading_after, 'tail')
+
+        self._modified()
+
+    def cancel(self):
+        """
+            Cancel the pages which are being fetched, e.g. when the
+            reader is left.
+        """
+        for future in self.pending.values():
+            if future is not None:
+                future.cancel()
+
+        self.pending = {}
+
+        if self.focus == LOADING:
+            self.focus = self.loading_after
+
+    @traced('reader.fetch')
+    def fetch(self, after=None, before=None):
+        """
+            Returns a page of rows adjacent to a key, where before may be 
+            'tail' to fetch the last page. The entries of encrypted diaries
+            are decrypted into the cache of the cipher. Runs in the background 
+            when prefetching, so it must not touch any widgets.
+        """
+        controller = self.view.controller
+        last = before == 'tail'
+        rows = controller.db_handler.get_page(after=after, before=None if last else before, 
+                                              start=self.start, end=self.end, last=last, tag=self.tag)
+
+        if controller.is_using_key():
+            for _ in controller.decrypt_entries((row.entry_id, row.entry_text) for row in rows):
+                pass
+
+        return rows
+
+    def load(self, after=None, before=None):
+        """
+            Fetch a page of entries adjacent to a key and link them together.
+        """
+        self.link(after, before, self.fetch(after, before))
+
+    def link(self, after, before, rows):
+        db_handler = self.view.controller.db_handler
+        keys = [db_handler.entry_key(row) for row in rows]
+
+        if before is None:
+            chain = [after or 'head'] + keys
+
+            if len(rows) < PAGE_SIZE:
+                chain.append('tail')
+        else:
+            chain = keys + [before]
+
+            if len(rows) < PAGE_SIZE:
+                chain.insert(0, 'head')
+
+        for prev_key, next_key in zip(chain, chain[1:]):
+            self.next_keys[prev_key] = next_key
+            self.prev_keys[next_key] = prev_key
+
+        for key, row in zip(keys, rows):
+            self.rows[key] = row
+
+        self.evict()
+
+    def jump(self, date):
+        """
+            Load the entries from a datetime on, returns the key of the
+            first entry written at or after date ('tail' if there is none).
+        """
+        anchor = (date, 0)
+        self.load(after=anchor)
+
+        key = self.next_keys.pop(anchor, 'tail')
+        if self.prev_keys.get(key) == anchor:
+            del self.prev_keys[key]
+
+        return key
+
+    @traced('reader.get_widget')
+    def get_widget(self, key):
+        if key == 'head':
+            return self.view.head
+        if key == 'tail':
+            return self.view.tail
+        
+        if key in self.widgets:
+            self.widgets.move_to_end(key)
+            return self.widgets[key]
+        
+        row = self.rows.get(key)
+
+        if row is None:
+            row = self.view.controller.db_handler.get_entry(key[1])
+            self.rows[key] = row
+        else:
+            self.rows.move_to_end(key)
+        
+        entry_id, timestamp, entry_text = row
+
+        if self.view.controller.is_using_key():
+            entry_text = self.view.controller.decrypt_entry(entry_text, entry_id)
+
+        widget = urwid.Pile([self.view.gen_entry(entry_id, timestamp, entry_text), urwid.Divider()])
+        self.widgets[key] = widget
+        self.evict()
+
+        return widget
+
+    def evict(self):
+        """
+            Drop the least recently used rows and widgets, except for the focus.
+        """
+        while len(self.widgets) > WIDGET_CACHE:
+            key = next(iter(self.widgets))
+            if key == self.focus:
+                self.widgets.move_to_end(key)
+                continue
+            del self.widgets[key]
+
+        while len(self.rows) > ROW_CACHE:
+            key = next(iter(self.rows))
+            if key == self.focus:
+                self.rows.move_to_end(key)
+                continue
+            del self.rows[key]
+            self.widgets.pop(key, None)
+            self.unlink(key)
+    
+    def unlink(self, key):
+        next_key = self.next_keys.pop(key, None)
+        prev_key = self.prev_keys.pop(key, None)
+
+        if next_key is not None and self.prev_keys.get(next_key) == key:
+            del self.prev_keys[next_key]
+        if prev_key is not None and self.next_keys.get(prev_key) == key:
+            del self.next_keys[prev_key]
+
+    def remove(self, entry_id):
+        """
+            Remove the entry with the given id from the walker, 
+            moving the focus to one of its neighbours.
+        """
+        key = self.find_key(entry_id)
+
+        if key is None:
+            return
+
+        next_key = self.next_keys.get(key)
+        prev_key = self.prev_keys.get(key)
+
+        self.rows.pop(key, None)
+        self.widgets.pop(key, None)
+        self.unlink(key)
+
+        if next_key is not None and prev_key is not None:
+            self.next_keys[prev_key] = next_key
+            self.prev_keys[next_key] = prev_key
+
+        if self.focus == key:
+            self.focus = next_key or prev_key or 'head'
+        
+        self._modified()
+
+    def invalidate(self, entry_id):
+        """
+            Drop the row and widget of an entry, such that it is reloaded.
+        """
+        key = self.find_key(entry_id)
+
+        if key is not None:
+            self.rows.pop(key, None)
+            self.widgets.pop(key, None)
+
+    def insert(self, entry_id):
+        """
+            Break the link between the loaded neighbours of a new entry,
+            such that the entries between them are loaded again.
+        """
+        row = self.db_handler.get_entry(entry_id)
+
+        if row is None:
+            return
+
+        key = self.db_handler.entry_key(row)
+
+        for prev_key, next_key in list(self.next_keys.items()):
+            if key_order(prev_key) < key_order(key) < key_order(next_key):
+                del self.next_keys[prev_key]
+                self.prev_keys.pop(next_key, None)
+
+    def find_key(self, entry_id):
+        if self.focus not in ('head', 'tail') and self.focus[1] == entry_id:
+            return self.focus
+
+        for key in self.rows:
+            if key[1] == entry_id:
+                return key
+
+        return None
 
 class ReaderView(BaseView):
     """
@@ -276,9 +837,12 @@ class ReaderView(BaseView):
         super().__init__(controller)
 
     def window(self):
-        listbox_content = []
-        
-        self.walker = urwid.SimpleFocusListWalker(listbox_content)
+        self.head = self.gen_controls(navigation=True)
+        self.tail = self.gen_controls()
+        self.loading = urwid.Padding(urwid.Text(u'Loading entries...', align='center'), 
+                                     align='center', width=('relative', 80))
+        self.count_task = None
+        self.walker = EntryWalker(self)
         self.listbox = urwid.ListBox(self.walker)
 
         view = urwid.AttrMap(self.listbox, 'body')
@@ -286,25 +850,33 @@ class ReaderView(BaseView):
 
         return view
 
+    @traced('reader.gen_entry')
     def gen_entry(self, id, date, txt):
         """
             Returns a listbox containing the information about diary entries.
+            Long entries are cut short, the whole entry is shown by the
+            EntryView, see preview.
         """
         div = urwid.Divider()
         div_bar = urwid.Divider('-')
 
+        txt, omitted = preview(txt)
+        buttons = [(u'Delete entry', self.on_delete), (u'Update entry', self.on_update)]
+
+        if omitted:
+            txt += u'\n\n... ({} more lines)'.format(omitted)
+            buttons.insert(0, (u'Read entry', self.on_read))
+
+        buttons = [urwid.Padding(urwid.Button(label, callback, id), align='center', 
+                                 width=('relative', 80 if omitted else 40)) for label, callback in buttons]
+
         pile = urwid.Pile([
             div,
             urwid.Padding(urwid.Text(txt), align='center', width=('relative', 90)),
             div,
             div_bar,
             div,
-            urwid.Columns([
-                urwid.Padding(urwid.Button(u'Delete entry', self.on_delete, id),
-                              align='center', width=('relative', 40)),
-                urwid.Padding(urwid.Button(u'Update entry', self.on_update, id),
-                              align='center', width=('relative', 40))
-            ]),
+            urwid.Columns(buttons),
             div,
         ])
         
@@ -320,11 +892,13 @@ class ReaderView(BaseView):
 
     def on_delete(self, button, id):
         self.controller.db_handler.remove_entry(id)
+        self.walker.apply_changes()
 
-        _, index = self.listbox.get_focus()
-        del self.walker[index:index+2] # Update the view and delete a divider
-    
-    def update_reader(self):
+    def gen_controls(self, navigation=False):
+        """
+            Returns the menu and quit buttons shown above and below the entries,
+            with navigation set the date navigation is added to them.
+        """
         div = urwid.Divider()
 
         menu_btn = urwid.Button(u'To menu', self.on_to_menu)
@@ -335,213 +909,837 @@ class ReaderView(BaseView):
             urwid.Padding(quit_btn, align='center', width=('relative', 50))
         ])
 
-        lb_content = [col, div]
+        if not navigation:
+            return urwid.Pile([col, div])
+
+        self.date_edit = urwid.Edit(u'Date (YYYY, YYYY-MM or YYYY-MM-DD) or #tag: ')
+        self.range_info = urwid.Text(u'')
+
+        nav = urwid.Columns([
+            urwid.Padding(urwid.Button(u'Jump to date', self.on_jump), align='center', width=('relative', 80)),
+            urwid.Padding(urwid.Button(u'Show period', self.on_show_period), align='center', width=('relative', 80)),
+            urwid.Padding(urwid.Button(u'Last week', self.on_last_week), align='center', width=('relative', 80)),
+            urwid.Padding(urwid.Button(u'Show all', self.on_show_all), align='center', width=('relative', 80)),
+            urwid.Padding(urwid.Button(u'Calendar', self.on_to_calendar), align='center', width=('relative', 80))
+        ])
+
+        return urwid.Pile([
+            col, 
+            div,
+            urwid.Padding(urwid.AttrMap(self.date_edit, 'edit_body'), align='center', width=('relative', 90)),
+            nav,
+            urwid.Padding(self.range_info, align='center', width=('relative', 90)),
+            div
+        ])
+
+    def get_date(self):
+        """
+            Returns the (start, end) of the period entered in the date field,
+            or None if it is not a valid date.
+        """
+        try:
+            return period_range(self.date_edit.get_edit_text().strip())
+        except ValueError:
+            self.range_info.set_text(u'Enter a date as YYYY, YYYY-MM or YYYY-MM-DD.')
+            return None
+
+    def show_range(self, start=None, end=None, label=None, tag=None):
+        """
+            Only show the entries written between start and end, having
+            the tag key tag if given.
+        """
+        self.walker.set_range(start, end, tag)
+        self.range_info.set_text(u'Counting entries...')
+
+        if self.count_task:
+            self.count_task.cancel()
+
+        self.count_task = self.controller.run_background(self.controller.db_handler.count_range,
+                                                         partial(self.on_counted, label), start, end, tag)
+
+    def on_counted(self, label, count):
+        self.count_task = None
+
+        if label:
+            self.range_info.set_text(u'Showing the {} entries of {}.'.format(count, label))
+        else:
+            self.range_info.set_text(u'Showing all {} entries.'.format(count))
+
+    def show_period(self, value):
+        start, end = period_range(value)
+        self.show_range(start, end, label=value)
+
+    def show_tag(self, tag):
+        """
+            Only show the entries tagged with #tag.
+        """
+        key = self.controller.tag_key(tag)
+
+        if key is None:
+            self.range_info.set_text(u'Enter a tag as #tag.')
+            return
+
+        self.show_range(tag=key, label='#' + tag.lstrip('#').lower())
+
+    def on_jump(self, button):
+        period = self.get_date()
+
+        if period:
+            self.walker.reset()
+            key = self.walker.jump(period[0])
+            self.listbox.set_focus(key, coming_from='below')
+            self.range_info.set_text(u'Jumped to {}.'.format(self.date_edit.get_edit_text().strip()))
 
-        for entry in self.controller.db_handler.get_entries():
-            entry_text = entry['entry_text']
+    def on_show_period(self, button):
+        value = self.date_edit.get_edit_text().strip()
 
-            if self.controller.is_using_key():
-                entry_text = self.controller.decrypt_entry(entry_text)
+        if value.startswith('#'):
+            self.show_tag(value)
+        elif self.get_date():
+            self.show_period(value)
 
-            entry_box = self.gen_entry(entry['entry_id'], entry['timestamp'], entry_text)
-            lb_content += [entry_box, div]
+    def on_last_week(self, button):
+        self.show_range(datetime.now() - timedelta(days=7), None, label='the last week')
 
-        lb_content += [col]
+    def on_show_all(self, button):
+        self.show_range()
 
-        self.walker[:] = lb_content 
+    def on_to_calendar(self, button):
+        self.controller.set_view('calendar')
+
+    def show_error(self, message):
+        # The pages are fetched again when they are scrolled to
+        self.on_hide()
+        super().show_error(message)
+
+    def on_hide(self):
+        self.walker.cancel()
+
+        if self.count_task:
+            self.count_task.cancel()
+            self.count_task = None
+
+    def on_stored(self):
+        # Changes stored while the reader is hidden wait for update_reader
+        if self.controller.loop.widget is self:
+            self.walker.apply_changes()
+
+    @traced('reader.update_reader')
+    def update_reader(self):
+        """
+            Show the changes made since the reader was last shown, see 
+            EntryWalker.apply_changes.
+        """
+        self.walker.listen(self.controller.db_handler)
+        self.walker.apply_changes()
     
     def on_update(self, button, id):
-        self.controller.views['edit'].set_state(id)
+        self.controller.get_view('edit').set_state(id)
         self.controller.set_view('edit')
 
-class PatchedHelpFormatter(argparse.HelpFormatter):
-    def _split_lines(self, text, width):
+    def on_read(self, button, id):
+        self.controller.get_view('entry').set_state(id)
+        self.controller.set_view('entry')
+
+class ChunkWalker(urwid.ListWalker):
+    """
+        Walks over the chunks of a long text (see split_chunks) after 
+        a controls widget at position 0, creating the widgets of the 
+        chunks only when they are shown, such that urwid only lays out
+        the visible part of the text.
+    """
+    def __init__(self, controls, chunks=()):
+        self.controls = controls
+        self.chunks = list(chunks)
+        self.widgets = OrderedDict()
+        self.focus = 0
+
+    def set_chunks(self, chunks):
+        self.chunks = list(chunks)
+        self.widgets.clear()
+        self.focus = 0
+        self._modified()
+
+    def get_widget(self, position):
+        if position == 0:
+            return self.controls
+
+        if position in self.widgets:
+            self.widgets.move_to_end(position)
+            return self.widgets[position]
+
+        widget = urwid.Padding(urwid.Text(self.chunks[position - 1]), align='center', width=('relative', 90))
+        self.widgets[position] = widget
+
+        while len(self.widgets) > CHUNK_CACHE:
+            self.widgets.popitem(last=False)
+
+        return widget
+
+    def get_focus(self):
+        return self.get_widget(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        if position >= len(self.chunks):
+            return None, None
+
+        return self.get_widget(position + 1), position + 1
+
+    def get_prev(self, position):
+        if position <= 0:
+            return None, None
+
+        return self.get_widget(position - 1), position - 1
+
+class EntryView(BaseView):
+    """
+        Class responsible for providing the application window
+        showing a single (long) entry as a whole.
+    """
+    def __init__(self, controller):
+        self.id = None
+        self.back = 'reader'
+        super().__init__(controller)
+
+    def window(self):
+        div = urwid.Divider()
+
+        self.info = urwid.Text(u'', align='center')
+        controls = urwid.Pile([
+            div,
+            self.info,
+            div,
+            urwid.Columns([
+                urwid.Padding(urwid.Button(u'Back', self.on_back), align='center', width=('relative', 40)),
+                urwid.Padding(urwid.Button(u'Update entry', self.on_update), align='center', width=('relative', 40))
+            ]),
+            div
+        ])
+
+        self.walker = ChunkWalker(controls)
+        listbox = urwid.ListBox(self.walker)
+        view = urwid.AttrMap(listbox, 'body')
+        view = urwid.LineBox(view, title='mDiary: Entry')
+
+        return view
+
+    def set_state(self, id, back='reader'):
+        self.id = id
+        self.back = back
+
+        entry, entry_text = self.controller.get_entry_text(id)
+        date = entry.timestamp
+
+        self.info.set_text(u'Entry no. {} on {}-{}-{} ({}:{})'.format(id, date.year, date.month, date.day,
+                                                                        date.hour, date.minute))
+        self.walker.set_chunks(split_chunks(entry_text))
+
+    def on_changed(self, change, entry_ids):
+        if change == 'update' and self.id in entry_ids:
+            self.set_state(self.id, self.back)
+
+    def on_back(self, button):
+        self.controller.set_view(self.back)
+
+    def on_update(self, button):
+        self.controller.get_view('edit').set_state(self.id, back=self.back)
+        self.controller.set_view('edit')
+
+class HistoryView(BaseView):
+    """
+        Class responsible for providing the application window 
+        listing the revisions of an entry, where a revision can be 
+        read and restored.
+    """
+    def __init__(self, controller):
+        self.id = None
+        self.revision = None
+        self.task = None
+        super().__init__(controller)
+
+    def window(self):
+        div = urwid.Divider()
+
+        self.info = urwid.Text(u'', align='center')
+        self.revisions = urwid.Pile([])
+        self.selected = urwid.Pile([])
+        controls = urwid.Pile([
+            div,
+            self.info,
+            div,
+            urwid.Padding(urwid.Button(u'Back to the editor', self.on_back), align='center', width=('relative', 40)),
+            div,
+            self.revisions,
+            div,
+            self.selected
+        ])
+
+        self.walker = ChunkWalker(controls)
+        listbox = urwid.ListBox(self.walker)
+        view = urwid.AttrMap(listbox, 'body')
+        view = urwid.LineBox(view, title='mDiary: History')
+
+        return view
+
+    def set_state(self, id):
+        self.id = id
+        self.info.set_text(u'Loading the revisions of entry {}...'.format(id))
+        self.revisions.contents[:] = []
+        self.select()
+
+        if self.task:
+            self.task.cancel()
+
+        self.task = self.controller.run_background(self.controller.db_handler.get_revisions, 
+                                                   self.show_revisions, id)
+
+    def select(self, revision=None, txt=None):
+        """
+            Show the text of a revision below the list, or nothing.
+        """
+        self.revision = revision
+        self.selected.contents[:] = []
+        self.walker.set_chunks(split_chunks(txt) if txt else [])
+
+        if revision is not None:
+            widgets = [
+                urwid.Text(u'Revision {}:'.format(revision), align='center'),
+                urwid.Padding(urwid.Button(u'Restore this revision', self.on_restore), 
+                              align='center', width=('relative', 40)),
+                urwid.Divider()
+            ]
+            self.selected.contents[:] = [(widget, self.selected.options()) for widget in widgets]
+
+    def on_hide(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def on_changed(self, change, entry_ids):
+        # Lists the revision kept by a stored update
+        if change == 'update' and self.id in entry_ids:
+            self.set_state(self.id)
+
+    def show_revisions(self, revisions):
+        self.task = None
+
+        if not revisions:
+            self.info.set_text(u'Entry {} has not been changed yet.'.format(self.id))
+            return
+
+        self.info.set_text(u'Entry {} has {} revisions, select one to read it.'.format(self.id, len(revisions)))
+        buttons = [urwid.Button(u'Revision {}, replaced on {}-{}-{} ({}:{:02})'.format(
+                                revision, date.year, date.month, date.day, date.hour, date.minute),
+                                self.on_show_revision, revision)
+                   for revision, date in revisions]
+        self.revisions.contents[:] = [(urwid.Padding(button, align='center', width=('relative', 60)), 
+                                       self.revisions.options()) for button in buttons]
+
+    def on_show_revision(self, button, revision):
+        self.selected.contents[:] = [(urwid.Text(u'Loading revision {}...'.format(revision), align='center'),
+                                      self.selected.options())]
+
+        if self.task:
+            self.task.cancel()
+
+        self.task = self.controller.run_background(self.controller.revision_text, 
+                                                   partial(self.select, revision), self.id, revision)
+
+    def on_restore(self, button):
+        self.controller.restore_revision(self.id, self.revision)
+        self.controller.get_view('edit').restore(self.revision)
+        self.controller.set_view('edit')
+
+    def on_back(self, button):
+        self.controller.set_view('edit')
+
+class CalendarView(BaseView):
+    """
+        Class responsible for providing the application window
+        showing the number of entries per month.
+    """
+    def __init__(self, controller):
+        self.task = None
+        super().__init__(controller)
+
+    def window(self):
+        self.walker = urwid.SimpleFocusListWalker([])
+
+        listbox = urwid.ListBox(self.walker)
+        view = urwid.AttrMap(listbox, 'body')
+        view = urwid.LineBox(view, title='mDiary: Calendar')
+
+        return view
+
+    def update_calendar(self):
+        """
+            Count the entries per year and month in the background, showing
+            the calendar once they are counted.
+        """
+        self.walker[:] = [urwid.Text(u'Loading the calendar...', align='center')]
+
+        if self.task:
+            self.task.cancel()
+
+        self.task = self.controller.run_background(self.count_entries, self.show_calendar)
+
+    def count_entries(self):
+        db_handler = self.controller.db_handler
+        
+        return db_handler.count_by_period('year'), db_handler.count_by_period('month')
+
+    def on_hide(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def on_changed(self, change, entry_ids):
+        if change != 'update':
+            self.update_calendar()
+
+    def show_calendar(self, counts):
+        years, months = counts
+        self.task = None
+        div = urwid.Divider()
+
+        content = [
+            urwid.Columns([
+                urwid.Padding(urwid.Button(u'To entries', self.on_to_reader), align='center', width=('relative', 50)),
+                urwid.Padding(urwid.Button(u'To menu', self.on_to_menu), align='center', width=('relative', 50))
+            ]),
+            div
+        ]
+
+        for year, year_count in years:
+            buttons = [urwid.Button(u'{} ({})'.format(month[5:], count), self.on_show_period, month)
+                       for month, count in months if month[:4] == year]
+
+            content += [
+                urwid.Button(u'{} ({} entries)'.format(year, year_count), self.on_show_period, year),
+                urwid.Padding(urwid.GridFlow(buttons, 14, 2, 0, 'left'), left=4),
+                div
+            ]
+
+        self.walker[:] = content
+
+    def on_show_period(self, button, period):
+        self.controller.get_view('reader').show_period(period)
+        self.controller.set_view('reader')
+
+    def on_to_reader(self, button):
+        self.controller.set_view('reader')
+
+    def on_to_menu(self, button):
+        self.controller.set_view('menu')
+
+class SummaryView(BaseView):
+    """
+        Class responsible for providing the application window
+        showing the writing statistics of the diary, read from the
+        summary tables, see DiaryCore.summary.
+    """
+    def __init__(self, controller):
+        self.task = None
+        super().__init__(controller)
+
+    def window(self):
+        self.walker = urwid.SimpleFocusListWalker([])
+
+        listbox = urwid.ListBox(self.walker)
+        view = urwid.AttrMap(listbox, 'body')
+        view = urwid.LineBox(view, title='mDiary: Writing statistics')
+
+        return view
+
+    def update_summary(self):
+        self.walker[:] = [urwid.Text(u'Loading the statistics...', align='center')]
+
+        if self.task:
+            self.task.cancel()
+
+        self.task = self.controller.run_background(self.controller.summary, self.show_summary)
+
+    def on_hide(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def on_changed(self, change, entry_ids):
+        self.update_summary()
+
+    def show_summary(self, summary):
+        self.task = None
+        div = urwid.Divider()
+
+        content = [
+            urwid.Padding(urwid.Button(u'To menu', self.on_to_menu), align='center', width=('relative', 50)),
+            div
+        ]
+
+        if not summary['entries']:
+            content.append(urwid.Text(u'There are no entries yet.', align='center'))
+            self.walker[:] = content
+            return
+
+        first, last = summary['first'], summary['last']
+        lines = [
+            u'Entries: {entries}, written on {days} days'.format(**summary),
+            u'Words: {} ({:.0f} per entry)'.format(summary['words'], summary['words'] / summary['entries']),
+            u'Characters: {}'.format(summary['chars']),
+            u'First entry: {}-{}-{}, last entry: {}-{}-{}'.format(first.year, first.month, first.day,
+                                                                 last.year, last.month, last.day),
+            u'Current streak: {current_streak} days, longest streak: {longest_streak} days'.format(**summary),
+            u''
+        ]
+
+        row = u'{:<10} {:>8} {:>10} {:>12}'
+        lines.append(row.format(u'month', u'entries', u'words', u'characters'))
+        lines += [row.format(month, entries, words, chars) for month, entries, words, chars in summary['months']]
+
+        content += [urwid.Padding(urwid.Text(line), align='center', width=('relative', 80)) for line in lines]
+        self.walker[:] = content
+
+    def on_to_menu(self, button):
+        self.controller.set_view('menu')
+
+class SearchView(BaseView):
+    """
+        Class responsible for providing the application window
+        handling the searching of entries.
+    """
+    def __init__(self, controller):
+        self.task = None
+        super().__init__(controller)
+
+    def window(self):
+        div = urwid.Divider()
+
+        self.edit_field = urwid.Edit(u'Search: ')
+        self.info = urwid.Text(u'')
+
+        controls = [
+            div,
+            urwid.Padding(urwid.LineBox(urwid.AttrMap(self.edit_field, 'edit_body')), 
+                          align='center', width=('relative', 90)),
+            urwid.Columns([
+                urwid.Padding(urwid.Button(('button', u'Search'), self.on_search),
+                              align='center', width=('relative', 80)),
+                urwid.Padding(urwid.Button(('button', u'To menu'), self.on_to_menu),
+                              align='center', width=('relative', 80)),
+                urwid.Padding(urwid.Button(('button', u'Quit'), self.on_quit),
+                              align='center', width=('relative', 80))
+            ]),
+            div,
+            urwid.Padding(self.info, align='center', width=('relative', 90)),
+            div
+        ]
+        
+        self.walker = urwid.SimpleFocusListWalker(controls)
+        self.n_controls = len(controls)
+
+        listbox = urwid.ListBox(self.walker)
+        view = urwid.AttrMap(listbox, 'body')
+        view = urwid.LineBox(view, title='mDiary: Search')
+
+        return view
+
+    def gen_result(self, id, date, snippet):
         """
-            Adds a blankline between arguments displayed by
-            the --help flag.
+            Returns a box showing a search result with the matches highlighted.
         """
-        return [''] + super()._split_lines(text, width) + ['']
+        div = urwid.Divider()
+
+        pile = urwid.Pile([
+            urwid.Padding(urwid.Text(snippet_markup(snippet)), align='center', width=('relative', 90)),
+            div,
+            urwid.Padding(urwid.Button(u'Update entry', self.on_update, id),
+                          align='center', width=('relative', 40))
+        ])
+
+        return urwid.Padding(urwid.LineBox(urwid.AttrMap(pile, 'body'), title='Entry no. {} on {}-{}-{} ({}:{})'.format(
+                             id, date.year, date.month, date.day, date.hour, date.minute)),
+                             align='center', width=('relative', 80))
+
+    def on_search(self, button):
+        """
+            Search in the background, replacing a search which is still running.
+        """
+        query = self.edit_field.get_edit_text().strip()
+        self.on_hide()
+
+        if not query:
+            self.show_results([])
+            return
+
+        self.info.set_text(u'Searching...')
+        self.task = self.controller.run_background(self.controller.search_entries, self.show_results, query)
+
+    def show_results(self, results):
+        self.task = None
+        self.info.set_text(u'Found {} entries.'.format(len(results)))
+        self.walker[self.n_controls:] = [self.gen_result(*result) for result in results]
+
+    def on_hide(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def keypress(self, size, key):
+        if key == 'enter' and self.walker.get_focus()[1] == 1:
+            self.on_search(None)
+            return None
+
+        return super().keypress(size, key)
+
+    def on_to_menu(self, button):
+        self.controller.set_view('menu')
+
+    def on_update(self, button, id):
+        self.controller.get_view('edit').set_state(id, back='search')
+        self.controller.set_view('edit')
+
+class StatsView(BaseView):
+    """
+        Class responsible for providing the application window
+        showing the number of calls and latencies of the traced 
+        operations, see mdiary.trace.
+    """
+    def __init__(self, controller):
+        super().__init__(controller)
 
-class Diary:
+    def window(self):
+        self.walker = urwid.SimpleFocusListWalker([])
+
+        listbox = urwid.ListBox(self.walker)
+        view = urwid.AttrMap(listbox, 'body')
+        view = urwid.LineBox(view, title='mDiary: Statistics')
+
+        return view
+
+    def update_stats(self):
+        div = urwid.Divider()
+
+        content = [
+            urwid.Columns([
+                urwid.Padding(urwid.Button(u'Refresh', self.on_refresh), align='center', width=('relative', 50)),
+                urwid.Padding(urwid.Button(u'To menu', self.on_to_menu), align='center', width=('relative', 50))
+            ]),
+            div
+        ]
+
+        if not TRACER.enabled:
+            content.append(urwid.Text(u'Start mdiary with --profile (or set MDIARY_TRACE) to collect statistics.', 
+                                      align='center'))
+            self.walker[:] = content
+            return
+
+        row = u'{:<28} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'
+        lines = [row.format(u'operation', u'calls', u'total ms', u'p50 ms', u'p95 ms', u'p99 ms', u'max ms')]
+
+        for name, calls, total, p50, p95, p99, maximum in TRACER.stats():
+            lines.append(row.format(name[:28], calls, *('{:.2f}'.format(value * 1000) 
+                                                        for value in (total, p50, p95, p99, maximum))))
+
+        lines.append(u'')
+        lines += [u'{:<28} {:>8}'.format(name[:28], value) for name, value in sorted(TRACER.counters.items())]
+        lines += [u'', u'Trace file: {}'.format(TRACER.path)]
+
+        content += [urwid.Text(line) for line in lines]
+        self.walker[:] = content
+
+    def on_refresh(self, button):
+        self.update_stats()
+
+    def on_to_menu(self, button):
+        self.controller.set_view('menu')
+
+VIEWS = {
+    'init': InitView,
+    'writer': WriterView,
+    'menu': MenuView,
+    'edit': EditView,
+    'reader': ReaderView,
+    'entry': EntryView,
+    'history': HistoryView,
+    'search': SearchView,
+    'calendar': CalendarView,
+    'summary': SummaryView,
+    'stats': StatsView
+}
+
+class Diary(DiaryCore):
     """
         Class controlling the behaviour of the application,
         handling the views etc.
     """
 
     def __init__(self):
-        self.hash_path = Path.home() / '.mdiary'
-        self.config_path = Path.home() / '.config' / 'mdiary'
-        self.config_file = self.config_path / 'mdiary.conf'
-        self.config = ConfigParser()
-        self.db_handler = None
-        self.key_file = None
-        self.key = None
+        super().__init__()
+        self.views = {}
+        self.loop = None
+        self.event_loop = None
+        self.executor = None
 
-        self.views = {
-            'init': InitView(self),
-            'writer': WriterView(self),
-            'menu': MenuView(self),
-            'edit': EditView(self),
-            'reader': ReaderView(self)
-        }
+    def get_view(self, id):
+        """
+            Returns the view with the given id, constructing it the
+            first time it is needed.
+        """
+        if id not in self.views:
+            self.views[id] = VIEWS[id](self)
 
-    def main(self):
+        return self.views[id]
+
+    def main(self, args):
         """
-            The main function.
+            The main function, given the parsed command line arguments.
         """
         if not self.config_path.is_dir():
             self.config_path.mkdir(exist_ok=True)
-
-        parser = argparse.ArgumentParser(description='A simple terminal diary, written in Python, with encryption possibilities.',
-                                         formatter_class=PatchedHelpFormatter)
-        parser.add_argument('--key', '-k', help='sets the location of the diary safety key! Make sure you always use the same key and for the sake of security, please do not keep the key in the original directory.',
-                            action='store', dest='key')
-        parser.add_argument('--reset', '-r', help='reset the configuration file. Such that a new diary instance can be created.',
-                        action='store_true', dest='reset')
-        parser.add_argument('--version', '-v', action='version', version='mdiary 0.0.2')
-        parser_results = parser.parse_args()
  
-        if parser_results.reset and self.config_file.is_file():
+        if args.reset and self.config_file.is_file():
             self.reset_config()
 
         if not self.config_file.is_file():
-            init_view = self.views['init']
+            init_view = self.get_view('init')
         else:
-            if self.is_using_key() and parser_results.key:
-                self.key_file = Path(parser_results.key).expanduser()
-                self.set_key()
-                
-                if not self.verify_key_hash():
-                    print('Use the appropiate key!')
-                    sys.exit()
-            elif self.is_using_key() and not parser_results.key:
-                print('Use your key to get access to the diary by using the [--key, -k KEY] argument!')
-                sys.exit()
-            
-            init_view = self.views['menu']
-            self.gen_db()
-
-        self.loop = urwid.MainLoop(init_view, PALETTE)
-        self.loop.run()
+            self.open_diary(args.key)
+            self.start_migration()
+            init_view = self.get_view('menu')
 
-    def set_view(self, id='menu'):
+        self.event_loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mdiary-loader')
+        self.loop = urwid.MainLoop(init_view, PALETTE, event_loop=urwid.AsyncioEventLoop(loop=self.event_loop))
+        self.loop.set_alarm_in(AUTOSAVE_INTERVAL, self.on_autosave)
+
+        try:
+            self.loop.run()
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+            self.close_diary()
+            self.event_loop.close()
+
+    def gen_db(self, lite=False):
+        super().gen_db(lite)
+        self.db_handler.add_listener(self.on_stored)
+
+    @property
+    def background(self):
         """
-            Set the view to either 'writer', 'reader', 'menu' or 'init'.
+            Whether run_background runs in the background.
         """
-        if id == 'reader':
-            self.views[id].update_reader()
-        self.loop.widget = self.views[id]
+        return self.executor is not None
 
-    def gen_config(self, db_name, using_key):
+    def run_background(self, func, callback, *args):
         """
-            Generate an ini like configuration file with
-            parameters 'db' for the database name and location, 
-            and 'using_key' which stores True/False depending
-            on whether one want to use a secret key to encrypt 
-            the diary entries (functionality nog yet implemented!).
+            Run func(*args) in the loader thread and call callback with its
+            result in the event loop, redrawing the screen afterwards. Returns
+            the future, cancelling it drops the result. Without an event loop 
+            (before main runs) func is called right away and None is returned.
         """
-        self.config['settings'] = {
-            'db': db_name + '.db',
-            'using_key': using_key
-        }
+        if not self.background:
+            callback(func(*args))
+            return None
 
-        with self.config_file.open(mode='w') as f:
-            self.config.write(f)
-        
-        self.gen_db()
+        future = self.event_loop.run_in_executor(self.executor, self.run_task, func, args)
+        future.add_done_callback(partial(self.on_task_done, callback))
 
-    def get_config(self):
-        """
-            Returns the retrieved configuration file's contents.
-        """
-        self.config.read(self.config_file)
-        conf = {
-            'db': self.config.get('settings', 'db'),
-            'using_key': self.config.getboolean('settings', 'using_key')
-        }
+        return future
 
-        return conf
+    def run_task(self, func, args):
+        try:
+            return func(*args)
+        finally:
+            if self.db_handler:
+                self.db_handler.end_session()
 
-    def reset_config(self):
-        """
-            Resets the configuration file such that one can initiate
-            a new database, key, etc.
-        """
-        suffix = '.old'
-        file_old = self.config_path / ('mdiary.conf' + suffix)
-        
-        while True: 
-            if not file_old.is_file():
-                break
+    def on_task_done(self, callback, future):
+        if future.cancelled():
+            return
 
-            suffix += '.old'
-            file_old = self.config_path / ('mdiary.conf' + suffix)
+        try:
+            result = future.result()
+        except Exception as error:
+            if isinstance(self.loop.widget, BaseView):
+                self.loop.widget.show_error(u'Loading failed: {}'.format(error))
+        else:
+            callback(result)
 
-        self.config_file.rename(file_old)
-        
-    def gen_db(self):
-        if self.get_config()['db']:
-            self.db_handler = DBHandler(name=self.get_config()['db'])
-            self.db_handler.create()
-            self.db_handler.new_session()
-    
-    def gen_key(self, key_fn):
+        self.loop.draw_screen()
+
+    def call_in_loop(self, func, *args):
         """
-            Generates a key at the <Path> key_fn.
+            Call func(*args) in the event loop and redraw the screen, from
+            any thread. Does nothing without an event loop.
         """
-        self.key_file = key_fn
+        if self.background:
+            self.event_loop.call_soon_threadsafe(self.run_in_loop, func, args)
 
-        if self.key_file:
-            self.key_file.touch()
-            key = Fernet.generate_key()
-            self.key_file.write_bytes(key)
-
-            self.set_key()
-        else:
-            raise AttributeError('self.key_file does not exist, SET IT IDIOT!')
-        
-    def set_key(self):
-        if self.key_file.is_file():
-            key = self.key_file.read_bytes()
-            self.key = key
-        else:
-            raise AttributeError('The key_file attribute is not valid or does not exist!')
-    
+    def run_in_loop(self, func, args):
+        func(*args)
+        self.loop.draw_screen()
 
-    def gen_key_hash(self):
-        hashed_key = pbkdf2_sha256.hash(self.key)
+    def on_stored(self, change, entry_ids):
+        # Called from the writer thread once queued writes are stored
+        self.call_in_loop(self.on_changed, change, entry_ids)
 
-        hf = self.hash_path / (self.get_config()['db'] + '.keyhash')
-        hf.write_text(hashed_key)
+    def on_changed(self, change, entry_ids):
+        if isinstance(self.loop.widget, BaseView):
+            self.loop.widget.on_changed(change, entry_ids)
 
-    def verify_key_hash(self, key=None):
-        if not key:
-            key = self.key
-        hf = self.hash_path / (self.get_config()['db'] + '.keyhash')
-        return pbkdf2_sha256.verify(key, hf.read_text())
-        
+    def on_autosave(self, loop=None, user_data=None):
+        """
+            Autosave the draft of the current view, rescheduling itself.
+        """
+        self.autosave()
+        self.loop.set_alarm_in(AUTOSAVE_INTERVAL, self.on_autosave)
 
-    def encrypt_entry(self, text):
-        f = Fernet(self.key)
-        enc = f.encrypt(text.encode())
+    def autosave(self):
+        view = self.loop.widget if self.loop else None
 
-        return enc
-    
-    def decrypt_entry(self, enc_text):
-        f = Fernet(self.key)
+        if self.db_handler and isinstance(view, DraftMixin):
+            view.autosave()
 
-        try:
-            dec = f.decrypt(enc_text)
-        except InvalidToken:
-            self.quit_program()
+    @traced('ui.set_view')
+    def set_view(self, id='menu'):
+        """
+            Set the view to either 'writer', 'reader', 'entry', 'history', 
+            'search', 'calendar', 'summary', 'stats', 'menu' or 'init'. Queued writes are not
+            waited for, the views show them once they are stored, see on_stored.
+        """
+        if self.db_handler:
+            self.autosave()
+
+        if isinstance(self.loop.widget, BaseView):
+            self.loop.widget.show_error(None)
+            self.loop.widget.on_hide()
+
+        view = self.get_view(id)
+
+        if id == 'writer':
+            view.restore_draft()
+        elif id == 'reader':
+            view.update_reader()
+        elif id == 'search':
+            view.on_search(None)
+        elif id == 'calendar':
+            view.update_calendar()
+        elif id == 'summary':
+            view.update_summary()
+        elif id == 'stats':
+            view.update_stats()
+        self.loop.widget = view
 
-        return dec.decode()
-    
-    def is_using_key(self):
-        return self.get_config()['using_key']
-    
-    def close_diary(self):
-        self.db_handler.close()
-    
     def quit_program(self):
+        if self.db_handler:
+            self.autosave()
+
+        if self.cipher:
+            self.cipher.wipe()
+
         raise urwid.ExitMainLoop()
@@ -0,0 +1,165 @@
+"""
+    Plain sqlite3 access to an existing diary for the headless commands,
+    which start a lot faster without importing SQLAlchemy. The schema 
+    is created and migrated by DBHandler only.
+"""
+import sqlite3
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+from mdiary.payload import pack, resolve_codec, sql_text, unpack
+from mdiary.search import plain_tag_keys
+from mdiary.stats import DAY_FORMAT, text_stats
+from mdiary.trace import traced
+
+STORAGE_PROFILES = {
+    # Write-ahead log with an fsync on every commit
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT'
+    },
+    # Large cache and memory mapped reads, commits may be lost (but not 
+    # corrupt the database) on a power failure
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    },
+    # Small cache and temporary tables on disk
+    'low-memory': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -1000,
+        'mmap_size': 0,
+        'temp_store': 'FILE'
+    }
+}
+
+BUSY_TIMEOUT = 5000 # ms
+
+# The format SQLAlchemy stores DateTime columns in
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+EntryRow = namedtuple('EntryRow', ['entry_id', 'timestamp', 'entry_text'])
+
+class LiteDBHandler():
+    """
+        Supports the subset of DBHandler used by the add, count and
+        show commands. Entries are written directly instead of being 
+        queued, the full-text index is kept up to date by its triggers.
+    """
+    def __init__(self, name='mdiary.db', profile='durable', path=None, compression='auto'):
+        if profile not in STORAGE_PROFILES:
+            raise ValueError('Unknown storage profile {}, use one of {}.'.format(
+                             profile, ', '.join(STORAGE_PROFILES)))
+
+        self.db_name = name
+        self.profile = profile
+        self.codec = resolve_codec(compression)
+        self.db_path = Path(path) if path else Path.home() / '.mdiary'
+        self.full_path = self.db_path / self.db_name
+        self.conn = None
+
+    def exists(self):
+        return self.full_path.is_file()
+
+    def connect(self):
+        if not self.conn:
+            self.conn = sqlite3.connect(str(self.full_path))
+            self.conn.create_function('mdiary_text', 1, sql_text, deterministic=True)
+            self.conn.execute('PRAGMA busy_timeout = {}'.format(BUSY_TIMEOUT))
+
+            for pragma, value in STORAGE_PROFILES[self.profile].items():
+                self.conn.execute('PRAGMA {} = {}'.format(pragma, value))
+
+        return self.conn
+
+    def has_table(self, name):
+        query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+
+        return self.connect().execute(query, (name,)).fetchone() is not None
+
+    def is_sharded(self):
+        """
+            Returns True if the entries are stored in yearly shards, which
+            are only opened by DBHandler, see mdiary.shards.
+        """
+        if not self.has_table('meta'):
+            return False
+
+        row = self.connect().execute("SELECT value FROM meta WHERE key = 'sharded'").fetchone()
+
+        return bool(row and row[0])
+
+    @traced('lite.new_entry')
+    def new_entry(self, txt, tokens=None, stats=None, tags=None):
+        """
+            Appends a new diary entry together with its search tokens,
+            stats and tags in a single transaction, returns the new EntryRow.
+            The stats and tags of plain texts are found when not given, see
+            DBHandler.new_entry.
+        """
+        dt = datetime.now()
+        conn = self.connect()
+        timestamp = dt.strftime(TIMESTAMP_FORMAT)
+
+        if stats is None and isinstance(txt, str):
+            stats = text_stats(txt)
+
+        if tags is None and isinstance(txt, str):
+            tags = plain_tag_keys(txt)
+
+        with conn:
+            cursor = conn.execute('INSERT INTO entries (text, timestamp) VALUES (?, ?)',
+                                  (pack(txt, self.codec), timestamp))
+            entry_id = cursor.lastrowid
+
+            # Diaries created by older versions get the tables once DBHandler opens them,
+            # which indexes and counts the entries written until then
+            if tokens and self.has_table('entry_tokens'):
+                conn.executemany('INSERT INTO entry_tokens (token, entry_id) VALUES (?, ?)',
+                                 ((token, entry_id) for token in tokens))
+
+            if stats and self.has_table('entry_stats'):
+                conn.execute('INSERT INTO entry_stats (entry_id, day, timestamp, words, chars) VALUES (?, ?, ?, ?, ?)',
+                             (entry_id, dt.strftime(DAY_FORMAT), timestamp) + tuple(stats))
+
+            if tags and self.has_table('tags'):
+                conn.executemany('INSERT OR IGNORE INTO tags (tag) VALUES (?)', ((tag,) for tag in tags))
+                conn.executemany('INSERT INTO entry_tags (tag_id, entry_id, timestamp) '
+                                 'SELECT id, ?, ? FROM tags WHERE tag = ?',
+                                 ((entry_id, timestamp, tag) for tag in tags))
+
+        return EntryRow(entry_id, dt, txt)
+
+    def queue_entry(self, txt, tokens=None, stats=None, tags=None):
+        self.new_entry(txt, tokens, stats, tags)
+
+    @traced('lite.get_entry')
+    def get_entry(self, id):
+        """
+            Returns the EntryRow with the given id, None if there is no such entry.
+        """
+        row = self.connect().execute('SELECT id, timestamp, text FROM entries WHERE id = ?', (id,)).fetchone()
+
+        if row is None:
+            return None
+
+        return EntryRow(row[0], datetime.fromisoformat(row[1]), unpack(row[2]))
+
+    @traced('lite.get_entry_count')
+    def get_entry_count(self):
+        return self.connect().execute('SELECT count(*) FROM entries').fetchone()[0]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
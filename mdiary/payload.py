@@ -0,0 +1,165 @@
+"""
+    The on-disk format of entry and draft texts. A payload starts with
+    a header byte telling how the rest is encoded: compressed or not and
+    encrypted or not, where texts are compressed before they are encrypted.
+    Rows written by older versions have no header, these are either plain
+    text or Fernet tokens (starting with b'g'), and are read as they are.
+"""
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PAYLOAD_VERSION = 1
+
+# Header bytes of version 1, combining a codec with the ENCRYPTED flag
+RAW = 0x01
+ZLIB = 0x02
+ZSTD = 0x03
+ENCRYPTED = 0x10
+
+HEADERS = {RAW, ZLIB, ZSTD, RAW | ENCRYPTED, ZLIB | ENCRYPTED, ZSTD | ENCRYPTED}
+
+CODECS = {
+    'none': RAW,
+    'zlib': ZLIB,
+    'zstd': ZSTD
+}
+
+MIN_COMPRESS = 64 # bytes, shorter texts are not worth compressing
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+class PayloadError(ValueError):
+    pass
+
+def resolve_codec(compression='auto'):
+    """
+        Returns the codec to write with for the compression setting,
+        'auto' uses zstd when the zstandard package is installed and
+        zlib otherwise.
+    """
+    if compression == 'auto':
+        return 'zstd' if zstandard else 'zlib'
+
+    if compression not in CODECS:
+        raise ValueError('Unknown compression {}, use auto or one of {}.'.format(
+                         compression, ', '.join(CODECS)))
+
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('Compressing with zstd requires the zstandard package.')
+
+    return compression
+
+def compress(data, codec):
+    """
+        Returns the (header, body) of data compressed with codec, data
+        is kept as it is when compressing does not make it smaller.
+    """
+    if codec == 'none' or len(data) < MIN_COMPRESS:
+        return RAW, data
+
+    if codec == 'zstd':
+        body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    else:
+        body = zlib.compress(data, ZLIB_LEVEL)
+
+    if len(body) >= len(data):
+        return RAW, data
+
+    return CODECS[codec], body
+
+def decompress(header, body):
+    codec = header & ~ENCRYPTED
+
+    if codec == RAW:
+        return body
+    elif codec == ZLIB:
+        return zlib.decompress(body)
+    elif codec == ZSTD:
+        if zstandard is None:
+            raise PayloadError('The diary is compressed with zstd, install the zstandard package to read it.')
+
+        return zstandard.ZstdDecompressor().decompress(body)
+
+    raise PayloadError('Unknown payload header {:#04x}.'.format(header))
+
+def is_legacy(value):
+    """
+        Whether value was written by a version without payload headers.
+    """
+    return isinstance(value, str) or value[0] not in HEADERS
+
+def is_sealed(value):
+    """
+        Whether value is encrypted, in either format.
+    """
+    if isinstance(value, str):
+        return False
+
+    return value[0] & ENCRYPTED if value[0] in HEADERS else True
+
+def pack(text, codec='zlib'):
+    """
+        Returns the payload of a plain text, payloads which are packed
+        or sealed already are returned as they are.
+    """
+    if not isinstance(text, str):
+        return text
+
+    header, body = compress(text.encode(), codec)
+
+    return bytes([header]) + body
+
+def unpack(value):
+    """
+        Returns the text of a plain payload. Sealed payloads are returned
+        as they are, they are decrypted by unseal.
+    """
+    if value is None or isinstance(value, str):
+        return value
+
+    value = bytes(value)
+
+    if is_sealed(value):
+        return value
+
+    return decompress(value[0], value[1:]).decode()
+
+def seal(fernet, text, codec='zlib'):
+    """
+        Returns the encrypted payload of text. The Fernet token is stored
+        without its base64 encoding, which would add a third to its size.
+    """
+    header, body = compress(text.encode(), codec)
+
+    return bytes([header | ENCRYPTED]) + urlsafe_b64decode(fernet.encrypt(body))
+
+def unseal(fernet, value):
+    """
+        Returns the text of an encrypted payload or of a Fernet token
+        written by an older version. Raises InvalidToken if it was not
+        encrypted with the key of fernet.
+    """
+    if isinstance(value, str):
+        value = value.encode()
+
+    value = bytes(value)
+
+    if is_legacy(value):
+        return fernet.decrypt(value).decode()
+
+    return decompress(value[0], fernet.decrypt(urlsafe_b64encode(value[1:]))).decode()
+
+def sql_text(value):
+    """
+        The mdiary_text SQL function, returns the text of a plain payload
+        and NULL for encrypted ones, see DBHandler.on_connect.
+    """
+    if value is None or is_sealed(value):
+        return None
+
+    return unpack(value)
@@ -0,0 +1,70 @@
+"""
+    The revision history of entries. When an entry is updated its old
+    text is kept as a revision, stored as a delta turning the next newer
+    version into it (a reverse delta), such that the revisions of a long
+    entry only take the space of what was changed. Every SNAPSHOT_INTERVAL
+    revisions, the whole text is stored instead, which bounds the number of
+    deltas to apply to reconstruct any revision.
+
+    A delta is a JSON list of [start, end] ranges of segments copied from
+    the newer version and of inserted strings, where texts are split into
+    segments at the end of lines and sentences.
+"""
+import re
+import json
+from difflib import SequenceMatcher
+
+SNAPSHOT_INTERVAL = 16
+
+SEGMENT_RE = re.compile(r'[^\n.!?]*[.!?]*\s*')
+
+def segments(txt):
+    """
+        Splits txt into sentences and lines, keeping their punctuation
+        and trailing whitespace, such that they join into txt.
+    """
+    return [segment for segment in SEGMENT_RE.findall(txt) if segment]
+
+def make_delta(base, txt):
+    """
+        Returns the delta turning base into txt.
+    """
+    base_segments = segments(base)
+    txt_segments = segments(txt)
+    ops = []
+
+    for op, i1, i2, j1, j2 in SequenceMatcher(None, base_segments, txt_segments).get_opcodes():
+        if op == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(txt_segments[j1:j2]))
+
+    return json.dumps(ops, ensure_ascii=False, separators=(',', ':'))
+
+def apply_delta(base, delta):
+    """
+        Returns the text the delta turns base into, see make_delta.
+    """
+    base_segments = segments(base)
+
+    return ''.join(op if isinstance(op, str) else ''.join(base_segments[op[0]:op[1]])
+                   for op in json.loads(delta))
+
+def reconstruct(current, chain):
+    """
+        Returns the text of the oldest revision of chain, a list of
+        (snapshot, text) tuples of successive revisions ordered from
+        old to new, which ends at a snapshot or else at the revision
+        before current, the text of the entry itself.
+    """
+    chain = list(chain)
+
+    if chain and chain[-1][0]:
+        txt = chain.pop()[1]
+    else:
+        txt = current
+
+    for _, delta in reversed(chain):
+        txt = apply_delta(txt, delta)
+
+    return txt
@@ -0,0 +1,110 @@
+import re
+from datetime import datetime
+
+HIGHLIGHT_OPEN = '\x02'
+HIGHLIGHT_CLOSE = '\x03'
+SNIPPET_WIDTH = 120
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+FILTER_RE = re.compile(r'\b(from|to):(\d{4}(?:-\d{1,2}){0,2})')
+TAG_RE = re.compile(r'(?<!\w)#(\w+)', re.UNICODE)
+
+def period_range(value):
+    """
+        Returns the (start, end) datetimes of the year, month or day 
+        written as YYYY, YYYY-MM or YYYY-MM-DD, where end is exclusive.
+        Raises ValueError for invalid dates.
+    """
+    parts = [int(part) for part in value.split('-')]
+    year, month, day = parts + [1] * (3 - len(parts))
+    start = datetime(year, month, day)
+
+    if len(parts) == 1:
+        end = datetime(year + 1, 1, 1)
+    elif len(parts) == 2:
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+    else:
+        end = datetime.fromordinal(start.toordinal() + 1)
+
+    return start, end
+
+def parse_query(query):
+    """
+        Split a search query into its text and date filters, where
+        from:DATE and to:DATE (YYYY, YYYY-MM or YYYY-MM-DD) restrict 
+        the search to entries written in or after / in or before
+        the given period. Returns (text, start, end), where start and
+        end are None when not given.
+    """
+    start = end = None
+
+    for name, value in FILTER_RE.findall(query):
+        try:
+            period_start, period_end = period_range(value)
+        except ValueError:
+            continue
+
+        if name == 'from':
+            start = period_start
+        else:
+            end = period_end
+
+    return FILTER_RE.sub('', query).strip(), start, end
+
+def query_words(query):
+    """
+        Split a search query into lowercase words.
+    """
+    return [word.lower() for word in WORD_RE.findall(query)]
+
+def parse_tags(txt):
+    """
+        Returns the set of #tags in a text, in lowercase without the #.
+    """
+    return {tag.lower() for tag in TAG_RE.findall(txt)}
+
+def plain_tag_keys(txt):
+    """
+        Returns the keys under which the tags of a text are stored
+        in a diary without a key, see DBHandler.get_page.
+    """
+    return {tag.encode() for tag in parse_tags(txt)}
+
+def fts_query(query):
+    """
+        Translate a search query into an FTS5 MATCH expression, where
+        every word has to match (as a prefix) for an entry to be found.
+    """
+    return ' '.join('"{}"*'.format(word) for word in query_words(query))
+
+def make_snippet(text, words, width=SNIPPET_WIDTH):
+    """
+        Returns the part of text around the first matching word, with
+        all words starting with one of the given words highlighted in
+        the same way as the snippets produced by DBHandler.search.
+    """
+    if not words:
+        return text[:width]
+
+    pattern = re.compile(r'\b(?:{})\w*'.format('|'.join(map(re.escape, words))), re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(match.start() - width // 3, 0) if match else 0
+    part = text[start:start + width]
+
+    part = pattern.sub(lambda m: HIGHLIGHT_OPEN + m.group(0) + HIGHLIGHT_CLOSE, part)
+    prefix = '...' if start > 0 else ''
+    suffix = '...' if start + width < len(text) else ''
+
+    return prefix + part + suffix
+
+def snippet_markup(snippet, attr='highlight'):
+    """
+        Convert a highlighted snippet into urwid text markup.
+    """
+    markup = []
+
+    for i, part in enumerate(re.split('[{}{}]'.format(HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE), snippet)):
+        if part:
+            markup.append((attr, part) if i % 2 else part)
+
+    return markup or ['']
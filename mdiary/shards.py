@@ -0,0 +1,562 @@
+"""
+    The sharded layout of a diary, where the entries written in a year are
+    stored in a database of their own, NAME-YYYY.db next to the main database
+    NAME.db, which keeps the drafts. Day-to-day work only touches the shard
+    of the current year, and the shards of past years can be compacted,
+    backed up or archived on their own.
+
+    Every shard is a complete diary database opened by a DBHandler once it
+    is used. The ids of the entries written in a year start at year *
+    SHARD_IDS, such that the shard of an entry follows from its id, and
+    the order of the ids is the order of the years.
+"""
+import re
+import threading
+from datetime import datetime
+from itertools import chain, groupby
+from pathlib import Path
+from sqlalchemy import text
+from mdiary.database import BATCH_SIZE, ENTRIES, MIGRATE_BATCH, PAGE_SIZE, SEARCH_LIMIT, DBHandler, EntryToken
+from mdiary.search import period_range
+from mdiary.trace import traced
+
+SHARD_IDS = 10**7 # the ids of the entries of a year
+
+# Copies the entries of a year from the attached main database in order of
+# their timestamps, which are renumbered by split_ids
+SPLIT_SCHEMA = [
+    """DROP TABLE IF EXISTS temp.split_ids""",
+    """CREATE TEMP TABLE split_ids AS
+           SELECT id AS old_id, :base + row_number() OVER (ORDER BY timestamp, id) AS new_id
+           FROM single.entries WHERE timestamp >= :start AND timestamp < :end""",
+    """CREATE UNIQUE INDEX temp.ix_split_ids ON split_ids (old_id)""",
+    """INSERT INTO entries (id, timestamp, text)
+           SELECT new_id, timestamp, text FROM single.entries JOIN split_ids ON id = old_id ORDER BY new_id""",
+    """INSERT INTO entry_tokens (entry_id, token)
+           SELECT new_id, token FROM single.entry_tokens JOIN split_ids ON entry_id = old_id""",
+    """INSERT INTO entry_stats (entry_id, day, timestamp, words, chars)
+           SELECT new_id, day, timestamp, words, chars FROM single.entry_stats JOIN split_ids ON entry_id = old_id""",
+    """INSERT OR IGNORE INTO tags (tag)
+           SELECT DISTINCT tag FROM single.tags JOIN single.entry_tags ON tag_id = tags.id
+           JOIN split_ids ON entry_id = old_id""",
+    """INSERT INTO entry_tags (tag_id, entry_id, timestamp)
+           SELECT tags.id, new_id, entry_tags.timestamp FROM single.entry_tags
+           JOIN split_ids ON entry_id = old_id
+           JOIN single.tags AS old_tags ON old_tags.id = entry_tags.tag_id
+           JOIN tags ON tags.tag = old_tags.tag""",
+    """INSERT INTO entry_revisions (entry_id, revision, timestamp, snapshot, text)
+           SELECT new_id, revision, timestamp, snapshot, text FROM single.entry_revisions
+           JOIN split_ids ON entry_id = old_id""",
+    # The drafts of the editor are named after the entry, see EditView.draft_name
+    """UPDATE single.drafts SET name = (SELECT 'edit-' || new_id FROM split_ids
+                                        WHERE 'edit-' || old_id = drafts.name)
+           WHERE name IN (SELECT 'edit-' || old_id FROM split_ids)""",
+    # Entries written before the tags were kept are tagged by add_tags
+    """INSERT INTO meta (key, value)
+           SELECT 'tags_until', max(new_id) FROM split_ids WHERE old_id > :tags_after AND old_id <= :tags_until
+           HAVING count(*) > 0""",
+    # And so are the entries written before the search tokens were kept
+    """INSERT OR REPLACE INTO meta (key, value)
+           SELECT 'tokens_until', max(new_id) FROM split_ids 
+           WHERE old_id > :tokens_after AND old_id <= :tokens_until
+           AND NOT EXISTS (SELECT 1 FROM single.entry_tokens WHERE entry_id = old_id)
+           HAVING count(*) > 0""",
+    """DROP TABLE temp.split_ids"""
+]
+
+def shard_path(path, year):
+    """
+        Returns the path of the shard of year of the main database at path.
+    """
+    path = Path(path)
+
+    return path.with_name('{}-{:04d}.db'.format(path.stem, year))
+
+def shard_paths(path):
+    """
+        Returns the paths of the shards of the main database at path,
+        as a dict ordered by year.
+    """
+    path = Path(path)
+    pattern = re.compile(re.escape(path.stem) + r'-(\d{4})\.db')
+    shards = {}
+
+    for shard in path.parent.glob(path.stem + '-*.db'):
+        match = pattern.fullmatch(shard.name)
+
+        if match:
+            shards[int(match.group(1))] = shard
+
+    return dict(sorted(shards.items()))
+
+def remove_database(path):
+    """
+        Delete the database file at path with its write-ahead log.
+    """
+    for path in (path, path.with_name(path.name + '-wal'), path.with_name(path.name + '-shm')):
+        if path.exists():
+            path.unlink()
+
+def shard_year(entry_id):
+    return entry_id // SHARD_IDS
+
+def migrated_key(year):
+    # The key in the meta table of the main database
+    return 'migrated-{:04d}'.format(year)
+
+def by_year(rows, year=lambda row: shard_year(row[0])):
+    """
+        Returns the rows, tuples starting with an entry id, grouped
+        by the year of their shard as a dict of lists.
+    """
+    groups = {}
+
+    for row in rows:
+        groups.setdefault(year(row), []).append(row)
+
+    return groups
+
+class ShardedDBHandler():
+    """
+        Provides the API of DBHandler over the main database main (an
+        opened DBHandler) and its shards, see the module docstring. Writes
+        go to the shard of the year of the entry, which is created when it
+        is missing. Reads go to the shards of the years they cover in order
+        of time, such that pages, ranges and counts are the same as those
+        of a single database, while searches return the matches of the
+        newest shards first.
+    """
+    def __init__(self, main, fulltext=False):
+        self.main = main
+        self.fulltext = fulltext
+        self.db_name = main.db_name
+        self.db_path = main.db_path
+        self.full_path = main.full_path
+        self.listeners = main.listeners
+        self.years = list(shard_paths(self.full_path))
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def shard(self, year, create=False):
+        """
+            Returns the DBHandler of the shard of year, opening it the first
+            time it is used. Returns None if there is no such shard, unless
+            create is set.
+        """
+        with self.lock:
+            if year in self.shards:
+                return self.shards[year]
+
+            if year not in self.years and not create:
+                return None
+
+            db_handler = DBHandler(name=shard_path(self.full_path, year).name, profile=self.main.profile,
+                                   path=self.db_path, compression=self.main.codec, first_id=year * SHARD_IDS + 1)
+            db_handler.listeners = self.listeners
+            db_handler.create(self.fulltext)
+            db_handler.new_session()
+            self.shards[year] = db_handler
+
+            if year not in self.years:
+                self.years = sorted(self.years + [year])
+
+            return db_handler
+
+    def shard_of(self, entry_id):
+        return self.shard(shard_year(entry_id))
+
+    def years_between(self, start=None, end=None):
+        """
+            Returns the years of the shards holding entries written
+            between start and end (exclusive), in order.
+        """
+        return [year for year in self.years if (start is None or year >= start.year) and
+                                               (end is None or datetime(year, 1, 1) < end)]
+
+    def shards_between(self, start=None, end=None, reverse=False):
+        """
+            Iterate over the DBHandlers of the shards of years_between,
+            which are opened as they are reached.
+        """
+        years = self.years_between(start, end)
+
+        return (self.shard(year) for year in (reversed(years) if reverse else years))
+
+    def open_shards(self):
+        with self.lock:
+            return list(self.shards.values())
+
+    def create(self, fulltext=False):
+        self.fulltext = fulltext
+        self.main.create(fulltext)
+
+        for db_handler in self.open_shards():
+            db_handler.create(fulltext)
+
+    def new_session(self):
+        self.main.new_session()
+
+    def end_session(self):
+        for db_handler in [self.main] + self.open_shards():
+            db_handler.end_session()
+
+    def new_entry(self, txt, tokens=None, stats=None, tags=None, timestamp=None):
+        """
+            Appends a new entry to the shard of the year it is written in,
+            see DBHandler.new_entry.
+        """
+        dt = timestamp or datetime.now()
+
+        return self.shard(dt.year, create=True).new_entry(txt, tokens, stats, tags, dt)
+
+    def get_entry(self, id, queued=True):
+        db_handler = self.shard_of(id)
+
+        return db_handler.get_entry(id, queued) if db_handler else None
+
+    def get_entries(self):
+        return [row._asdict() for row in self.iter_entries()]
+
+    @traced('shards.get_page')
+    def get_page(self, after=None, before=None, limit=PAGE_SIZE, start=None, end=None, last=False, tag=None):
+        """
+            See DBHandler.get_page, reading the shards from the one of the
+            key until limit rows are found.
+        """
+        years = [year for year in self.years_between(start, end) 
+                 if (not after or year >= after[0].year) and (not before or year <= before[0].year)]
+        rows = []
+
+        if (before or last) and not after:
+            for year in reversed(years):
+                rows = self.shard(year).get_page(None, before, limit - len(rows), start, end, True, tag) + rows
+
+                if len(rows) >= limit:
+                    break
+
+            return rows
+
+        for year in years:
+            rows += self.shard(year).get_page(after, before, limit - len(rows), start, end, tag=tag)
+
+            if len(rows) >= limit:
+                break
+
+        return rows
+
+    entry_key = staticmethod(DBHandler.entry_key)
+
+    def get_range(self, start=None, end=None, limit=None):
+        rows = []
+
+        for db_handler in self.shards_between(start, end):
+            rows += db_handler.get_range(start, end, None if limit is None else limit - len(rows))
+
+            if limit is not None and len(rows) >= limit:
+                break
+
+        return rows
+
+    def get_day(self, year, month, day):
+        return self.get_range(*period_range('{}-{}-{}'.format(year, month, day)))
+
+    def get_month(self, year, month):
+        return self.get_range(*period_range('{}-{}'.format(year, month)))
+
+    def get_year(self, year):
+        return self.get_range(*period_range(str(year)))
+
+    @traced('shards.count_range')
+    def count_range(self, start=None, end=None, tag=None):
+        return sum(db_handler.count_range(start, end, tag) for db_handler in self.shards_between(start, end))
+
+    def count_by_period(self, period='month', start=None, end=None):
+        return [row for db_handler in self.shards_between(start, end)
+                for row in db_handler.count_by_period(period, start, end)]
+
+    def get_summary(self):
+        """
+            Combines the summaries of the shards, see DBHandler.get_summary.
+        """
+        summaries = [summary for summary in (db_handler.get_summary() for db_handler in self.shards_between())
+                     if summary[0]]
+
+        if not summaries:
+            return (0, 0, 0, 0, None, None)
+
+        entries, words, chars, days = (sum(values) for values in list(zip(*summaries))[:4])
+
+        return (entries, words, chars, days, summaries[0][4], summaries[-1][5])
+
+    def stats_by_period(self, period='month'):
+        return [row for db_handler in self.shards_between() for row in db_handler.stats_by_period(period)]
+
+    def get_texts_without_stats(self, batch=PAGE_SIZE):
+        return chain.from_iterable(db_handler.get_texts_without_stats(batch) for db_handler in self.shards_between())
+
+    def get_untagged_texts(self, batch=PAGE_SIZE):
+        return chain.from_iterable(db_handler.get_untagged_texts(batch) for db_handler in self.shards_between())
+
+    def add_tags(self, entry_tags):
+        for year, group in by_year(entry_tags).items():
+            self.shard(year).add_tags(group)
+
+    def remove_unused_tags(self):
+        for db_handler in self.shards_between():
+            db_handler.remove_unused_tags()
+
+    def get_meta(self, key, default=0):
+        return self.main.get_meta(key, default)
+
+    def add_stats(self, stats):
+        for year, group in by_year(stats).items():
+            self.shard(year).add_stats(group)
+
+    def get_entries_raw(self):
+        return self.iter_entries()
+
+    def remove_entry(self, id):
+        db_handler = self.shard_of(id)
+
+        if db_handler:
+            db_handler.remove_entry(id)
+
+    def entry_exists(self, id):
+        db_handler = self.shard_of(id)
+
+        return db_handler is not None and db_handler.entry_exists(id)
+
+    def update_entry(self, id, txt, tokens=None, stats=None, tags=None, revision=None):
+        self.shard_of(id).update_entry(id, txt, tokens, stats, tags, revision)
+
+    def get_revisions(self, id):
+        return self.shard_of(id).get_revisions(id)
+
+    def revision_depth(self, id):
+        return self.shard_of(id).revision_depth(id)
+
+    def get_revision_chain(self, id, revision):
+        return self.shard_of(id).get_revision_chain(id, revision)
+
+    def get_revision_texts(self, entry_ids):
+        """
+            See DBHandler.get_revision_texts, where the revision ids are
+            (year, revision_id) tuples, which are passed on to rewrite.
+        """
+        return [((year, revision_id), txt) for year, ids in by_year(entry_ids, shard_year).items()
+                for revision_id, txt in self.shard(year).get_revision_texts(ids)]
+
+    def get_entry_count(self):
+        return sum(db_handler.get_entry_count() for db_handler in self.shards_between())
+
+    @traced('shards.search')
+    def search(self, query, start=None, end=None, limit=SEARCH_LIMIT):
+        """
+            See DBHandler.search, where the matches of the newest shards
+            come first, each ordered by relevance.
+        """
+        rows = []
+
+        for db_handler in self.shards_between(start, end, reverse=True):
+            rows += db_handler.search(query, start, end, limit - len(rows))
+
+            if len(rows) >= limit:
+                break
+
+        return rows
+
+    @traced('shards.search_tokens')
+    def search_tokens(self, tokens, start=None, end=None, limit=SEARCH_LIMIT):
+        rows = []
+
+        for db_handler in self.shards_between(start, end, reverse=True):
+            rows += db_handler.search_tokens(tokens, start, end, limit - len(rows))
+
+            if len(rows) >= limit:
+                break
+
+        return rows
+
+    def get_unindexed_texts(self, batch=PAGE_SIZE):
+        return chain.from_iterable(db_handler.get_unindexed_texts(batch) for db_handler in self.shards_between())
+
+    def add_tokens(self, entry_tokens):
+        for year, group in by_year(entry_tokens).items():
+            self.shard(year).add_tokens(group)
+
+    def is_indexed(self):
+        return all(db_handler.is_indexed() for db_handler in self.unmigrated())
+
+    def set_indexed(self):
+        for db_handler in self.shards_between():
+            db_handler.set_indexed()
+
+    def bulk_insert(self, rows, batch_size=BATCH_SIZE):
+        """
+            Inserts the rows into the shards of the years of their timestamps,
+            see DBHandler.bulk_insert.
+        """
+        return sum(self.shard(year, create=True).bulk_insert(group, batch_size)
+                   for year, group in groupby(rows, key=lambda row: row[0].year))
+
+    def iter_entries(self, batch=BATCH_SIZE):
+        return chain.from_iterable(db_handler.iter_entries(batch) for db_handler in self.shards_between())
+
+    def get_texts(self, batch=PAGE_SIZE, after=0):
+        return chain.from_iterable(self.shard(year).get_texts(batch, after) for year in self.years
+                                   if year >= shard_year(after))
+
+    def get_draft(self, name):
+        return self.main.get_draft(name)
+
+    def get_drafts(self):
+        return self.main.get_drafts()
+
+    def rewrite(self, entries=(), drafts=(), revisions=()):
+        """
+            See DBHandler.rewrite, which is a transaction per shard.
+        """
+        drafts = list(drafts)
+
+        if drafts:
+            self.main.rewrite(drafts=drafts)
+
+        entries = by_year(entries)
+        revisions = by_year(revisions, lambda revision: revision[0][0])
+
+        for year in sorted(set(entries) | set(revisions)):
+            self.shard(year).rewrite(entries=entries.get(year, ()), 
+                                     revisions=[(revision_id, txt) for (_, revision_id), txt in revisions.get(year, ())])
+
+    def queue_entry(self, txt, tokens=None, stats=None, tags=None, timestamp=None):
+        dt = timestamp or datetime.now()
+        self.shard(dt.year, create=True).queue_entry(txt, tokens, stats, tags, dt)
+
+    def queue_update(self, id, txt, tokens=None, stats=None, tags=None, revision=None):
+        self.shard_of(id).queue_update(id, txt, tokens, stats, tags, revision)
+
+    def queue_draft(self, name, txt):
+        self.main.queue_draft(name, txt)
+
+    def queue_remove_draft(self, name):
+        self.main.queue_remove_draft(name)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def pack(self, txt):
+        return self.main.pack(txt)
+
+    def unmigrated(self):
+        """
+            Returns the DBHandlers of the shards which are not marked as
+            migrated in the main database, see set_migrated. Shards are
+            only written by versions which keep the entries migrated.
+        """
+        return [self.shard(year) for year in self.years if not self.main.get_meta(migrated_key(year))]
+
+    def set_migrated(self, db_handler):
+        """
+            Mark the shard of db_handler as migrated, see DiaryCore.migrate.
+        """
+        with self.main.engine.begin() as conn:
+            DBHandler.set_meta(conn, migrated_key(shard_year(db_handler.first_id)), 1)
+
+    def migrate_payloads(self, convert, stop=None, batch=MIGRATE_BATCH):
+        return sum(db_handler.migrate_payloads(convert, stop, batch) for db_handler in self.shards_between())
+
+    def vacuum(self, year=None):
+        """
+            Rebuild the files of the main database and all shards, or
+            only the shard of year if given.
+        """
+        if year is None:
+            shards = [self.main] + list(self.shards_between())
+        else:
+            shards = [db_handler for db_handler in [self.shard(year)] if db_handler]
+
+        for db_handler in shards:
+            db_handler.vacuum()
+
+        return len(shards)
+
+    def flush(self):
+        for db_handler in [self.main] + self.open_shards():
+            db_handler.flush()
+
+    def close(self):
+        """
+            Close all databases, raising the first error of a failed write.
+        """
+        errors = []
+
+        for db_handler in self.open_shards() + [self.main]:
+            try:
+                db_handler.close()
+            except Exception as error:
+                errors.append(error)
+
+        if errors:
+            raise errors[0]
+
+    @traced('shards.split')
+    def split(self, progress=None):
+        """
+            Move the entries of the main database into the shards,
+            renumbering them by year, together with their search tokens,
+            stats, tags and revisions. Drafts of entries are renamed along.
+            The shards are written first and the main database is only
+            marked as sharded once all are complete, such that an
+            interrupted split starts over when it is run again. Calls
+            progress(year) after every shard, returns the number of shards.
+        """
+        main = self.main
+
+        if main.get_meta('sharded'):
+            return 0
+
+        main.flush()
+
+        for path in shard_paths(self.full_path).values():
+            remove_database(path)
+
+        self.years = []
+        years = [int(year) for year, _ in main.count_by_period('year')]
+        params = {key: main.get_meta(key) for key in ('tags_after', 'tags_until', 'tokens_after', 'tokens_until')}
+        version = main.get_payload_version()
+
+        for year in years:
+            db_handler = self.shard(year, create=True)
+            params.update(base=year * SHARD_IDS, start='{:04d}-01-01'.format(year), end='{:04d}-01-01'.format(year + 1))
+
+            with db_handler.engine.connect() as conn:
+                conn.execute(text('ATTACH DATABASE :path AS single'), path=str(self.full_path))
+
+                try:
+                    with conn.begin():
+                        for statement in SPLIT_SCHEMA:
+                            conn.execute(text(statement), **params)
+                finally:
+                    conn.execute(text('DETACH DATABASE single'))
+
+            db_handler.set_payload_version(version)
+
+            if progress:
+                progress(year)
+
+        with main.engine.begin() as conn:
+            conn.execute(EntryToken.__table__.delete())
+            conn.execute(ENTRIES.delete())
+            main.set_meta(conn, 'sharded', 1)
+
+            # Drops the segments of the deleted entries
+            if self.fulltext:
+                conn.execute(text("INSERT INTO entries_fts (entries_fts) VALUES ('rebuild')"))
+
+        main.remove_unused_tags()
+        main.vacuum()
+
+        return len(years)
@@ -0,0 +1,37 @@
+"""
+    Writing statistics of a diary. The words and characters of an entry
+    are counted before it is encrypted and stored next to it, from which
+    the database keeps a summary per day up to date, such that the 
+    statistics never require decrypting the diary. See DBHandler.get_summary.
+"""
+from datetime import date, timedelta
+from mdiary.search import WORD_RE
+
+DAY_FORMAT = '%Y-%m-%d'
+
+def text_stats(txt):
+    """
+        Returns the (words, characters) of a text.
+    """
+    return sum(1 for _ in WORD_RE.finditer(txt)), len(txt)
+
+def streaks(days, today=None):
+    """
+        Returns the (current, longest) number of successive days on which
+        entries were written, given the sorted days formatted as YYYY-MM-DD. 
+        The current streak ends today or yesterday.
+    """
+    today = today or date.today()
+    current = longest = 0
+    previous = None
+
+    for day in days:
+        day = date(*(int(part) for part in day.split('-')))
+        current = current + 1 if previous and day - previous == timedelta(days=1) else 1
+        longest = max(longest, current)
+        previous = day
+
+    if previous is None or today - previous > timedelta(days=1):
+        current = 0
+
+    return current, longest
@@ -0,0 +1,182 @@
+"""
+    Optional timing of the hot paths of mdiary. Tracing is enabled by the
+    --profile argument or the MDIARY_TRACE environment variable (a file
+    name, or 1 for the default one), before the traced modules are imported:
+    when it is disabled the traced decorator returns functions unchanged,
+    such that tracing costs nothing.
+
+    The trace file holds one JSON object per line, a 'start' record, a
+    'span' record for every timed call and a 'summary' with the counts and
+    latency percentiles per operation when the program exits.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+MAX_SAMPLES = 100000 # per operation, older ones are sampled
+FLUSH_SIZE = 1000 # spans
+
+def default_path():
+    return Path.home() / '.mdiary' / 'trace-{}.jsonl'.format(os.getpid())
+
+def percentile(values, fraction):
+    """
+        Returns the value at fraction (0-1) of the sorted values.
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Tracer():
+    """
+        Collects the durations of operations and counters, writing the
+        spans to a trace file in batches. It may be used by any thread.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.start = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+        self.totals = {}
+        self.counters = {}
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def enable(self, path=None):
+        """
+            Start tracing to the file path, see default_path.
+        """
+        if self.enabled:
+            return
+
+        self.enabled = True
+        self.path = Path(path) if path else default_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self.path.open('w') as f:
+            f.write(json.dumps({'type': 'start', 'pid': os.getpid(), 'argv': sys.argv,
+                                'time': time.time()}) + '\n')
+
+        atexit.register(self.close)
+
+    def record(self, name, start, duration):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.totals[name] = self.totals.get(name, 0) + duration
+            samples = self.durations.setdefault(name, [])
+
+            if len(samples) < MAX_SAMPLES:
+                samples.append(duration)
+            else:
+                # Reservoir sampling keeps a uniform sample of all calls
+                i = random.randrange(self.counts[name])
+                if i < MAX_SAMPLES:
+                    samples[i] = duration
+
+            self.spans.append((name, start - self.start, duration, threading.current_thread().name))
+
+            if len(self.spans) >= FLUSH_SIZE:
+                self.flush()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def flush(self):
+        # Called with the lock held
+        spans, self.spans = self.spans, []
+
+        with self.path.open('a') as f:
+            for name, start, duration, thread in spans:
+                f.write(json.dumps({'type': 'span', 'name': name, 'start': round(start, 6),
+                                    'duration': round(duration, 6), 'thread': thread}) + '\n')
+
+    def stats(self):
+        """
+            Returns a list of (name, count, total, p50, p95, p99, max) tuples
+            of the traced operations in seconds, the slowest in total first.
+        """
+        with self.lock:
+            durations = {name: sorted(samples) for name, samples in self.durations.items()}
+            counts = dict(self.counts)
+            totals = dict(self.totals)
+
+        stats = [(name, counts[name], totals[name], percentile(samples, 0.5), percentile(samples, 0.95),
+                  percentile(samples, 0.99), samples[-1]) for name, samples in durations.items()]
+
+        return sorted(stats, key=lambda stat: stat[2], reverse=True)
+
+    def close(self):
+        """
+            Write the pending spans and the summary.
+        """
+        if not self.enabled:
+            return
+
+        summary = {name: {'count': count, 'total': total, 'p50': p50, 'p95': p95, 'p99': p99, 'max': maximum}
+                   for name, count, total, p50, p95, p99, maximum in self.stats()}
+
+        with self.lock:
+            self.flush()
+
+            with self.path.open('a') as f:
+                f.write(json.dumps({'type': 'summary', 'operations': summary,
+                                    'counters': dict(self.counters)}) + '\n')
+
+        self.enabled = False
+
+TRACER = Tracer()
+
+def enable(path=None):
+    TRACER.enable(path)
+
+def traced(name):
+    """
+        Decorator timing every call of a function as the operation name,
+        only when tracing is enabled while the function is defined.
+    """
+    def decorator(func):
+        if not TRACER.enabled:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                TRACER.record(name, start, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+@contextmanager
+def span(name):
+    """
+        Time a block of code as the operation name.
+    """
+    if not TRACER.enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        TRACER.record(name, start, time.perf_counter() - start)
+
+def count(name, n=1):
+    TRACER.count(name, n)
+
+if os.environ.get('MDIARY_TRACE'):
+    enable(None if os.environ['MDIARY_TRACE'] == '1' else os.environ['MDIARY_TRACE'])
@@ -0,0 +1,116 @@
+import re
+import json
+from datetime import datetime
+
+HEADER_RE = re.compile(r'^## (\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)')
+
+# Lines of entries which look like a header (after any backslashes) are
+# escaped by one more backslash, see escape_line
+ESCAPED_RE = re.compile(r'^\\*## \d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}')
+
+def parse_timestamp(value):
+    """
+        Parse an ISO formatted timestamp, defaulting to the current time.
+    """
+    if not value:
+        return datetime.now()
+
+    return datetime.fromisoformat(value)
+
+def escape_line(line):
+    """
+        Returns a line of an entry written to a Markdown journal, where
+        lines looking like the header of an entry are escaped by a 
+        backslash, as in Markdown.
+    """
+    return '\\' + line if ESCAPED_RE.match(line) else line
+
+def unescape_line(line):
+    """
+        Returns a line of an entry read from a Markdown journal,
+        undoing escape_line.
+    """
+    return line[1:] if line.startswith('\\') and ESCAPED_RE.match(line[1:]) else line
+
+def read_jsonl(f):
+    """
+        Yields (timestamp, text) tuples from a file with one JSON
+        object per line, holding a 'text' and optional 'timestamp'.
+    """
+    for line in f:
+        line = line.strip()
+
+        if line:
+            entry = json.loads(line)
+            yield parse_timestamp(entry.get('timestamp')), entry['text']
+
+def read_markdown(f):
+    """
+        Yields (timestamp, text) tuples from a Markdown journal, where every
+        entry starts with a '## YYYY-MM-DD HH:MM[:SS[.ffffff]]' header line.
+    """
+    timestamp = None
+    lines = []
+
+    for line in f:
+        match = HEADER_RE.match(line)
+
+        if match:
+            if timestamp:
+                yield timestamp, ''.join(lines).strip('\n')
+
+            timestamp = parse_timestamp(match.group(1))
+            lines = []
+        elif timestamp:
+            lines.append(unescape_line(line))
+
+    if timestamp:
+        yield timestamp, ''.join(lines).strip('\n')
+
+def write_jsonl(f, rows):
+    """
+        Writes (entry_id, timestamp, text) rows as JSON lines,
+        returns the number of written entries.
+    """
+    count = 0
+
+    for entry_id, timestamp, text in rows:
+        entry = {'id': entry_id, 'timestamp': timestamp.isoformat(), 'text': text}
+        f.write(json.dumps(entry) + '\n')
+        count += 1
+
+    return count
+
+def write_markdown(f, rows):
+    """
+        Writes (entry_id, timestamp, text) rows as a Markdown journal
+        readable by read_markdown, returns the number of written entries.
+        Timestamps are written with their microseconds, if any.
+    """
+    count = 0
+
+    for entry_id, timestamp, text in rows:
+        text = '\n'.join(escape_line(line) for line in text.split('\n'))
+        f.write('## {} (entry {})\n\n{}\n\n'.format(timestamp.isoformat(' '), entry_id, text))
+        count += 1
+
+    return count
+
+READERS = {
+    'jsonl': read_jsonl,
+    'markdown': read_markdown
+}
+
+WRITERS = {
+    'jsonl': write_jsonl,
+    'markdown': write_markdown
+}
+
+def guess_format(path):
+    """
+        Returns the format of a file based on its extension.
+    """
+    if str(path).endswith(('.md', '.markdown')):
+        return 'markdown'
+
+    return 'jsonl'
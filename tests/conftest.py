@@ -0,0 +1,58 @@
+import pytest
+from mdiary.core import DiaryCore
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """
+        An empty home directory of the diaries.
+    """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    (tmp_path / '.config' / 'mdiary').mkdir(parents=True)
+
+    return tmp_path
+
+def create_diary(using_key):
+    """
+        Returns a new diary named test, which uses the key file
+        ~/.mdiary/test.key if using_key is set.
+    """
+    diary = DiaryCore()
+    diary.gen_config('test', 'true' if using_key else 'false')
+
+    if using_key:
+        diary.gen_key(diary.hash_path / 'test.key')
+        diary.gen_key_hash()
+
+    return diary
+
+@pytest.fixture
+def diary(home):
+    diary = create_diary(using_key=False)
+    yield diary
+    diary.close_diary()
+
+@pytest.fixture
+def key_diary(home):
+    diary = create_diary(using_key=True)
+    yield diary
+    diary.close_diary()
+
+@pytest.fixture
+def reopen(home):
+    """
+        Returns a function opening the diary named test again, like 
+        mdiary does, which is closed at the end of the test.
+    """
+    diaries = []
+
+    def reopen(using_key, **kwargs):
+        diary = DiaryCore()
+        diary.open_diary(str(diary.hash_path / 'test.key') if using_key else None, **kwargs)
+        diaries.append(diary)
+
+        return diary
+
+    yield reopen
+
+    for diary in diaries:
+        diary.close_diary()
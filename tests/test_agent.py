@@ -0,0 +1,85 @@
+import os
+import socket
+import stat
+import threading
+import pytest
+from mdiary import agent
+
+KEY = b'0123456789abcdef0123456789abcdef0123456789a='
+
+def serve(sock_path, timeout=5):
+    """
+        Run an agent holding KEY in a thread, returns the thread once
+        the agent accepts connections.
+    """
+    thread = threading.Thread(target=agent.serve, args=(sock_path, KEY, timeout), daemon=True)
+    thread.start()
+
+    while True:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            client.connect(str(sock_path))
+            return thread
+        except OSError:
+            thread.join(0.01)
+        finally:
+            client.close()
+
+@pytest.fixture
+def sock_path(tmp_path):
+    return agent.socket_path('test', tmp_path)
+
+def test_peer_of_the_same_user(monkeypatch):
+    left, right = socket.socketpair(socket.AF_UNIX)
+
+    with left, right:
+        assert agent.peer_is_owner(left)
+
+        if hasattr(socket, 'SO_PEERCRED'):
+            uid = os.getuid()
+            monkeypatch.setattr(agent.os, 'getuid', lambda: uid + 1)
+
+            assert not agent.peer_is_owner(left)
+
+def test_serves_the_key_to_the_owner(sock_path):
+    thread = serve(sock_path)
+
+    assert stat.S_IMODE(sock_path.stat().st_mode) == 0o600
+    assert agent.get_key(sock_path) == KEY
+    assert agent.stop(sock_path)
+
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert not sock_path.exists()
+    assert agent.get_key(sock_path) is None
+
+def test_refuses_other_users(sock_path, monkeypatch):
+    monkeypatch.setattr(agent, 'peer_is_owner', lambda conn: False)
+    thread = serve(sock_path, timeout=0.5)
+
+    # Neither the key nor stopping the agent is granted
+    assert agent.get_key(sock_path) is None
+
+    agent.stop(sock_path)
+    thread.join(5)
+
+    assert not thread.is_alive() and not sock_path.exists()
+
+def test_one_agent_per_socket(sock_path):
+    thread = serve(sock_path)
+
+    with pytest.raises(RuntimeError):
+        agent.serve(sock_path, KEY)
+
+    agent.stop(sock_path)
+    thread.join(5)
+
+def test_start_in_the_background(sock_path):
+    agent.start(sock_path, KEY, timeout=10)
+
+    try:
+        assert agent.get_key(sock_path) == KEY
+    finally:
+        assert agent.stop(sock_path)
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+import pytest
+from mdiary.backup import BackupError, fcntl, manifest_chunks
+
+def texts(n, first=0):
+    return [(datetime(2021, 1, 1) + timedelta(days=day), u'Entry {}'.format(day)) for day in range(first, first + n)]
+
+def count_entries(path):
+    conn = sqlite3.connect(str(path))
+
+    try:
+        return conn.execute('SELECT count(*) FROM entries').fetchone()[0]
+    finally:
+        conn.close()
+
+@pytest.fixture
+def store(diary, tmp_path):
+    return diary.backup_store(tmp_path / 'backups')
+
+def test_ids_are_unique(diary, store):
+    diary.import_entries(texts(3))
+    manifests = [diary.backup(store) for _ in range(5)]
+    ids = [manifest['id'] for manifest in manifests]
+
+    assert len(set(ids)) == 5
+    assert [manifest['id'] for manifest in store.snapshots()] == ids
+    assert store.find()['id'] == ids[-1]
+    assert store.find(ids[1])['id'] == ids[1]
+
+def test_older_ids(diary, store):
+    diary.import_entries(texts(3))
+    manifest = diary.backup(store)
+
+    # Backups of older versions have ids and times of a precision of seconds
+    old = dict(manifest, id='2020-01-01T10-00-00', created='2020-01-01 10:00:00')
+    (store.snapshots_path / (old['id'] + '.json')).write_text(json.dumps(old))
+
+    assert [m['id'] for m in store.snapshots()] == [old['id'], manifest['id']]
+    assert store.find('2020-06-01')['id'] == old['id']
+
+def test_verify(diary, store):
+    diary.import_entries(texts(3))
+    manifest = diary.backup(store)
+
+    assert store.verify([manifest]) == len(set(manifest_chunks(manifest)))
+
+    digest = manifest_chunks(manifest)[0]
+    path = store.chunk_path(digest)
+    path.write_bytes(path.read_bytes()[:-1] + b'x')
+
+    with pytest.raises(BackupError):
+        store.verify([manifest])
+
+def test_restore(diary, store, reopen, tmp_path):
+    diary.import_entries(texts(3))
+    first = diary.backup(store)
+    diary.import_entries(texts(2, first=3))
+    diary.backup(store)
+
+    output = tmp_path / 'restored.db'
+    diary.restore_backup(store, first, output)
+
+    assert count_entries(output) == 3
+
+    diary.close_diary()
+    diary.restore_backup(store, store.find(first['created']))
+
+    assert reopen(using_key=False).db_handler.get_entry_count() == 3
+
+def test_prune(diary, store):
+    for day in range(3):
+        diary.import_entries(texts(1, first=day))
+        diary.backup(store)
+
+    kept = store.snapshots()[-1]
+    removed, chunks = store.prune(1)
+
+    assert removed == 2 and chunks > 0
+    assert store.snapshots() == [kept]
+    assert store.verify([kept]) == len(set(manifest_chunks(kept)))
+    assert store.prune(1) == (0, 0)
+
+@pytest.mark.skipif(fcntl is None, reason='needs file locks')
+def test_prune_waits_for_the_lock(diary, store):
+    diary.import_entries(texts(1))
+    diary.backup(store)
+    diary.backup(store)
+
+    with store.lock():
+        thread = threading.Thread(target=store.prune, args=(1,))
+        thread.start()
+        thread.join(0.2)
+
+        assert thread.is_alive() and len(store.snapshots()) == 2
+
+    thread.join(5)
+
+    assert len(store.snapshots()) == 1
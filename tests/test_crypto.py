@@ -0,0 +1,25 @@
+from cryptography.fernet import Fernet
+from mdiary.crypto import PARALLEL_THRESHOLD, EntryCipher, worker_context
+
+def test_parallel_round_trip():
+    cipher = EntryCipher(Fernet.generate_key())
+    texts = [u'Entry {} #tag'.format(i) for i in range(PARALLEL_THRESHOLD + 10)]
+
+    tokens = list(cipher.encrypt_many(texts, workers=2))
+    rows = list(cipher.decrypt_many(enumerate(tokens), workers=2))
+
+    assert rows == list(enumerate(texts))
+    assert [cipher.decrypt(token) for token in tokens[:10]] == texts[:10]
+
+def test_workers_are_not_forked():
+    assert worker_context().get_start_method() != 'fork'
+
+def test_rekey_with_an_old_key():
+    old = EntryCipher(Fernet.generate_key())
+    new = EntryCipher(Fernet.generate_key(), old_keys=[old.key])
+    tokens = list(old.encrypt_many([u'Old #tag'] * (PARALLEL_THRESHOLD + 1), workers=2))
+    rows = list(new.rekey_many(enumerate(tokens), workers=2))
+
+    assert len(rows) == len(tokens)
+    assert all(new.decrypt(token) == u'Old #tag' for _, token, _, _ in rows)
+    assert all(tags == new.blind_tags({'tag'}) for _, _, _, tags in rows)
@@ -0,0 +1,88 @@
+import string
+import zlib
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+from mdiary import payload
+from mdiary.payload import (ENCRYPTED, RAW, ZLIB, PayloadError, is_legacy, is_sealed, pack, seal, sql_text,
+                            unpack, unseal)
+
+LONG_TEXT = u'Went for a walk along the river, the water was high after the rain. ' * 20
+
+CODECS = ['none', 'zlib'] + (['zstd'] if payload.zstandard else [])
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('text', [u'', u'Short', u'Ünïcödé ✓ #tag', LONG_TEXT])
+def test_pack_round_trip(codec, text):
+    value = pack(text, codec)
+
+    assert not is_legacy(value)
+    assert not is_sealed(value)
+    assert unpack(value) == text
+    assert sql_text(value) == text
+
+@pytest.mark.parametrize('codec', CODECS)
+@pytest.mark.parametrize('text', [u'', u'Short', LONG_TEXT])
+def test_seal_round_trip(codec, text):
+    fernet = Fernet(Fernet.generate_key())
+    value = seal(fernet, text, codec)
+
+    assert value[0] & ENCRYPTED
+    assert is_sealed(value)
+    assert unpack(value) == value
+    assert sql_text(value) is None
+    assert unseal(fernet, value) == text
+
+def test_headers():
+    assert pack(u'Short', 'zlib')[0] == RAW
+    assert pack(LONG_TEXT, 'zlib')[0] == ZLIB
+    assert pack(LONG_TEXT, 'none')[0] == RAW
+
+def test_incompressible_text_is_kept_raw():
+    text = (string.ascii_letters + string.digits + string.punctuation)[:80]
+    value = pack(text, 'zlib')
+
+    assert value[0] == RAW
+    assert unpack(value) == text
+
+def test_packed_values_are_not_packed_again():
+    value = pack(LONG_TEXT)
+
+    assert pack(value) is value
+
+def test_legacy_plain_text():
+    assert is_legacy(u'An entry of an older version')
+    assert not is_sealed(u'An entry of an older version')
+    assert unpack(u'An entry of an older version') == u'An entry of an older version'
+    assert sql_text(u'An entry of an older version') == u'An entry of an older version'
+    assert unpack(None) is None
+
+@pytest.mark.parametrize('as_str', [True, False])
+def test_legacy_fernet_token(as_str):
+    fernet = Fernet(Fernet.generate_key())
+    token = fernet.encrypt(u'Encrypted by an older version'.encode())
+    value = token.decode() if as_str else token
+
+    assert is_legacy(value)
+    assert unpack(value) == value
+    assert unseal(fernet, value) == u'Encrypted by an older version'
+
+def test_unseal_with_another_key():
+    value = seal(Fernet(Fernet.generate_key()), u'Secret')
+
+    with pytest.raises(InvalidToken):
+        unseal(Fernet(Fernet.generate_key()), value)
+
+def test_unknown_codec():
+    with pytest.raises(PayloadError):
+        payload.decompress(0x07, b'')
+
+def test_corrupt_body():
+    with pytest.raises(zlib.error):
+        unpack(bytes([ZLIB]) + b'not zlib')
+
+def test_resolve_codec():
+    assert payload.resolve_codec('auto') == ('zstd' if payload.zstandard else 'zlib')
+    assert payload.resolve_codec('none') == 'none'
+
+    with pytest.raises(ValueError):
+        payload.resolve_codec('lzma')
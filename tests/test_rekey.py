@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+import pytest
+from cryptography.fernet import Fernet
+
+TEXTS = [(datetime(2020, 1, 1) + timedelta(days=day), u'Entry {}'.format(day)) for day in range(5)]
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(batches):
+    def progress(count):
+        progress.calls += 1
+
+        if progress.calls == batches:
+            raise Interrupted()
+
+    progress.calls = 0
+
+    return progress
+
+def texts(diary):
+    return [txt for _, txt in diary.decrypt_entries((row.entry_id, row.entry_text) 
+                                                    for row in diary.db_handler.iter_entries())]
+
+@pytest.fixture
+def new_key():
+    return Fernet.generate_key()
+
+def test_rekey(key_diary, new_key):
+    key_diary.import_entries(TEXTS)
+    old_key = key_diary.key
+
+    assert key_diary.rekey(new_key, batch=2) == 5
+    assert key_diary.rekey_state() is None
+    assert key_diary.verify_key_hash(new_key)
+    assert not key_diary.verify_key_hash(old_key)
+    assert texts(key_diary) == [txt for _, txt in TEXTS]
+
+def test_resume_from_the_checkpoint(key_diary, reopen, new_key):
+    key_diary.import_entries(TEXTS)
+    key_diary.update_entry(5, u'Entry 4, changed')
+    key_diary.save_draft('new', u'Draft')
+    key_diary.db_handler.flush()
+    old_key = key_diary.key
+
+    with pytest.raises(Interrupted):
+        key_diary.rekey(new_key, batch=2, progress=interrupt_after(1))
+
+    state = key_diary.rekey_state()
+
+    assert state is not None and state['after'] == 2
+    assert key_diary.verify_key_hash(old_key)
+
+    key_diary.close_diary()
+
+    # The diary stays locked until the rekey is finished
+    with pytest.raises(SystemExit):
+        reopen(using_key=True)
+
+    diary = reopen(using_key=True, rekey=True)
+
+    with pytest.raises(ValueError):
+        diary.rekey(Fernet.generate_key(), batch=2)
+
+    assert diary.rekey(new_key, batch=2) == 3
+    assert diary.rekey_state() is None
+    assert diary.verify_key_hash(new_key)
+
+    # Everything is readable with the new key alone
+    diary.set_key(new_key)
+
+    assert texts(diary) == [txt for _, txt in TEXTS[:4]] + [u'Entry 4, changed']
+    assert diary.revision_text(5, 1) == u'Entry 4'
+    assert diary.load_draft('new') == u'Draft'
+
+def test_rekey_to_the_same_key(key_diary):
+    with pytest.raises(ValueError):
+        key_diary.rekey(key_diary.key)
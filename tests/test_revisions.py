@@ -0,0 +1,77 @@
+import pytest
+from mdiary.revisions import SNAPSHOT_INTERVAL, apply_delta, make_delta, reconstruct, segments
+
+TEXTS = [
+    u'',
+    u'One line',
+    u'First sentence. Second one! A question?\nA new line.\n\n  Indented, no end',
+    u'Ünïcödé ✓ #tag... and more!!\r\nWindows line\r\n',
+]
+
+@pytest.mark.parametrize('txt', TEXTS)
+def test_segments_join(txt):
+    assert ''.join(segments(txt)) == txt
+
+@pytest.mark.parametrize('base', TEXTS)
+@pytest.mark.parametrize('txt', TEXTS)
+def test_delta_round_trip(base, txt):
+    assert apply_delta(base, make_delta(base, txt)) == txt
+
+def test_delta_copies_unchanged_segments():
+    base = u'Kept sentence. Removed sentence. Another kept one.\n'
+    txt = u'Kept sentence. Another kept one.\nAdded line.'
+    delta = make_delta(base, txt)
+
+    assert u'Kept sentence' not in delta
+    assert apply_delta(base, delta) == txt
+
+def versions(count):
+    txt = u'Day one. Nothing happened.\n'
+
+    for i in range(count):
+        yield txt
+        txt = txt.replace(u'Nothing', u'Little', 1) if i % 3 == 0 else txt + u'Edit {}.\n'.format(i)
+
+def history(texts):
+    """
+        Returns the current text and the (snapshot, text) revisions of
+        updating an entry through texts, as kept by the core.
+    """
+    texts = list(texts)
+    revisions = []
+    depth = 0
+
+    for old_text, txt in zip(texts, texts[1:]):
+        snapshot = depth + 1 >= SNAPSHOT_INTERVAL
+        revisions.append((snapshot, old_text if snapshot else make_delta(txt, old_text)))
+        depth = 0 if snapshot else depth + 1
+
+    return texts[-1], revisions
+
+def chain(revisions, revision):
+    """
+        Returns the revisions from revision up to the next snapshot, as
+        DBHandler.get_revision_chain.
+    """
+    result = []
+
+    for snapshot, text in revisions[revision:]:
+        result.append((snapshot, text))
+
+        if snapshot:
+            break
+
+    return result
+
+def test_reconstruct_every_revision():
+    texts = list(versions(3 * SNAPSHOT_INTERVAL + 2))
+    current, revisions = history(texts)
+
+    assert [snapshot for snapshot, _ in revisions].count(True) == 3
+
+    for revision, txt in enumerate(texts[:-1]):
+        assert reconstruct(current, chain(revisions, revision)) == txt
+
+def test_reconstruct_snapshot():
+    assert reconstruct(u'Current', [(True, u'Old')]) == u'Old'
+    assert reconstruct(u'Current', [(False, make_delta(u'Current', u'Newer')), (True, u'Current')]) == u'Newer'
@@ -0,0 +1,92 @@
+from datetime import datetime
+from sqlalchemy import text
+
+TEXTS = [
+    (datetime(2020, 1, 1, 9), u'Walked to the lake. #outside'),
+    (datetime(2020, 6, 1, 9), u'Rain all day, read a book.'),
+    (datetime(2021, 1, 1, 9), u'Lake frozen, walked around it.'),
+    (datetime(2021, 2, 1, 9), u'...'),
+]
+
+def found(diary, query):
+    return sorted(entry_id for entry_id, _, _ in diary.search_entries(query))
+
+def test_blind_tokens(key_diary):
+    key_diary.import_entries(TEXTS)
+
+    assert found(key_diary, 'lake') == [1, 3]
+    assert found(key_diary, 'LAKE walked') == [1, 3]
+    assert found(key_diary, 'lake rain') == []
+    assert found(key_diary, 'lak') == []
+    assert found(key_diary, 'lake from:2021') == [3]
+    assert found(key_diary, 'outside') == [1]
+    assert found(key_diary, '') == []
+
+    # Only keyed hashes of the words are stored
+    tokens = key_diary.db_handler.session.execute(text('SELECT token FROM entry_tokens')).fetchall()
+
+    assert tokens and all(b'lake' not in token for token, in tokens)
+
+def test_snippets_of_encrypted_entries(key_diary):
+    key_diary.import_entries(TEXTS)
+    (entry_id, timestamp, snippet), = key_diary.search_entries('rain')
+
+    assert (entry_id, timestamp) == (2, TEXTS[1][0])
+    assert 'Rain' in snippet
+
+def test_updates_replace_the_tokens(key_diary):
+    key_diary.import_entries(TEXTS)
+    key_diary.update_entry(2, u'Sunny all day.')
+    key_diary.db_handler.flush()
+
+    assert found(key_diary, 'rain') == []
+    assert found(key_diary, 'sunny') == [2]
+
+def unindexed_diary(key_diary, reopen):
+    """
+        Returns the diary of key_diary opened again after its entries
+        were stored without search tokens, as by an older version.
+    """
+    key_diary.import_entries(TEXTS)
+    key_diary.db_handler.remove_entry(4)
+
+    with key_diary.db_handler.engine.begin() as conn:
+        conn.execute(text('DELETE FROM entry_tokens'))
+        conn.execute(text("DELETE FROM meta WHERE key LIKE 'tokens_%'"))
+
+    key_diary.close_diary()
+
+    return reopen(using_key=True)
+
+def test_index_entries_in_the_background(key_diary, reopen):
+    diary = unindexed_diary(key_diary, reopen)
+
+    # Opening the diary does not index the entries
+    assert not diary.db_handler.is_indexed()
+    assert diary.db_handler.session.execute(text('SELECT count(*) FROM entry_tokens')).scalar() == 0
+
+    # Searches decrypt the entries meanwhile
+    assert found(diary, 'lake walked') == [1, 3]
+    assert found(diary, 'lake from:2021') == [3]
+    assert [entry_id for entry_id, _, _ in diary.search_entries('lake')] == [3, 1]
+
+    diary.start_migration()
+    diary.migration.join()
+
+    # The index is complete, even though the last unindexed entry was deleted
+    assert diary.db_handler.is_indexed()
+    assert found(diary, 'lake walked') == [1, 3]
+    assert found(diary, 'outside') == [1]
+
+def test_stopped_indexing_resumes(key_diary, reopen):
+    diary = unindexed_diary(key_diary, reopen)
+    diary.stop_migration.set()
+    diary.index_entries()
+
+    assert not diary.db_handler.is_indexed()
+
+    diary = reopen(using_key=True)
+    diary.index_entries()
+
+    assert diary.db_handler.is_indexed()
+    assert found(diary, 'rain') == [2]
@@ -0,0 +1,105 @@
+from datetime import datetime
+import pytest
+from mdiary.database import DBHandler
+from mdiary.shards import SHARD_IDS, ShardedDBHandler, by_year, shard_path, shard_paths, shard_year
+
+# Entries around the turn of the years 2023 and 2024
+TIMESTAMPS = [
+    datetime(2023, 1, 1, 0, 0, 0),
+    datetime(2023, 6, 1, 12, 0, 0),
+    datetime(2023, 12, 31, 23, 59, 59),
+    datetime(2024, 1, 1, 0, 0, 0),
+    datetime(2024, 1, 1, 0, 0, 1),
+]
+
+def test_shard_year():
+    assert shard_year(2024 * SHARD_IDS + 1) == 2024
+    assert shard_year(2025 * SHARD_IDS - 1) == 2024
+    assert shard_year(2025 * SHARD_IDS) == 2025
+
+def test_by_year():
+    rows = [(2023 * SHARD_IDS + 1, 'a'), (2024 * SHARD_IDS + 1, 'b'), (2023 * SHARD_IDS + 2, 'c')]
+
+    assert by_year(rows) == {2023: [rows[0], rows[2]], 2024: [rows[1]]}
+
+def test_shard_paths(tmp_path):
+    assert shard_path(tmp_path / 't.db', 987) == tmp_path / 't-0987.db'
+
+    for name in ('t.db', 't-2024.db', 't-2023.db', 't-x-2022.db', 't-20245.db', 'u-2021.db', 't-2020.db-wal'):
+        (tmp_path / name).touch()
+
+    assert shard_paths(tmp_path / 't.db') == {2023: tmp_path / 't-2023.db', 2024: tmp_path / 't-2024.db'}
+
+@pytest.fixture
+def sharded(tmp_path):
+    main = DBHandler(name='t.db', path=tmp_path)
+    main.create()
+    main.new_session()
+    db_handler = ShardedDBHandler(main)
+    yield db_handler
+    db_handler.close()
+
+def test_new_entries_go_to_the_shard_of_their_year(sharded):
+    ids = [sharded.new_entry('Entry {}'.format(i), timestamp=dt).entry_id for i, dt in enumerate(TIMESTAMPS)]
+
+    assert ids == [2023 * SHARD_IDS + 1, 2023 * SHARD_IDS + 2, 2023 * SHARD_IDS + 3,
+                   2024 * SHARD_IDS + 1, 2024 * SHARD_IDS + 2]
+    assert list(shard_paths(sharded.full_path)) == [2023, 2024]
+    assert sharded.get_entry(ids[3]).entry_text == 'Entry 3'
+    assert sharded.get_entry(2022 * SHARD_IDS + 1) is None
+
+def test_years_between(sharded):
+    sharded.years = [2022, 2023, 2024]
+
+    assert sharded.years_between() == [2022, 2023, 2024]
+    assert sharded.years_between(datetime(2023, 12, 31), datetime(2024, 1, 1)) == [2023]
+    assert sharded.years_between(datetime(2023, 12, 31), datetime(2024, 1, 1, 0, 0, 1)) == [2023, 2024]
+    assert sharded.years_between(end=datetime(2023, 1, 1)) == [2022]
+    assert sharded.years_between(start=datetime(2024, 1, 1)) == [2024]
+
+def test_split_keeps_pages(sharded):
+    main = sharded.main
+
+    for i, dt in enumerate(TIMESTAMPS):
+        main.new_entry('Entry {} #tag'.format(i), timestamp=dt)
+
+    single = [(row.timestamp, row.entry_text) for row in main.get_page(limit=10)]
+
+    assert sharded.split() == 2
+    assert main.get_meta('sharded')
+
+    rows = sharded.get_page(limit=10)
+
+    assert [(row.timestamp, row.entry_text) for row in rows] == single
+    assert [shard_year(row.entry_id) for row in rows] == [dt.year for dt in TIMESTAMPS]
+
+    # Paging across the boundary of the shards, both ways
+    assert sharded.get_page(after=sharded.entry_key(rows[1]), limit=2) == rows[2:4]
+    assert sharded.get_page(before=sharded.entry_key(rows[4]), limit=2) == rows[2:4]
+    assert sharded.get_page(last=True, limit=3) == rows[2:]
+    assert sharded.get_range(datetime(2023, 12, 31), datetime(2024, 1, 1, 0, 0, 1)) == rows[2:4]
+
+def test_migrate_skips_migrated_shards(diary, monkeypatch):
+    diary.import_entries([(dt, 'Entry {}'.format(i)) for i, dt in enumerate(TIMESTAMPS)])
+    diary.shard()
+    db_handler = diary.db_handler
+
+    assert [shard_year(shard.first_id) for shard in db_handler.unmigrated()] == [2023, 2024]
+
+    diary.stop_migration.set()
+    diary.migrate()
+
+    assert len(db_handler.unmigrated()) == 2
+
+    diary.stop_migration.clear()
+    diary.migrate()
+
+    assert db_handler.unmigrated() == [] and db_handler.is_indexed()
+    assert db_handler.get_meta('migrated-2023') == 1
+
+    migrated = []
+    monkeypatch.setattr(diary, 'backfill_stats', migrated.append)
+    db_handler.new_entry('Entry of 2025', timestamp=datetime(2025, 1, 1))
+    diary.migrate()
+
+    assert [shard_year(shard.first_id) for shard in migrated] == [2025]
@@ -0,0 +1,50 @@
+from datetime import datetime
+import pytest
+
+TEXTS = [
+    (datetime(2021, 3, 1, 9), u'One two three.'),
+    (datetime(2021, 3, 1, 18), u'Four five.'),
+    (datetime(2021, 3, 2, 9), u'Six.'),
+]
+
+@pytest.fixture(params=[False, True], ids=['plain', 'key'])
+def filled(request):
+    diary = request.getfixturevalue('key_diary' if request.param else 'diary')
+    diary.import_entries(TEXTS)
+
+    return diary
+
+def days(diary):
+    return diary.db_handler.stats_by_period('day')
+
+def test_insert(filled):
+    summary = filled.summary()
+
+    assert (summary['entries'], summary['words'], summary['chars'], summary['days']) == (3, 6, 28, 2)
+    assert (summary['first'], summary['last']) == (TEXTS[0][0], TEXTS[2][0])
+    assert days(filled) == [('2021-03-01', 2, 5, 24), ('2021-03-02', 1, 1, 4)]
+    assert filled.db_handler.stats_by_period('month') == [('2021-03', 3, 6, 28)]
+
+def test_update(filled):
+    filled.update_entry(1, u'One.')
+    filled.db_handler.flush()
+
+    assert days(filled) == [('2021-03-01', 2, 3, 14), ('2021-03-02', 1, 1, 4)]
+    assert filled.summary()['words'] == 4
+
+def test_delete(filled):
+    filled.db_handler.remove_entry(2)
+
+    assert days(filled) == [('2021-03-01', 1, 3, 14), ('2021-03-02', 1, 1, 4)]
+    assert filled.summary()['last'] == TEXTS[2][0]
+
+    filled.db_handler.remove_entry(3)
+    summary = filled.summary()
+
+    assert days(filled) == [('2021-03-01', 1, 3, 14)]
+    assert (summary['entries'], summary['days'], summary['first'], summary['last']) == (1, 1, TEXTS[0][0], TEXTS[0][0])
+
+    filled.db_handler.remove_entry(1)
+
+    assert days(filled) == []
+    assert filled.summary()['entries'] == 0
@@ -0,0 +1,44 @@
+from datetime import datetime
+import pytest
+
+TEXTS = [
+    (datetime(2021, 3, 1, 9), u'A long #walk along the river.'),
+    (datetime(2021, 3, 2, 9), u'Stayed in, #reading.'),
+    (datetime(2021, 3, 3, 9), u'Another #Walk, then #reading.'),
+]
+
+@pytest.fixture(params=[False, True], ids=['plain', 'key'])
+def filled(request):
+    diary = request.getfixturevalue('key_diary' if request.param else 'diary')
+    diary.import_entries(TEXTS)
+
+    return diary
+
+def tagged(diary, tag):
+    key = diary.tag_key(tag)
+    ids = [row.entry_id for row in diary.db_handler.get_page(tag=key)]
+
+    assert diary.db_handler.count_range(tag=key) == len(ids)
+
+    return ids
+
+def test_filter_by_tag(filled):
+    assert tagged(filled, 'walk') == [1, 3]
+    assert tagged(filled, '#reading') == [2, 3]
+    assert tagged(filled, 'river') == []
+    assert tagged(filled, 'reading') == [2, 3] and filled.tag_key('reading') == filled.tag_key('READING')
+
+def test_update(filled):
+    filled.update_entry(1, u'A long walk along the river.')
+    filled.update_entry(2, u'Stayed in, #reading about the #river.')
+    filled.db_handler.flush()
+
+    assert tagged(filled, 'walk') == [3]
+    assert tagged(filled, 'river') == [2]
+    assert tagged(filled, 'reading') == [2, 3]
+
+def test_delete(filled):
+    filled.db_handler.remove_entry(3)
+
+    assert tagged(filled, 'walk') == [1]
+    assert tagged(filled, 'reading') == [2]
@@ -0,0 +1,64 @@
+import io
+from datetime import datetime
+import pytest
+from mdiary.transfer import READERS, WRITERS, guess_format, read_markdown
+
+ROWS = [
+    (1, datetime(2020, 1, 1, 9, 30, 15, 123456), u'Plain entry'),
+    (2, datetime(2020, 1, 1, 9, 30, 15, 123457), u'Ünïcödé, "quotes"\nand a second line'),
+    (3, datetime(2020, 2, 29, 23, 59), u'## 2020-03-01 10:00 is not a new entry\n\\## 2020-03-01 10:00 neither\n## Heading'),
+    (4, datetime(2021, 1, 1), u'\\\\## 2021-01-01 00:00\n# Title\n\n\n  indented'),
+]
+
+def round_trip(format, rows):
+    rows = list(rows)
+    f = io.StringIO()
+
+    assert WRITERS[format](f, rows) == len(rows)
+
+    f.seek(0)
+
+    return list(READERS[format](f))
+
+@pytest.mark.parametrize('format', ['jsonl', 'markdown'])
+def test_round_trip(format):
+    assert round_trip(format, ROWS) == [(timestamp, text) for _, timestamp, text in ROWS]
+
+def test_markdown_escapes_headers():
+    f = io.StringIO()
+    WRITERS['markdown'](f, ROWS[2:3])
+
+    assert f.getvalue().count('\n## ') == 1
+    assert '\n\\## 2020-03-01 10:00 is not' in f.getvalue()
+    assert '\n## Heading' in f.getvalue()
+
+def test_read_markdown():
+    journal = io.StringIO(u'Preamble\n## 2020-01-01 10:00\nFirst\n\n## 2020-01-02 11:00:30 (entry 7)\n\nSecond\n')
+
+    assert list(read_markdown(journal)) == [
+        (datetime(2020, 1, 1, 10, 0), u'First'),
+        (datetime(2020, 1, 2, 11, 0, 30), u'Second')
+    ]
+
+def test_guess_format():
+    assert guess_format('journal.md') == 'markdown'
+    assert guess_format('journal.jsonl') == 'jsonl'
+
+@pytest.mark.parametrize('format', ['jsonl', 'markdown'])
+@pytest.mark.parametrize('using_key', [False, True])
+def test_export_import(request, using_key, format, reopen):
+    diary = request.getfixturevalue('key_diary' if using_key else 'diary')
+    rows = [(timestamp, text) for _, timestamp, text in ROWS]
+
+    assert diary.import_entries(reversed(rows)) == len(rows)
+
+    exported = round_trip(format, diary.export_entries())
+    diary.close_diary()
+
+    assert exported == rows
+
+    # Importing the export again doubles every entry
+    diary = reopen(using_key)
+    diary.import_entries(exported)
+
+    assert [(timestamp, text) for _, timestamp, text in diary.export_entries()] == [row for row in rows for _ in (0, 1)]
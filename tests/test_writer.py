@@ -0,0 +1,100 @@
+import threading
+import pytest
+
+def pause_writer(db_handler, monkeypatch):
+    """
+        Hold the first write of the background writer until the event
+        resume is set, returns the events started and resume and the list
+        of the op keys of every write.
+    """
+    started = threading.Event()
+    resume = threading.Event()
+    writes = []
+    write = db_handler.write
+
+    def paused_write(ops):
+        ops = list(ops)
+        writes.append([(op, key) for op, key, _ in ops])
+
+        if len(writes) == 1:
+            started.set()
+            resume.wait(5)
+
+        write(ops)
+
+    monkeypatch.setattr(db_handler, 'write', paused_write)
+
+    return started, resume, writes
+
+@pytest.mark.parametrize('using_key', [False, True])
+def test_updates_are_coalesced(request, monkeypatch, using_key):
+    diary = request.getfixturevalue('key_diary' if using_key else 'diary')
+    diary.add_entry(u'First version')
+    diary.db_handler.flush()
+
+    started, resume, writes = pause_writer(diary.db_handler, monkeypatch)
+    diary.update_entry(1, u'Second version')
+    started.wait(5)
+    diary.update_entry(1, u'Third version')
+    diary.update_entry(1, u'Fourth version')
+
+    # Reads see the queued updates before they are stored
+    assert diary.get_entry_text(1)[1] == u'Fourth version'
+
+    resume.set()
+    diary.db_handler.flush()
+
+    assert len(writes) == 2 and writes[1] == [('update', 1), ('update', 1)]
+    assert diary.get_entry_text(1)[1] == u'Fourth version'
+
+    # The revisions are kept against the stored texts
+    assert [revision for revision, _ in diary.db_handler.get_revisions(1)] == [2, 1]
+    assert diary.revision_text(1, 1) == u'First version'
+    assert diary.revision_text(1, 2) == u'Second version'
+
+def test_unchanged_text_keeps_no_revision(diary):
+    diary.add_entry(u'Same')
+    diary.update_entry(1, u'Same')
+    diary.db_handler.flush()
+
+    assert diary.db_handler.get_revisions(1) == []
+
+def test_update_does_not_wait_for_the_writer(diary, monkeypatch):
+    diary.add_entry(u'Entry')
+    diary.db_handler.flush()
+
+    def flush():
+        raise AssertionError('update_entry waited for the writer')
+
+    monkeypatch.setattr(diary.db_handler, 'flush', flush)
+    diary.update_entry(1, u'Changed entry')
+    diary.save_draft('edit-1', u'Draft')
+
+    assert diary.load_draft('edit-1') == u'Draft'
+
+    diary.discard_draft('edit-1')
+
+    assert diary.load_draft('edit-1') is None
+
+def test_drafts_are_stored(diary):
+    diary.save_draft('new', u'One')
+    diary.save_draft('new', u'Two')
+    diary.db_handler.flush()
+
+    assert diary.db_handler.queued == {}
+    assert diary.load_draft('new') == u'Two'
+
+def test_close_raises_failed_writes(diary, monkeypatch):
+    diary.add_entry(u'Entry')
+    diary.db_handler.flush()
+
+    def write(ops):
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(diary.db_handler, 'write', write)
+    diary.update_entry(1, u'Lost update')
+
+    with pytest.raises(RuntimeError, match='disk full'):
+        diary.db_handler.close()
+
+    assert diary.db_handler.write_error is None